@@ -0,0 +1,38 @@
+"""Benchmarks for the hot paths of the ISG state machine framework.
+
+Each module in this package may be run directly, e.g.
+
+    python -m benchmarks.dispatch
+
+and benchmarks.suite runs a fixed selection of them, recording the
+results as JSON for comparison between revisions. benchmarks.flows drives
+a connection end to end against a synthetic terminal application,
+benchmarks/fakehost.py.
+
+These are not installed along with the isg package.
+"""
+
+import time
+
+__all__ = ['bestOf', 'report']
+
+def bestOf(func, number=10000, repeat=3):
+    """Call func number times, repeat times over; return the best observed cost of a single call, in seconds."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for j in xrange(number):
+            func()
+        elapsed = (time.time() - start) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(name, before, after=None):
+    """Print a one-line summary of a per-call cost (in seconds), optionally comparing against a baseline."""
+    if after is None:
+        print '%-40s %10.2f us' % (name, before * 1e6)
+    else:
+        print '%-40s %10.2f us -> %10.2f us (%.1fx)' % (name, before * 1e6, after * 1e6, before / after)
+
+# vim: sw=4 ts=4 sts=4 sta et ai
@@ -0,0 +1,68 @@
+"""Cost of capturing 100+ fixed-position fields from a screen, one
+get_region() call per field versus a single FieldPlan pass; and of
+capturing and of scanning rows after a screen update, with list- and
+array-backed terminals."""
+
+import random
+
+from isg.util.screen_scraper.terminal import TrackingANSI, ArrayANSI, FieldPlan, capture_fields
+
+from benchmarks import bestOf, report
+
+FIELDS = 120
+
+def makeScreen(rows, cols, terminalClass=TrackingANSI):
+    term = terminalClass(rows, cols)
+    rand = random.Random(rows * cols)
+    for row in range(1, rows + 1):
+        term.write('\x1b[%d;1H' % row)
+        term.write(''.join([ rand.choice('ABCDEFGH 0123456789') for n in range(cols - 1) ]))
+    return term
+
+def makePlan(rows, cols):
+    rand = random.Random(FIELDS)
+    fields = []
+    for n in range(FIELDS):
+        length = rand.randint(1, 20)
+        fields.append(('field%d' % n, rand.randint(1, rows), rand.randint(1, cols - length), length, n % 2))
+    return FieldPlan(fields)
+
+def main():
+    for rows, cols in [(24, 80), (50, 132)]:
+        term = makeScreen(rows, cols)
+        plan = makePlan(rows, cols)
+        ## each capture follows a (one character) screen update, as it would in use
+        def perField():
+            term.put_abs(1, 1, 'A')
+            retval = {}
+            for name, lineno, startcol, length, strip in plan.fields:
+                text = term.get_region(lineno, startcol, lineno, startcol+length)[0]
+                if strip:
+                    text = text.strip()
+                retval[name] = text
+            return retval
+        def batched():
+            term.put_abs(1, 1, 'A')
+            return capture_fields(term, plan)
+        assert perField() == batched()
+        before = bestOf(perField, number=200)
+        after = bestOf(batched, number=200)
+        report('%d fields, %dx%d screen' % (FIELDS, rows, cols), before, after)
+        array_term = makeScreen(rows, cols, ArrayANSI)
+        def arrayBatched():
+            array_term.put_abs(1, 1, 'A')
+            return capture_fields(array_term, plan)
+        assert arrayBatched() == batched()
+        report('  ... with ArrayANSI', after, bestOf(arrayBatched, number=200))
+        def scan(term):
+            def scanner():
+                term.write('\x1b[1;1H\x1b[K')
+                for row in term.dump_rows():
+                    pass
+            return scanner
+        report('  dump_rows after update (ansi -> array)', bestOf(scan(term), number=200), bestOf(scan(array_term), number=200))
+
+if __name__ == '__main__':
+    main()
+
+# vim: sw=4 ts=4 sts=4 sta et ai
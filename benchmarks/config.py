@@ -0,0 +1,95 @@
+"""Cost of the ConfigMixIn lookups made on every keystroke or screen
+(sendline's endline, the settle_time property, send_key), with and without
+memoization; and of prefix queries (config_get_items) over large generated
+screen sections, by linear scan and through the sorted key index."""
+
+import configobj
+
+from isg.util.config import ConfigMixIn, UNDEFINED
+
+from benchmarks import bestOf, report
+
+CONFIG = r"""
+[General]
+settle_time=0.5
+dump_screen=False
+[os]
+endline='\r\n'
+term_key_PF1='\x1bOP'
+"""
+
+class Config(ConfigMixIn):
+    config = None
+
+class LegacyConfig(ConfigMixIn):
+    """Looks values up the way config_get did before lookups were memoized."""
+    config = None
+    def config_get(self, section, item, default=UNDEFINED, decode=False, isBoolean=False, isInteger=False, isFloat=False):
+        subtree = self.config_get_section(section)
+        if subtree is None or not item in subtree:
+            if default != UNDEFINED:
+                return default
+            raise KeyError((section, item))
+        if decode:
+            return subtree[item].decode('string_escape')
+        if isFloat:
+            return subtree.as_float(item)
+        if isInteger:
+            return subtree.as_int(item)
+        if isBoolean:
+            return subtree.as_bool(item)
+        return subtree[item]
+    def config_get_items(self, section, prefix, sort=None, strip_prefix=False):
+        subtree = self.config_get_section(section)
+        if subtree is None: return
+        for key in subtree.keys():
+            if not key[:len(prefix)] == prefix:
+                continue
+            value = subtree[key]
+            if strip_prefix:
+                key = key[len(prefix):]
+            yield key, value
+
+def makeScreenConfig(data_keys, verify_keys, redirect_keys):
+    """A [screens] section for one screen holding the given numbers of data__, verify_ and redirect_ keys, interleaved."""
+    lines = ['[screens]', '[[Screens]]', '[[[MENU]]]', '[[[[default]]]]']
+    for n in range(max(data_keys, verify_keys, redirect_keys)):
+        if n < data_keys:
+            lines.append('data__field%d=fixedpos,%d,1,10,1' % (n, n % 24 + 1))
+        if n < verify_keys:
+            lines.append('verify_%d=%d,TEXT%d' % (n, n % 24 + 1, n))
+        if n < redirect_keys:
+            lines.append('redirect_%d=regex,1,1,10,TEXT%d,other' % (n, n))
+    return configobj.ConfigObj(lines)
+
+LOOKUPS = [
+    ('endline (decoded)', ('os', 'endline'), {'decode': True}),
+    ('settle_time (float)', ('General', 'settle_time'), {'isFloat': True, 'default': 0.5}),
+    ('dump_screen (boolean)', ('General', 'dump_screen'), {'isBoolean': True, 'default': False}),
+    ('absent key, with default', ('os', 'term_key_PF2'), {'default': None}),
+]
+
+def main():
+    config = configobj.ConfigObj(CONFIG.splitlines())
+    before = LegacyConfig(config)
+    after = Config(config)
+    for name, args, kwargs in LOOKUPS:
+        assert before.config_get(*args, **kwargs) == after.config_get(*args, **kwargs)
+        report('config_get: %s' % name,
+               bestOf(lambda: before.config_get(*args, **kwargs), number=20000),
+               bestOf(lambda: after.config_get(*args, **kwargs), number=20000))
+    section = ['screens', 'Screens', 'MENU', 'default']
+    for data_keys, verify_keys, redirect_keys in [(100, 10, 10), (500, 50, 50), (2000, 100, 100)]:
+        config = makeScreenConfig(data_keys, verify_keys, redirect_keys)
+        before = LegacyConfig(config)
+        after = Config(config)
+        for prefix in ['verify_', 'redirect_']:
+            assert list(before.config_get_items(section, prefix)) == list(after.config_get_items(section, prefix))
+            report('%s of %d keys' % (prefix, data_keys + verify_keys + redirect_keys),
+                   bestOf(lambda: list(before.config_get_items(section, prefix)), number=200),
+                   bestOf(lambda: list(after.config_get_items(section, prefix)), number=200))
+
+if __name__ == '__main__':
+    main()
+
+# vim: sw=4 ts=4 sts=4 sta et ai
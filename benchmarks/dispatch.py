@@ -0,0 +1,77 @@
+"""Per-step cost of StateMachineHandler.run(), and of transition handler lookup, with and without the dispatch table."""
+
+from isg.state_machine import StateMachineHandler, HandlerSet, TransitionHelperSet, \
+    possibleStateHandlerNames, possibleTransitionHandlerNames, nullHandler
+
+from benchmarks import bestOf, report
+
+class CyclingHandlers(HandlerSet):
+    """Cycles between a few nested states, finishing after a set number of steps."""
+    def do__FIRST__STEP(self):
+        return 'SECOND__STEP__INNER'
+    def do__SECOND__default(self):
+        return 'THIRD'
+    def post__SECOND__default(self):
+        pass
+    def do__THIRD(self):
+        self.remaining -= 1
+        if self.remaining <= 0:
+            self.exitStateMachine(newState='FIRST__STEP')
+        return 'FIRST__STEP'
+
+class ReconnectHelpers(TransitionHelperSet):
+    def transition__default__to__DISCONNECTED(self):
+        self.setState('DISCONNECTED')
+
+class Machine(StateMachineHandler):
+    pass
+
+class LegacyMachine(StateMachineHandler):
+    """Resolves handlers the way getStateHandler did before the dispatch table existed."""
+    def getStateHandler(self, stateName=None, handlerType='do', allowFail=False):
+        if stateName == None: stateName = self._StateMachineHandler__state
+        for name in possibleStateHandlerNames(stateName, handlerType):
+            if hasattr(self, name):
+                return getattr(self, name)
+        if not allowFail:
+            raise KeyError('No handler for %s found' % repr(stateName))
+        return nullHandler
+    def getTransitionHandler(self, stateOne, stateTwo=None):
+        if stateTwo is None: oldState, newState = (self._StateMachineHandler__state, stateOne)
+        else:                oldState, newState = (stateOne, stateTwo)
+        for name in possibleTransitionHandlerNames(oldState, newState):
+            if hasattr(self, name):
+                return getattr(self, name)
+        raise KeyError('No handler for %s -> %s found' % (repr(oldState), repr(newState)))
+
+STEPS = 1000
+
+def makeRunner(machineClass):
+    machine = machineClass()
+    machine.inherit(CyclingHandlers)
+    machine.setState('FIRST__STEP')
+    def runner():
+        machine.remaining = STEPS
+        machine.run()
+    return runner
+
+def makeTransitionLookup(machineClass):
+    machine = machineClass()
+    machine.inherit((CyclingHandlers, ReconnectHelpers))
+    def lookup():
+        machine.getTransitionHandler('SECOND__STEP__INNER', 'DISCONNECTED')
+    return lookup
+
+def main():
+    # each pass through the cycle is three steps
+    before = bestOf(makeRunner(LegacyMachine), number=10) / (STEPS * 3)
+    after = bestOf(makeRunner(Machine), number=10) / (STEPS * 3)
+    report('state machine step', before, after)
+    before = bestOf(makeTransitionLookup(LegacyMachine))
+    after = bestOf(makeTransitionLookup(Machine))
+    report('transition handler lookup', before, after)
+
+if __name__ == '__main__':
+    main()
+
+# vim: sw=4 ts=4 sts=4 sta et ai
@@ -0,0 +1,122 @@
+"""A synthetic terminal application for end-to-end benchmarks.
+
+Run under a pty (as pxtty.spawn runs it), it draws 24x80 ANSI screens:
+a login screen asking for a username and password, a main menu listing
+numbered reports, and pages of report fields. Content is generated from
+a fixed seed, so every run draws identical screens.
+
+    login     Username: <any>   Password: <PASSWORD>
+    menu      <n>  show report n             x  log out
+    report    <blank line>  next page (back to the menu after the last)
+              q  back to the menu
+
+Every screen ends by placing the cursor at the prompt, with SCREEN_END,
+which makes a convenient settle_pattern. Output is written chunk bytes
+at a time with delay seconds between chunks, after think seconds of
+"processing" per request, to stand in for hosts and links of various
+speeds.
+
+    python benchmarks/fakehost.py --think 0.001 --chunk 256 --delay 0.002
+"""
+
+import optparse
+import os
+import random
+import sys
+import time
+
+PASSWORD = 'secret'
+REPORTS = 5
+FIELDS_PER_PAGE = 18
+PROMPT_ROW = 22
+SCREEN_END = '\x1b[%d;13H' % PROMPT_ROW
+
+def goto(row, col):
+    return '\x1b[%d;%dH' % (row, col)
+
+class FakeHost(object):
+    def __init__(self, pages=4, think=0, chunk=0, delay=0, seed=0):
+        self.pages = pages
+        self.think = think
+        self.chunk = chunk
+        self.delay = delay
+        self.rand = random.Random(seed)
+    def draw(self, title, lines, prompt):
+        screen = ['\x1b[H\x1b[2J', goto(1, 1), title]
+        for row, text in lines:
+            screen.append(goto(row, 1))
+            screen.append(text)
+        screen.append(goto(PROMPT_ROW, 1))
+        screen.append(prompt.ljust(12))
+        screen.append(SCREEN_END)
+        self.write(''.join(screen))
+    def write(self, data):
+        if self.think:
+            time.sleep(self.think)
+        if not self.chunk:
+            os.write(1, data)
+            return
+        for start in range(0, len(data), self.chunk):
+            os.write(1, data[start:start + self.chunk])
+            if self.delay:
+                time.sleep(self.delay)
+    def readline(self):
+        line = sys.stdin.readline()
+        if not line:
+            raise EOFError()
+        return line.strip()
+    def login(self):
+        while True:
+            self.draw('LOGIN', [(10, 'Welcome to the benchmark host.')], 'Username:')
+            self.readline()
+            self.draw('LOGIN', [(10, 'Welcome to the benchmark host.')], 'Password:')
+            if self.readline() == PASSWORD:
+                return
+            self.draw('LOGIN', [(12, 'INVALID LOGIN')], 'Username:')
+    def menu(self):
+        lines = [ (row + 3, '%d. REPORT %d' % (row + 1, row + 1)) for row in range(REPORTS) ]
+        lines.append((REPORTS + 4, 'x. LOG OUT'))
+        while True:
+            self.draw('MAIN MENU', lines, 'SELECTION:')
+            choice = self.readline()
+            if choice == 'x':
+                return
+            if choice.isdigit() and 1 <= int(choice) <= REPORTS:
+                self.report(int(choice))
+    def report(self, number):
+        for page in range(1, self.pages + 1):
+            lines = []
+            for n in range(FIELDS_PER_PAGE):
+                value = ''.join([ self.rand.choice('ABCDEFGHJKLMNPQRSTUVWXYZ0123456789') for i in range(10) ])
+                lines.append((n + 3, 'FIELD%02d:   %s' % (n + 1, value)))
+            self.draw('REPORT %d PAGE %d OF %d' % (number, page, self.pages), lines, 'ENTER/Q:')
+            if self.readline() == 'q':
+                return
+    def run(self):
+        try:
+            self.login()
+            self.menu()
+        except EOFError:
+            pass
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--pages', type='int', default=4, help='pages per report')
+    parser.add_option('--think', type='float', default=0, help='seconds to wait before answering each request')
+    parser.add_option('--chunk', type='int', default=0, help='bytes written at a time (0 for whole screens)')
+    parser.add_option('--delay', type='float', default=0, help='seconds to wait between chunks')
+    parser.add_option('--seed', type='int', default=0)
+    options, args = parser.parse_args()
+    try:
+        import termios
+        attributes = termios.tcgetattr(0)
+        attributes[3] = attributes[3] & ~termios.ECHO
+        termios.tcsetattr(0, termios.TCSANOW, attributes)
+    except Exception:
+        pass                              ## not on a tty; input is not echoed anyway
+    FakeHost(options.pages, options.think, options.chunk, options.delay, options.seed).run()
+
+if __name__ == '__main__':
+    main()
+
+# vim: sw=4 ts=4 sts=4 sta et ai
@@ -0,0 +1,263 @@
+"""End-to-end throughput of a BaseConnection driving the synthetic host
+(benchmarks/fakehost.py) through a login, then each report on its menu,
+page by page, capturing every field of every page: screens imaged per
+second, image_screen latency, and state machine steps per second, for
+hosts and links of various speeds.
+
+pexpect sleeps delaybeforesend (50ms by default) before every send, and
+so twice per sendline; that alone would swamp everything else measured
+here, so it is set to 0 (the fake host needs no such delay), except in
+one run which shows what it costs.
+
+The flow is also recorded once, and replayed (see
+isg.util.screen_scraper.recording) as fast as it will go, with no host;
+and run from a [SpawnPool] of children logged in ahead of time, checking
+that sessions are handed pooled children, start at the menu, and that
+the children are all reaped once disconnected."""
+
+import configobj
+import glob
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from isg.state_machine import StateMachineHandler
+from isg.util.screen_scraper import BaseConnection
+from isg.util.screen_scraper.spawnpool import reaper
+
+from benchmarks import report
+from benchmarks import fakehost
+
+## name -> fakehost options: think seconds per request, bytes per write and seconds between writes
+PACINGS = [
+    ('instant', {'think': 0, 'chunk': 0, 'delay': 0}),
+    ('fast host', {'think': 0.001, 'chunk': 512, 'delay': 0.0005}),
+    ('slow link', {'think': 0.002, 'chunk': 128, 'delay': 0.002}),
+]
+
+def fakehostCommand(pages=4, think=0, chunk=0, delay=0, seed=0):
+    script = os.path.join(os.path.dirname(os.path.abspath(fakehost.__file__)), 'fakehost.py')
+    return '%s %s --pages %d --think %r --chunk %d --delay %r --seed %d' % (
+        sys.executable, script, pages, think, chunk, delay, seed)
+
+def makeConfig(spawnString, backend='ansi'):
+    config = configobj.ConfigObj()
+    config['General'] = {
+        'terminal_backend': backend,
+        'settle_time': '0.5',
+        ## screens end by placing the cursor at the prompt, so there is no need to wait out settle_time
+        'settle_pattern': fakehost.SCREEN_END.replace('\x1b', '\\x1b').replace('[', '\\['),
+    }
+    config['Connect'] = {'spawnString': spawnString}
+    config['os'] = {'endline': '\\r'}
+    report_screen = {
+        'verify_1': ['1', r'REPORT \d+ PAGE \d+ OF \d+'],
+        'data__report': ['fixedpos', '1', '8', '1', '1'],
+        'data__page': ['fixedpos', '1', '15', '1', '1'],
+        'data__pages': ['fixedpos', '1', '20', '1', '1'],
+    }
+    for n in range(fakehost.FIELDS_PER_PAGE):
+        report_screen['data__field%02d' % (n + 1)] = ['fixedpos', str(n + 3), '12', '10', '1']
+    config['screens'] = {'BenchScreens': {
+        'CONNECTING': {'default': {'verify_1': ['1', 'LOGIN'], 'verify_2': [str(fakehost.PROMPT_ROW), 'Username:']}},
+        'PASSWORD': {'default': {'verify_1': [str(fakehost.PROMPT_ROW), 'Password:']}},
+        'MENU': {'default': {'verify_1': ['1', 'MAIN MENU']}},
+        'REPORT': {'default': report_screen},
+    }}
+    return config
+
+class BenchScreens(BaseConnection):
+    """Logs in, then pages through each report in turn, keeping the latency of every image_screen."""
+    send_delay = 0
+    def cmd_connect(self, resume=False):
+        retval = BaseConnection.cmd_connect(self, resume)
+        self.pooled = retval
+        if self.send_delay is not None:
+            self.child.delaybeforesend = self.send_delay
+        return retval
+    def image_screen(self, expect_updates=False, settle_time=None, substate='default'):
+        start = time.time()
+        BaseConnection.image_screen(self, expect_updates, settle_time, substate)
+        self.latencies.append(time.time() - start)
+    def pre__default(self):
+        self.steps += 1
+    def do__CONNECTING(self):
+        self.image_screen()
+        self.sendline('bench')
+        return 'PASSWORD'
+    def do__PASSWORD(self):
+        self.image_screen()
+        self.sendline(fakehost.PASSWORD)
+        return 'MENU'
+    def do__MENU(self):
+        self.image_screen()
+        if not self.reports:
+            self.sendline('x')
+            self.exitStateMachine(newState='DONE')
+        self.sendline(str(self.reports.pop(0)))
+        return 'REPORT'
+    def do__REPORT(self):
+        self.image_screen()
+        data = self._BenchScreens__data
+        self.captured += len(data)
+        self.sendline()
+        if data['page'] == data['pages']:
+            return 'MENU'
+        return 'REPORT'
+
+class Machine(StateMachineHandler):
+    pass
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+def makeMachine(config, send_delay=0):
+    machine = Machine()
+    BenchScreens.config = config
+    machine.inherit(BenchScreens)
+    machine.send_delay = send_delay
+    machine.latencies = []
+    machine.steps = 0
+    machine.captured = 0
+    machine.reports = range(1, fakehost.REPORTS + 1)
+    return machine
+
+def runFlow(pacing, backend='ansi', pages=4, repeat=3, send_delay=0):
+    """Run the whole flow repeat times against a fresh fakehost; return figures for the fastest run. send_delay, if not None, replaces pexpect's delaybeforesend."""
+    best = None
+    for i in range(repeat):
+        machine = makeMachine(makeConfig(fakehostCommand(pages=pages, **pacing), backend), send_delay)
+        start = time.time()
+        machine.run()
+        elapsed = time.time() - start
+        machine.transitionTo('DISCONNECTED')
+        if best is None or elapsed < best[0]:
+            best = (elapsed, machine.latencies, machine.steps, machine.captured)
+    elapsed, latencies, steps, captured = best
+    ## the first screen waits on the host starting up, so is reported apart from the rest
+    first_screen = latencies.pop(0)
+    return {
+        'elapsed': elapsed,
+        'screens': len(latencies) + 1,
+        'first_screen': first_screen,
+        'fields_captured': captured,
+        'screens_per_second': (len(latencies) + 1) / elapsed,
+        'steps_per_second': steps / elapsed,
+        'image_screen_p50': percentile(latencies, 0.5),
+        'image_screen_p99': percentile(latencies, 0.99),
+    }
+
+def replayFlow(backend='ansi', sessions=50):
+    """Record the flow once, against an instant fakehost, then replay it sessions times; return figures for the replays."""
+    directory = tempfile.mkdtemp()
+    try:
+        config = makeConfig(fakehostCommand(), backend)
+        config['Record'] = {'directory': directory}
+        machine = makeMachine(config)
+        machine.run()
+        machine.transitionTo('DISCONNECTED')
+        config = makeConfig('unused', backend)
+        config['Connect']['replayFile'] = glob.glob(os.path.join(directory, '*'))[0]
+        steps = 0
+        start = time.time()
+        for i in range(sessions):
+            machine = makeMachine(config)
+            machine.run()
+            machine.transitionTo('DISCONNECTED')
+            steps += machine.steps
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(directory)
+    return {
+        'elapsed': elapsed,
+        'sessions_per_minute': sessions * 60 / elapsed,
+        'steps_per_second': steps / elapsed,
+    }
+
+def poolConfig(backend='ansi', size=2):
+    """The flow's config, with a [SpawnPool] logging children in to the menu."""
+    config = makeConfig(fakehostCommand(), backend)
+    config['SpawnPool'] = {
+        'size': str(size),
+        'login_1': ['Username:', 'bench\\r'],
+        'login_2': ['Password:', fakehost.PASSWORD + '\\r'],
+        'verify_1': ['1', 'MAIN MENU'],
+        'ready_state': 'MENU',
+        'settle_time': '0.2',
+        'check_interval': '0.5',
+    }
+    return config
+
+def waitFor(condition, timeout, what):
+    end_time = time.time() + timeout
+    while not condition():
+        if time.time() > end_time:
+            raise RuntimeError('timed out waiting for %s' % what)
+        time.sleep(0.01)
+
+def poolFlow(backend='ansi', sessions=10, size=2):
+    """Warm a SpawnPool of size children, then run the flow sessions times from it, one after another; return figures for the pooled sessions. Raises RuntimeError if the pool does not warm, a session starts anywhere but the menu, or the reaper does not drain."""
+    config = poolConfig(backend, size)
+    start = time.time()
+    warmer = makeMachine(config)
+    pool = warmer.spawn_pool()
+    waitFor(lambda: pool.ready() == size, 30, 'the pool to warm')
+    warm_time = time.time() - start
+    pooled = 0
+    elapsed = 0
+    for i in range(sessions):
+        ## let the pool refill, so that every session should find a child ready
+        waitFor(lambda: pool.ready() == size, 30, 'the pool to refill')
+        machine = makeMachine(config)
+        start = time.time()
+        machine.run()
+        elapsed += time.time() - start
+        if machine.pooled:
+            pooled += 1
+            ## the menu before each report and at the end, and each report's pages; no login screens
+            if len(machine.latencies) != fakehost.REPORTS + 1 + fakehost.REPORTS * 4:
+                raise RuntimeError('a pooled session did not start at the menu')
+        machine.transitionTo('DISCONNECTED')
+        machine.release_spawn_pool()
+    ## the last session to let go of the pool stops it, reaping its children
+    start = time.time()
+    warmer.release_spawn_pool()
+    waitFor(lambda: not len(reaper), 30, 'the reaper to drain')
+    return {
+        'warm_time': warm_time,
+        'pooled': pooled,
+        'sessions_per_minute': sessions * 60 / elapsed,
+        'reap_time': time.time() - start,
+    }
+
+def flows():
+    """Yield (name, figures) for each pacing and terminal backend."""
+    for name, pacing in PACINGS:
+        for backend in ['ansi', 'array']:
+            yield '%s, %s terminal' % (name, backend), runFlow(pacing, backend)
+    yield 'instant, ansi terminal, pexpect send delay', runFlow(PACINGS[0][1], 'ansi', repeat=1, send_delay=None)
+
+def main():
+    logging.disable(logging.CRITICAL)
+    for name, figures in flows():
+        print '%s: %d screens in %.2fs, %.1f screens/s, %.1f steps/s' % (
+            name, figures['screens'], figures['elapsed'], figures['screens_per_second'], figures['steps_per_second'])
+        report('  first screen', figures['first_screen'])
+        report('  image_screen p50', figures['image_screen_p50'])
+        report('  image_screen p99', figures['image_screen_p99'])
+    for backend in ['ansi', 'array']:
+        figures = replayFlow(backend)
+        print 'replay, %s terminal: %.0f sessions/min, %.0f steps/s' % (backend, figures['sessions_per_minute'], figures['steps_per_second'])
+    figures = poolFlow()
+    print 'spawn pool: %d of 10 sessions pooled, %.0f sessions/min' % (figures['pooled'], figures['sessions_per_minute'])
+    report('  warming', figures['warm_time'])
+    report('  reaping', figures['reap_time'])
+
+if __name__ == '__main__':
+    main()
+
+# vim: sw=4 ts=4 sts=4 sta et ai
@@ -0,0 +1,63 @@
+"""State machine step throughput with INFO logging turned off, comparing
+eagerly formatted log messages against the deferred ones, and the cost of
+recording into a TraceBuffer instead, or of timing each handler into a
+StateStats."""
+
+import logging
+
+from isg.state_machine import StateMachineHandler, HandlerSet
+
+from benchmarks import bestOf, report
+
+class PagingHandlers(HandlerSet):
+    """Pushes and pops a report page with a sizable stateData payload on each pass."""
+    def do__MENU(self):
+        self.remaining -= 1
+        if self.remaining <= 0:
+            self.exitStateMachine(newState='MENU')
+        self.push('REPORT__PAGE', self.payload)
+    def do__REPORT__PAGE(self):
+        self.pop()
+
+class Machine(StateMachineHandler):
+    payload = dict([ ('field%d' % n, 'x' * 40) for n in range(50) ])
+
+class EagerMachine(Machine):
+    """Formats its log messages up front, as push/pop/setState used to."""
+    def push(self, state, stateData=None):
+        logging.getLogger('StateMachine.StateMachineHandler').info('push(state=%s, stateData=%s) oldState=%s stack=%s' % (repr(state), repr(stateData), repr(self._StateMachineHandler__state), repr(self._StateMachineHandler__oldStateStack)))
+        StateMachineHandler.push(self, state, stateData)
+    def pop(self):
+        StateMachineHandler.pop(self)
+        logging.getLogger('StateMachine.StateMachineHandler').info('pop() -> (state=%s, stateData=%s) stack=%s' % (repr(self._StateMachineHandler__state), repr(self._StateMachineHandler__stateData), repr(self._StateMachineHandler__oldStateStack)))
+
+STEPS = 500
+
+def makeRunner(machineClass, trace=False, stats=False):
+    machine = machineClass()
+    machine.inherit(PagingHandlers)
+    machine.setState('MENU')
+    if trace:
+        machine.enableTrace()
+    if stats:
+        machine.enableStats()
+    def runner():
+        machine.remaining = STEPS
+        machine.run()
+    return runner
+
+def main():
+    logging.getLogger('StateMachine').setLevel(logging.WARNING)
+    # each pass is two steps
+    eager = bestOf(makeRunner(EagerMachine), number=10) / (STEPS * 2)
+    deferred = bestOf(makeRunner(Machine), number=10) / (STEPS * 2)
+    traced = bestOf(makeRunner(Machine, trace=True), number=10) / (STEPS * 2)
+    report('step, INFO off (eager -> deferred)', eager, deferred)
+    timed = bestOf(makeRunner(Machine, stats=True), number=10) / (STEPS * 2)
+    report('step, INFO off, tracing enabled', traced)
+    report('step, INFO off (stats off -> on)', deferred, timed)
+
+if __name__ == '__main__':
+    main()
+
+# vim: sw=4 ts=4 sts=4 sta et ai
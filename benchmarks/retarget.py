@@ -0,0 +1,68 @@
+"""Cost of Retargetable.inherit when switching between handler families,
+and when re-requesting the family already in place."""
+
+import new, sha, string
+
+from isg.state_machine import StateMachineHandler, HandlerSet
+
+from benchmarks import bestOf, report
+
+class LoginScreens(HandlerSet):
+    def do__LOGIN(self): pass
+
+class MenuScreens(HandlerSet):
+    def do__MENU(self): pass
+
+class ReportScreens(HandlerSet):
+    def do__REPORT(self): pass
+
+class Machine(StateMachineHandler):
+    pass
+
+class LegacyMachine(StateMachineHandler):
+    """Retargets the way inherit() did before generated classes were keyed on their bases."""
+    legacyClasses = {}
+    def inherit(self, requestedClasses):
+        if hasattr(self.__class__, 'originalClass'):
+            baseClass = self.__class__.originalClass
+        else:
+            baseClass = self.__class__
+        requestedClasses = self._Retargetable__parseClasslistArg(requestedClasses)
+        classes = tuple(self._Retargetable__firstConstantClasses) + (baseClass,) + requestedClasses + tuple(self._Retargetable__constantClasses)
+        for aClass in classes:
+            assert isinstance(aClass, type)
+        className  = '__GeneratedClass__' + sha.sha(string.join([clazz.__name__ for clazz in classes], '__')).hexdigest()
+        if not LegacyMachine.legacyClasses.has_key(className):
+            LegacyMachine.legacyClasses[className] = new.classobj(className, classes, {'originalClass':baseClass})
+        self.__class__ = LegacyMachine.legacyClasses[className]
+        for aClass in classes:
+            self._Retargetable__initializeIfNeeded(aClass)
+
+def makeSwitcher(machineClass):
+    machine = machineClass()
+    families = [ (LoginScreens,), (MenuScreens, ReportScreens), (ReportScreens,) ]
+    def switcher():
+        for family in families:
+            machine.inherit(family)
+    return switcher
+
+def makeRepeater(machineClass):
+    machine = machineClass()
+    family = (MenuScreens, ReportScreens)
+    machine.inherit(family)
+    def repeater():
+        machine.inherit(family)
+    return repeater
+
+def main():
+    before = bestOf(makeSwitcher(LegacyMachine)) / 3
+    after = bestOf(makeSwitcher(Machine)) / 3
+    report('inherit, switching family', before, after)
+    before = bestOf(makeRepeater(LegacyMachine))
+    after = bestOf(makeRepeater(Machine))
+    report('inherit, same family', before, after)
+
+if __name__ == '__main__':
+    main()
+
+# vim: sw=4 ts=4 sts=4 sta et ai
@@ -0,0 +1,79 @@
+"""Round-trip cost of typical calls over XML-RPC versus the framed
+transport (JSON over TCP and over a Unix socket, and msgpack if it is
+installed), against a stand-in session on the loopback interface. The
+calls return a screen dump and a dict of captured fields, as the real
+screen-scraping methods do."""
+
+import logging
+import os
+import random
+import tempfile
+import threading
+import xmlrpclib
+
+from SimpleXMLRPCServer import SimpleXMLRPCServer
+
+from isg.util.xmlrpc import ServerObject
+from isg.util.xmlrpc.framed import FramedProxy, makeFramedServer, codecs
+
+from benchmarks import bestOf, report
+
+class StandInSession(object):
+    """Returns canned data shaped like that of a 24x80 screen-scraping session."""
+    def __init__(self):
+        rand = random.Random(0)
+        self.rows = [ ''.join([ rand.choice('ABCDEFGH 0123456789') for n in range(80) ]) for row in range(24) ]
+        self.fields = dict([ ('field%d' % n, row[n % 60:n % 60 + 12]) for n, row in enumerate(self.rows * 5) ])
+    def send_key(self, key):
+        return True
+    send_key.expose = True
+    def dump_rows(self):
+        return self.rows
+    dump_rows.expose = True
+    def captured(self):
+        return self.fields
+    captured.expose = True
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+
+def main():
+    logging.disable(logging.CRITICAL)
+    so = ServerObject(StandInSession())
+    xmlrpc_server = SimpleXMLRPCServer(('127.0.0.1', 0), logRequests=False)
+    xmlrpc_server.register_introspection_functions()
+    xmlrpc_server.register_multicall_functions()
+    xmlrpc_server.register_instance(so)
+    serve(xmlrpc_server)
+    proxies = [('xmlrpc', xmlrpclib.ServerProxy('http://127.0.0.1:%d' % xmlrpc_server.server_address[1]))]
+    socket_path = os.path.join(tempfile.mkdtemp(), 'rpc.sock')
+    for codec in sorted(codecs.keys()):
+        tcp_server = makeFramedServer(so, ('127.0.0.1', 0), codec)
+        serve(tcp_server)
+        proxies.append(('framed %s/tcp' % codec, FramedProxy(tcp_server.server_address, codec)))
+        unix_server = makeFramedServer(so, '%s.%s' % (socket_path, codec), codec)
+        serve(unix_server)
+        proxies.append(('framed %s/unix' % codec, FramedProxy('%s.%s' % (socket_path, codec), codec)))
+    batch = [ {'methodName': 'send_key', 'params': ['DOWN']} ] * 10 + \
+            [ {'methodName': 'dump_rows', 'params': []}, {'methodName': 'captured', 'params': []} ]
+    baselines = {}
+    for name, proxy in proxies:
+        for call, func in [('send_key', lambda: proxy.send_key('DOWN')),
+                           ('dump_rows', lambda: proxy.dump_rows()),
+                           ('captured (120 fields)', lambda: proxy.captured()),
+                           ('system.batch of 12', lambda: proxy.system.batch(batch))]:
+            cost = bestOf(func, number=200)
+            if call not in baselines:
+                baselines[call] = cost
+                report('%s: %s' % (name, call), cost)
+            else:
+                report('%s: %s' % (name, call), baselines[call], cost)
+    for name, proxy in proxies[1:]:
+        proxy.close()
+
+if __name__ == '__main__':
+    main()
+
+# vim: sw=4 ts=4 sts=4 sta et ai
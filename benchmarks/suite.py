@@ -0,0 +1,182 @@
+"""Run a fixed set of benchmarks and record the results as JSON, so that
+runs from different revisions can be compared:
+
+    python -m benchmarks.suite -o before.json
+    ... change things ...
+    python -m benchmarks.suite -o after.json --compare before.json
+
+Pure-CPU microbenchmarks cover state handler name generation, retargeting
+with Retargetable.inherit, ConfigMixIn lookups and state machine steps;
+the end-to-end flows of benchmarks.flows (which need a pty, and include
+a check of the spawn pool) can be left out with --no-flows.
+
+Each result records its value and its unit: times are in microseconds
+(lower is better), rates per second or minute (higher is better), and counts are
+only there for reference. With --compare, any result worse than the baseline by more than
+--threshold (a fraction) is listed as a regression, and the exit status
+is 1 if there are any.
+"""
+
+import configobj
+import logging
+import optparse
+import os
+import platform
+import sys
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from isg.state_machine import possibleStateHandlerNames
+
+from benchmarks import bestOf, report
+from benchmarks import config, dispatch, flows, retarget
+
+FORMAT_VERSION = 1
+
+## units for which a lower value is better; rates are better higher, and counts are not compared
+LOWER_IS_BETTER = ['us']
+
+def revision():
+    """Return the git revision of the tree being benchmarked, if it can be found."""
+    try:
+        pipe = os.popen('cd %s && git rev-parse HEAD 2>/dev/null' % os.path.dirname(os.path.abspath(__file__)))
+        try:
+            return pipe.read().strip() or None
+        finally:
+            pipe.close()
+    except OSError:
+        return None
+
+def slug(name):
+    return name.lower().replace(', ', '.').replace(' ', '_')
+
+def micro(quick=False):
+    """Yield (name, value, unit) for each pure-CPU microbenchmark (times in seconds)."""
+    number = quick and 1000 or 10000
+    yield ('possibleStateHandlerNames',
+           bestOf(lambda: list(possibleStateHandlerNames('FOO__BAR__BAZ')), number=number), 'us')
+    yield ('inherit.switching_family', bestOf(retarget.makeSwitcher(retarget.Machine), number=number) / 3, 'us')
+    yield ('inherit.same_family', bestOf(retarget.makeRepeater(retarget.Machine), number=number), 'us')
+    lookups = config.Config(configobj.ConfigObj(config.CONFIG.splitlines()))
+    for name, args, kwargs in config.LOOKUPS:
+        yield ('config_get.%s' % slug(name.split(' (')[0]),
+               bestOf(lambda: lookups.config_get(*args, **kwargs), number=number * 2), 'us')
+    screens = config.Config(config.makeScreenConfig(500, 50, 50))
+    section = ['screens', 'Screens', 'MENU', 'default']
+    yield ('config_get_items.verify_of_600_keys',
+           bestOf(lambda: list(screens.config_get_items(section, 'verify_')), number=number / 10), 'us')
+    step = bestOf(dispatch.makeRunner(dispatch.Machine), number=quick and 2 or 10) / (dispatch.STEPS * 3)
+    yield ('state_machine.step', step, 'us')
+    yield ('state_machine.steps_per_second', 1 / step, 'per_second')
+
+FLOW_UNITS = [
+    ('screens_per_second', 'per_second'),
+    ('steps_per_second', 'per_second'),
+    ('first_screen', 'us'),
+    ('image_screen_p50', 'us'),
+    ('image_screen_p99', 'us'),
+    ('screens', 'count'),
+    ('fields_captured', 'count'),
+]
+
+def endToEnd(quick=False):
+    """Yield (name, value, unit) for each figure of each flow (times in seconds)."""
+    repeat = quick and 1 or 3
+    for name, pacing in flows.PACINGS:
+        for backend in ['ansi', 'array']:
+            figures = flows.runFlow(pacing, backend, repeat=repeat)
+            for figure, unit in FLOW_UNITS:
+                yield ('flow.%s.%s.%s' % (slug(name), backend, figure), figures[figure], unit)
+    for backend in ['ansi', 'array']:
+        figures = flows.replayFlow(backend, sessions=quick and 10 or 50)
+        yield ('flow.replay.%s.sessions_per_minute' % backend, figures['sessions_per_minute'], 'per_minute')
+        yield ('flow.replay.%s.steps_per_second' % backend, figures['steps_per_second'], 'per_second')
+    figures = flows.poolFlow(sessions=quick and 5 or 10)
+    yield ('flow.spawn_pool.pooled', figures['pooled'], 'count')
+    yield ('flow.spawn_pool.sessions_per_minute', figures['sessions_per_minute'], 'per_minute')
+    yield ('flow.spawn_pool.warm_time', figures['warm_time'], 'us')
+    yield ('flow.spawn_pool.reap_time', figures['reap_time'], 'us')
+
+def run(include_flows=True, quick=False):
+    results = {}
+    benchmarks = [micro(quick)]
+    if include_flows:
+        benchmarks.append(endToEnd(quick))
+    for benchmark in benchmarks:
+        for name, value, unit in benchmark:
+            if unit == 'us':
+                ## measured in seconds
+                report(name, value)
+                value = value * 1e6
+            else:
+                print '%-40s %10.2f %s' % (name, value, unit.replace('_', ' '))
+            results[name] = {'value': value, 'unit': unit}
+    return {
+        'format': FORMAT_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'revision': revision(),
+        'quick': quick,
+        'results': results,
+    }
+
+def compare(baseline, current, threshold=0.1):
+    """Print each result against the baseline; return the names of those worse by more than threshold."""
+    regressions = []
+    names = [ name for name in current['results'].keys() if name in baseline['results'] ]
+    names.sort()
+    for name in names:
+        old = baseline['results'][name]
+        new = current['results'][name]
+        if old['unit'] != new['unit'] or new['unit'] == 'count' or not old['value']:
+            continue
+        change = new['value'] / old['value'] - 1
+        if new['unit'] in LOWER_IS_BETTER:
+            worse = change > threshold
+        else:
+            worse = change < -threshold / (1 + threshold)
+        if worse:
+            regressions.append(name)
+        print '%-50s %12.2f -> %12.2f %-10s %+6.1f%%%s' % (name, old['value'], new['value'], new['unit'], change * 100, worse and '  REGRESSION' or '')
+    return regressions
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-o', '--output', help='write the results as JSON to this file')
+    parser.add_option('--compare', metavar='FILE', help='compare against results previously written with -o')
+    parser.add_option('--threshold', type='float', default=0.1, help='the fraction by which a result may be worse than the baseline before it counts as a regression [%default]')
+    parser.add_option('--no-flows', dest='flows', action='store_false', default=True, help='skip the end-to-end flows, which need a pty')
+    parser.add_option('--quick', action='store_true', default=False, help='fewer repetitions, for a rough result')
+    options, args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    current = run(options.flows, options.quick)
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump(current, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+    if options.compare:
+        f = open(options.compare)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        if baseline.get('format') != FORMAT_VERSION:
+            parser.error('%s is not in a results format this version can compare' % options.compare)
+        print
+        print 'against %s (revision %s):' % (options.compare, baseline.get('revision'))
+        regressions = compare(baseline, current, options.threshold)
+        if regressions:
+            print '%d regression(s)' % len(regressions)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
+
+# vim: sw=4 ts=4 sts=4 sta et ai
@@ -1,7 +1,13 @@
-import re, string, types, new, sha, sys, logging
+import re, string, types, new, sha, sys, logging, weakref, time, threading
 from pprint import pprint
 from sets   import Set
 
+from isg.util.lru import LRUCache
+from isg.util.reactor import Call, Return
+from isg.state_machine import checkpoint
+from isg.state_machine.tracing import TraceBuffer, SET_STATE, PUSH, POP, TRANSITION, RESET
+from isg.state_machine.stats import StateStats
+
 class NonFatalException(Exception):
     """An Exception which doesn't force the state machine to reset"""
 
@@ -9,6 +15,8 @@ stateNameRe = re.compile(r'^(?P<stateName>[A-Z][A-Z0-9_]+)$')
 handlerRe = re.compile(r'^do__(?P<stateName>[A-Z][A-Z0-9_]+(__default)?)?$')
 preHandlerRe = re.compile(r'^pre__(?P<stateName>[A-Z][A-Z0-9_]+(__default)?)?$')
 transitionStateRe = re.compile(r'^transition__([A-Z][A-Z0-9_]+(__default)?)__to__([A-Z][A-Z0-9]+)$')
+dataAttributeRe = re.compile(r'^_[A-Za-z0-9_]+__data$')
+transitionNameRe = re.compile(r'^transition__(?P<source>[A-Z][A-Z0-9_]*?(?:__default)?|default)__to__(?P<dest>[A-Z][A-Z0-9_]+)$')
 
 """An extensible architecture for building state machines.
 
@@ -89,19 +97,127 @@ def isSubstateOf(parentState, subState):
     if subState[:len(parentState)+2] == parentState + '__': return True
     return False
 
+class TransitionGraph(object):
+    """The transition handlers of a single class, compiled into a graph of source -> destination -> handler function.
+
+    Sources are named as in the handler names: 'FOO__BAR' matches only that state, 'FOO__BAR__default' matches it and all its substates, and 'default' matches any state. Lookups are memoized, including lookups which find no route.
+
+    >>> class Helpers(TransitionHelperSet):
+    ...     def transition__default__to__DISCONNECTED(self): pass
+    ...     def transition__MENU__default__to__MENU__MAIN(self): pass
+    >>> graph = TransitionGraph(Helpers)
+    >>> graph.resolve('MENU__REPORTS', 'MENU__MAIN').__name__
+    'transition__MENU__default__to__MENU__MAIN'
+    >>> graph.resolve('LOGIN', 'MENU__MAIN') is None
+    True
+    >>> graph.sourcesReaching('DISCONNECTED')
+    ['default']
+    """
+    def __init__(self, clazz):
+        self.clazz = clazz
+        self.edges = {}                   ## source -> destination -> function
+        self.handlers = {}                ## handler name -> function
+        self.resolved = {}                ## (fromState, toState) -> function or None
+        for name in dir(clazz):
+            match = transitionNameRe.match(name)
+            if match is None:
+                continue
+            handler = getattr(clazz, name)
+            func = getattr(handler, 'im_func', handler)
+            self.handlers[name] = func
+            self.edges.setdefault(match.group('source'), {})[match.group('dest')] = func
+    def resolve(self, fromState, toState):
+        """Return the unbound function handling a transition from fromState to toState, or None if there is none."""
+        key = (fromState, toState)
+        try:
+            return self.resolved[key]
+        except KeyError:
+            pass
+        func = None
+        for name in possibleTransitionHandlerNames(fromState, toState):
+            func = self.handlers.get(name)
+            if func is not None:
+                break
+        self.resolved[key] = func
+        return func
+    def canReach(self, fromState, toState):
+        """Return True if a transition handler exists from fromState to toState."""
+        return self.resolve(fromState, toState) is not None
+    def sourcesReaching(self, toState):
+        """Return (sorted) the sources, in the form described above, which have a transition handler leading to toState."""
+        retval = [ source for source, destinations in self.edges.items()
+                   if toState in destinations ]
+        retval.sort()
+        return retval
+
+class DispatchTable(object):
+    """Resolved state handler lookups for a single class.
+
+    Maps (stateName, handlerType) pairs to the function which handles them (or None if no handler exists), so the candidate names from possibleStateHandlerNames need only be generated and probed once per class. Entries are filled lazily, or ahead of time via precompile(). Transition handlers are looked up through a TransitionGraph, compiled the first time one is needed.
+    """
+    def __init__(self, clazz):
+        self.clazz = clazz
+        self.stateHandlers = {}
+        self.transitions = None
+    def resolveStateHandler(self, stateName, handlerType='do'):
+        """Return the unbound function handling stateName, or None if there is none."""
+        key = (stateName, handlerType)
+        try:
+            return self.stateHandlers[key]
+        except KeyError:
+            pass
+        func = None
+        for name in possibleStateHandlerNames(stateName, handlerType):
+            handler = getattr(self.clazz, name, None)
+            if handler is not None:
+                func = getattr(handler, 'im_func', handler)
+                break
+        self.stateHandlers[key] = func
+        return func
+    def getTransitionGraph(self):
+        if self.transitions is None:
+            self.transitions = TransitionGraph(self.clazz)
+        return self.transitions
+    def resolveTransitionHandler(self, fromState, toState):
+        """Return the unbound function handling a transition from fromState to toState, or None if there is none."""
+        return self.getTransitionGraph().resolve(fromState, toState)
+    def precompile(self, stateNames, handlerTypes=('pre', 'do', 'post')):
+        """Resolve the handlers for each of the given states up front."""
+        for stateName in stateNames:
+            for handlerType in handlerTypes:
+                self.resolveStateHandler(stateName, handlerType)
+        self.getTransitionGraph()
+    def clear(self):
+        """Forget all resolved handlers (for use if the class is modified at runtime)."""
+        self.stateHandlers.clear()
+        self.transitions = None
+
+def getDispatchTable(clazz):
+    """Return the DispatchTable for clazz, creating it if needed.
+
+    Tables are stored on the class itself (never inherited from a base), so they are discarded along with the class.
+    """
+    table = clazz.__dict__.get('_dispatchTable')
+    if table is None:
+        table = DispatchTable(clazz)
+        setattr(clazz, '_dispatchTable', table)
+    return table
+
 def initializeAs(self, clazz, *args, **kwargs):
     assert self.__init__ != self.__old_init__, 'equivalent constructors?!'
     logger = logging.getLogger('SingleInitClass.__init__.initializeAs')
-    logger.info('fake constructor for class %s' % repr(clazz))
+    debug = logger.isEnabledFor(logging.DEBUG)
+    logger.info('fake constructor for class %r', clazz)
     if not hasattr(self, 'initializationSet'):
-        logger.debug('creating a new initializationSet for %s' % repr(self))
+        if debug: logger.debug('creating a new initializationSet for %r', self)
         self.initializationSet = Set()
     if not clazz in self.initializationSet:
-        logger.debug('%s not in %s' % (repr(clazz), repr(self.initializationSet)))
-        logger.debug('initializing %s as %s for first time' % (repr(self), repr(clazz)))
+        if debug:
+            logger.debug('%r not in %r', clazz, self.initializationSet)
+            logger.debug('initializing %r as %r for first time', self, clazz)
         self.initializationSet.add(clazz)
         return clazz.__old_init__(self, *args, **kwargs)
-    logger.debug('%s has been a %s before' % (repr(self), repr(clazz)))
+    if debug: logger.debug('%r has been a %r before', self, clazz)
     return None
 
 class OriginMarkClass(type):
@@ -125,30 +241,78 @@ class SingleInitClass(type):
             setattr(cls, '__init__', (lambda self, *args, **kwargs: self.initializeAs(cls, *args, **kwargs)))
             dict['__old_init__'] = getattr(cls, '__old_init__')
             dict['__init__'] = getattr(cls, '__init__')
-        logger.debug('Initializers for %s are %s (new) and %s (old)' % (repr(cls),
-                                                                        repr(getattr(cls, '__init__')),
-                                                                        repr(getattr(cls, '__old_init__'))))
-        logger.debug('Dictionary for %s is %s' % (repr(cls), repr(dict)))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Initializers for %r are %r (new) and %r (old)', cls,
+                         getattr(cls, '__init__'), getattr(cls, '__old_init__'))
+            logger.debug('Dictionary for %r is %r', cls, dict)
         super(SingleInitClass, cls).__init__(name, bases, dict)
 
 class SingleInitOriginMarkClass(SingleInitClass, OriginMarkClass):
     def __init__(cls, name, bases, dict):
         super(SingleInitOriginMarkClass, cls).__init__(name, bases, dict)
 
+class GeneratedClassCache(object):
+    """Classes generated by Retargetable.inherit, keyed by their tuple of base classes.
+
+    The maxSize most recently used classes are held strongly; older ones are held only for as long as some instance is still using them, so long-running processes do not accumulate classes without bound. The cache is shared by every thread, so the two maps are only touched under a lock.
+    """
+    def __init__(self, maxSize=256):
+        self.recent = LRUCache(maxSize)
+        self.live = weakref.WeakValueDictionary()
+        self.__lock = threading.Lock()
+    def get(self, classes, default=None):
+        self.__lock.acquire()
+        try:
+            clazz = self.recent.get(classes)
+            if clazz is None:
+                clazz = self.live.get(classes)
+                if clazz is None:
+                    return default
+                self.recent[classes] = clazz
+            return clazz
+        finally:
+            self.__lock.release()
+    def __setitem__(self, classes, clazz):
+        self.__lock.acquire()
+        try:
+            self.recent[classes] = clazz
+            self.live[classes] = clazz
+        finally:
+            self.__lock.release()
+    def setdefault(self, classes, clazz):
+        """Store clazz for classes unless another thread got there first; return whichever class is held."""
+        self.__lock.acquire()
+        try:
+            held = self.live.get(classes)
+            if held is None:
+                held = clazz
+                self.live[classes] = clazz
+            self.recent[classes] = held
+            return held
+        finally:
+            self.__lock.release()
+    def __contains__(self, classes):
+        return classes in self.live
+    has_key = __contains__
+    def __len__(self):
+        return len(self.live)
+
 class Retargetable(object):
     """An object which can have its class swapped out to a freshly constructed class inheriting from any defined set of base classes.
 
     Retargetable objects' constructors may not take arguments.
     """
     __metaclass__ = SingleInitOriginMarkClass
-    generatedClasses = {}
+    generatedClasses = GeneratedClassCache()
     def __init__(self):
         super(Retargetable, self).__init__()
         self.__logger = logging.getLogger('StateMachine.Retargetable')
-        self.__logger.debug('Retargetable constructor (initializedAs %s)' % str(self.initializationSet))
+        self.__logger.debug('Retargetable constructor (initializedAs %s)', self.initializationSet)
         self.__firstConstantClasses = []
         self.__constantClasses = []
         self.__initializedClasses = Set()
+        self.__requestedClasses = None    ## requestedClasses tuple behind our current class
+        self.__generatedClass = None      ## the class inherit() last gave us
     def __parseClasslistArg(self, classes):
         """Retrieve a classlist argument (which may be a tuple or list of classes, or a single class). Convert to a tuple listing classes, and assert that all members are indeed classes"""
         if type(classes) is types.TupleType:    pass
@@ -164,38 +328,50 @@ class Retargetable(object):
                 self.__initializedClasses.add(aClass)
                 aClass.__init__(self)
     def inherit(self, requestedClasses):
+        if type(requestedClasses) is not types.TupleType:
+            requestedClasses = self.__parseClasslistArg(requestedClasses)
+        if requestedClasses == self.__requestedClasses and self.__class__ is self.__generatedClass:
+            return
+
         if hasattr(self.__class__, 'originalClass'):
             baseClass = self.__class__.originalClass
         else:
             baseClass = self.__class__
 
-        self.__logger.info('remaking %s (originally %s) to have classes %s' % (repr(self), repr(baseClass), repr(requestedClasses)))
-        requestedClasses = self.__parseClasslistArg(requestedClasses)
+        if self.__logger.isEnabledFor(logging.INFO):
+            self.__logger.info('remaking %r (originally %r) to have classes %r', self, baseClass, requestedClasses)
         classes = tuple(self.__firstConstantClasses) + (baseClass,) + requestedClasses + tuple(self.__constantClasses)
 
+        clazz = Retargetable.generatedClasses.get(classes)
+        if clazz is None:
+            for aClass in classes:
+                assert isinstance(aClass, types.TypeType), 'a non-class objct was provided'
+            if self.__logger.isEnabledFor(logging.DEBUG):
+                self.__logger.debug('  Prepended classes are %r', self.__firstConstantClasses)
+                self.__logger.debug('  Requested classes are %r', requestedClasses)
+                self.__logger.debug('  Appended  classes are %r', self.__constantClasses)
+                self.__logger.debug('  Complete set of classes is %r', classes)
+            ## the name is informational only; classes are keyed on the bases themselves
+            className  = '__GeneratedClass__' + sha.sha(string.join([aClass.__name__ for aClass in classes], '__')).hexdigest()
+            self.__logger.info('New class name is %r', className)
+            clazz = new.classobj(className, classes, {'originalClass':baseClass})
+            clazz = Retargetable.generatedClasses.setdefault(classes, clazz)
+
+        self.__class__ = self.__generatedClass = clazz
+        self.__requestedClasses = requestedClasses
         for aClass in classes:
-            assert isinstance(aClass, types.TypeType), 'a non-class objct was provided'
-        
-        self.__logger.debug('  Prepended classes are %s' % repr(self.__firstConstantClasses))
-        self.__logger.debug('  Requested classes are %s' % repr(requestedClasses))
-        self.__logger.debug('  Appended  classes are %s' % repr(self.__constantClasses))
-        self.__logger.debug('  Complete set of classes is %s' % repr(classes))
-        className  = '__GeneratedClass__' + sha.sha(string.join([clazz.__name__ for clazz in classes], '__')).hexdigest()
-        self.__logger.info('New class name is %s' % repr(className))
-
-        if not Retargetable.generatedClasses.has_key(className):
-            Retargetable.generatedClasses[className] = new.classobj(className,
-                                                                    classes,
-                                                                    {'originalClass':baseClass})
-        
-        self.__class__ = Retargetable.generatedClasses[className]
-        for aClass in classes:
-            self.__initializeIfNeeded(aClass)
+            if not aClass in self.__initializedClasses:
+                self.__initializeIfNeeded(aClass)
+    def getRequestedClasses(self):
+        """Return the tuple of classes last requested of inherit() (empty if none)."""
+        return self.__requestedClasses or ()
     def alwaysInherit(self, classes):
         self.__constantClasses += self.__parseClasslistArg(classes)
+        self.__requestedClasses = None
         self.inherit(())
     def alwaysInheritFirst(self, classes):
         self.__firstConstantClasses += self.__parseClasslistArg(classes)
+        self.__requestedClasses = None
         self.inherit(())
 
 class StateMachineFinished(Exception):
@@ -244,6 +420,9 @@ class StateMachineHandler(Retargetable):
         self.__lastState = None           ## previous (state, data) pair
         self.__state = 'INITIAL_STATE'    ## current state
         self.__stateData = None           ## data specific to this state
+        self.trace = None                 ## TraceBuffer, if tracing is enabled
+        self.stats = None                 ## StateStats, if instrumentation is enabled
+        self.__dispatch = None            ## DispatchTable for our current class
     def haveHandlerForState(self, stateName = None):
         """return True if we have a handler for the specified state (or the current state if no state is specified), False otherwise."""
         try:
@@ -254,15 +433,103 @@ class StateMachineHandler(Retargetable):
     def exitStateMachine(self, *args, **kwargs):
         """Exit the state machine. See the constructor to StateMachineFinished for valid arguments."""
         raise StateMachineFinished(*args, **kwargs)
+    def enableTrace(self, size=4096):
+        """Start recording state changes into a TraceBuffer of the given size (available as self.trace). Returns the buffer."""
+        self.trace = TraceBuffer(size)
+        return self.trace
+    def disableTrace(self):
+        self.trace = None
+    def enableStats(self, stats=None):
+        """Start timing handlers, transitions and screens into stats (a new StateStats by default; available as self.stats). Returns it."""
+        if stats is None:
+            stats = StateStats()
+        self.stats = stats
+        return stats
+    def disableStats(self):
+        self.stats = None
+    def checkpoint(self):
+        """Return a dict recording our position: state and state data, the previous state, the state stack, the classes requested of inherit(), and every dict captured into a __data attribute (e.g. _Screens__data). If we have a checkpointExtra() method, the dict it returns is stored under 'extra'. See isg.state_machine.checkpoint for saving these to disk."""
+        data = {}
+        for name, value in self.__dict__.items():
+            if dataAttributeRe.match(name) and isinstance(value, dict):
+                data[name] = value.copy()
+        checkpoint = {
+            'state': self.__state,
+            'stateData': self.__stateData,
+            'lastState': self.__lastState,
+            'stack': list(self.__oldStateStack),
+            'classes': self.getRequestedClasses(),
+            'data': data,
+        }
+        if hasattr(self, 'checkpointExtra'):
+            checkpoint['extra'] = self.checkpointExtra()
+        return checkpoint
+    def restore(self, checkpoint):
+        """Return to the position recorded by checkpoint(): inherit the classes it lists, and take up its state, previous state, stack and captured data. If we have a restoreExtra() method, it is passed whatever was stored under 'extra'.
+
+        >>> machine = StateMachineHandler()
+        >>> machine.setState('MENU')
+        >>> saved = machine.checkpoint()
+        >>> machine.setState('REPORT')
+        >>> machine.restore(saved)
+        >>> restored = machine.checkpoint()
+        >>> restored['state'], restored['lastState']
+        ('MENU', ('INITIAL_STATE', None))
+        """
+        self.inherit(checkpoint['classes'])
+        for name, value in checkpoint['data'].items():
+            setattr(self, name, value.copy())
+        self.__oldStateStack = list(checkpoint['stack'])
+        self.setState(checkpoint['state'], checkpoint['stateData'])
+        ## setState took the state we were in before restoring as the previous one
+        self.__lastState = checkpoint['lastState']
+        if hasattr(self, 'restoreExtra'):
+            self.restoreExtra(checkpoint.get('extra'))
+    def saveCheckpoint(self, filename):
+        """Write checkpoint() to filename, atomically"""
+        checkpoint.save(self.checkpoint(), filename)
+    def loadCheckpoint(self, filename):
+        """Restore a checkpoint written by saveCheckpoint"""
+        self.restore(checkpoint.load(filename))
     def getStateHandler(self, stateName = None, handlerType='do', allowFail=False):
         """Return the state handler method for the given state (or current state if none is provided). Raise a KeyError if a nonexistant state is attempted."""
         if stateName == None: stateName = self.__state
-        for name in possibleStateHandlerNames(stateName, handlerType):
-            if hasattr(self, name):
-                return getattr(self, name)
+        func = self.getDispatchTable().resolveStateHandler(stateName, handlerType)
+        if func is not None:
+            return new.instancemethod(func, self, self.__class__)
         if not allowFail:
             raise KeyError('No handler for %s found' % repr(stateName))
         return nullHandler
+    def getDispatchTable(self):
+        """Return the DispatchTable for our current class. The table is dropped and refetched whenever inherit() has swapped out our class."""
+        dispatch = self.__dispatch
+        if dispatch is None or dispatch.clazz is not self.__class__:
+            dispatch = self.__dispatch = getDispatchTable(self.__class__)
+        return dispatch
+    def getHandledStateNames(self):
+        """Return the set of states named by our do__ handlers (a handler for FOO__default counting as one for FOO)."""
+        stateNames = Set()
+        if not isinstance(self, HandlerSet):
+            return stateNames
+        for stateName in self.getStateNames():
+            if stateName is None:
+                continue
+            if stateName.endswith('__default'):
+                stateName = stateName[:-len('__default')]
+            stateNames.add(stateName)
+        return stateNames
+    def precompileDispatch(self):
+        """Resolve pre-, primary and post-handlers for every state we have a handler for, rather than waiting for each to be looked up."""
+        self.getDispatchTable().precompile(self.getHandledStateNames())
+    def statesUnableToReach(self, newState, states=None):
+        """Return (sorted) those of the given states (by default, every handled state) which have no transition handler leading to newState. This allows a machine to be validated without being run."""
+        if states is None:
+            states = self.getHandledStateNames()
+        graph = self.getDispatchTable().getTransitionGraph()
+        retval = [ state for state in states
+                   if state != newState and not graph.canReach(state, newState) ]
+        retval.sort()
+        return retval
     def getTransitionHandler(self, stateOne, stateTwo = None):
         """Return the transition handler method for the given states (or, if only one state is provided, between the current state and the provided one). Raise a KeyError if no appropriate TransitionHandler exists."""
         if stateTwo is None: oldState, newState = (self.__state, stateOne)
@@ -270,26 +537,65 @@ class StateMachineHandler(Retargetable):
 
         assert oldState != newState, 'searching for null handler'
         
-        for name in possibleTransitionHandlerNames(oldState, newState):
-            if hasattr(self, name):
-                return getattr(self, name)
+        func = self.getDispatchTable().resolveTransitionHandler(oldState, newState)
+        if func is not None:
+            return new.instancemethod(func, self, self.__class__)
         raise KeyError('No handler for %s -> %s found' % (repr(oldState), repr(newState)))
     def transitionTo(self, newState, exact = False, *args, **kwargs):
         """Transition to the provided state; pass any extra arguments provided here on to the transition handler. If exact is true, allow only the target or a substate thereof; otherwise, any handled state is fair game"""
         oldState = self.__state
         if oldState == newState: return
+        handler = self.__beginTransition(newState, exact, args, kwargs)
+        stats = self.stats
+        if stats is None:
+            retval = handler(*args, **kwargs)
+        else:
+            start = time.time()
+            try:
+                retval = handler(*args, **kwargs)
+            finally:
+                stats.transition(oldState, newState, time.time() - start)
+        self.__checkTransition(oldState, newState, exact)
+        return retval
+    def asyncTransitionTo(self, newState, exact = False, *args, **kwargs):
+        """A coroutine (see isg.util.reactor) equivalent to transitionTo(). The transition handler may itself be a coroutine."""
+        oldState = self.__state
+        if oldState == newState: return
+        handler = self.__beginTransition(newState, exact, args, kwargs)
+        start = time.time()
+        try:
+            retval = handler(*args, **kwargs)
+            if isinstance(retval, types.GeneratorType):
+                call = Call(retval)
+                yield call
+                retval = call.result()
+        except:
+            if self.stats is not None:
+                self.stats.transition(oldState, newState, time.time() - start)
+            raise
+        if self.stats is not None:
+            self.stats.transition(oldState, newState, time.time() - start)
+        self.__checkTransition(oldState, newState, exact)
+        yield Return(retval)
+    def __beginTransition(self, newState, exact, args, kwargs):
         handler = self.getTransitionHandler(newState)
-        self.__logger.info('transitionTo(newState=%s, exact=%s, *args=%s, **args=%s) current=%s stack=%s: %s' % (repr(newState), repr(exact), repr(args), repr(kwargs), repr(oldState), repr(self.__oldStateStack), handler.__name__))
-        retval = handler(*args, **kwargs)
+        if self.__logger.isEnabledFor(logging.INFO):
+            self.__logger.info('transitionTo(newState=%r, exact=%r, *args=%r, **args=%r) current=%r stack=%r: %s', newState, exact, args, kwargs, self.__state, self.__oldStateStack, handler.__name__)
+        if self.trace is not None:
+            self.trace.record(TRANSITION, newState, self.__state, len(self.__oldStateStack))
+        return handler
+    def __checkTransition(self, oldState, newState, exact):
         assert self.__state != oldState, 'transition failed! (still in original state %s)' % oldState
         if exact:
-        assert isSubstateOf(newState, self.__state), 'transition failed! (wanted %s, landed in %s)' % (newState, self.__state)
+            assert isSubstateOf(newState, self.__state), 'transition failed! (wanted %s, landed in %s)' % (newState, self.__state)
         else:
-        assert isSubstateOf(newState, self.__state) or self.haveHandlerForState(), 'transition failed! (wanted %s, landed in %s with no handler)' % (newState, self.__state)
-        return retval
+            assert isSubstateOf(newState, self.__state) or self.haveHandlerForState(), 'transition failed! (wanted %s, landed in %s with no handler)' % (newState, self.__state)
     def push(self, state, stateData = None):
         """Push our current state onto the stack, and replace it with the state provided"""
-        self.__logger.info('push(state=%s, stateData=%s) oldState=%s stack=%s' % (repr(state), repr(stateData), repr(self.__state), repr(self.__oldStateStack)))
+        if self.__logger.isEnabledFor(logging.INFO):
+            self.__logger.info('push(state=%r, stateData=%r) oldState=%r stack=%r', state, stateData, self.__state, self.__oldStateStack)
+        if self.trace is not None:
+            self.trace.record(PUSH, state, self.__state, len(self.__oldStateStack) + 1)
         self.__oldStateStack.append((self.__state, self.__stateData))
         self.__state = state
         self.__stateData = stateData
@@ -297,16 +603,24 @@ class StateMachineHandler(Retargetable):
         """Discard our current state in favor of the first state on the stack."""
         self.__lastState = (self.__state, self.__stateData)
         self.__state, self.__stateData = self.__oldStateStack.pop()
-        self.__logger.info('pop() -> (state=%s, stateData=%s) stack=%s' % (repr(self.__state), repr(self.__stateData), repr(self.__oldStateStack)))
+        if self.__logger.isEnabledFor(logging.INFO):
+            self.__logger.info('pop() -> (state=%r, stateData=%r) stack=%r', self.__state, self.__stateData, self.__oldStateStack)
+        if self.trace is not None:
+            self.trace.record(POP, self.__state, self.__lastState[0], len(self.__oldStateStack))
     def setState(self, state, stateData = None):
         """Make the current state that which is provided. Clears stateData or replaces it with a new value, as appropriate."""
-        self.__logger.info('setState(state=%s, stateData=%s)' % (repr(state), repr(stateData)))
+        if self.__logger.isEnabledFor(logging.INFO):
+            self.__logger.info('setState(state=%r, stateData=%r)', state, stateData)
+        if self.trace is not None:
+            self.trace.record(SET_STATE, state, self.__state, len(self.__oldStateStack))
         self.__lastState = (self.__state, self.__stateData)
         self.__state = state
         self.__stateData = stateData
     def resetStack(self):
         """Clear the old state stack."""
         self.__oldStateStack = []
+        if self.trace is not None:
+            self.trace.record(RESET, self.__state)
     def peek(self):
         """Peek at the state in the top of the oldStateStack"""
         try:
@@ -324,9 +638,38 @@ class StateMachineHandler(Retargetable):
         else:
             raise AssertionError, 'unrecognized return value'
         return True
-    def __run_handler(self, *args, **kwargs):
-        self.__current_handler = self.getStateHandler(*args, **kwargs)
-        self.handleRetval(self.__current_handler())
+    def __run_handler(self, stateName=None, handlerType='do', allowFail=False):
+        self.__current_handler = self.getStateHandler(stateName, handlerType, allowFail)
+        stats = self.stats
+        if stats is None or self.__current_handler is nullHandler:
+            self.handleRetval(self.__current_handler())
+        else:
+            state = stateName or self.__state
+            start = time.time()
+            try:
+                retval = self.__current_handler()
+            finally:
+                stats.handler(state, handlerType, time.time() - start)
+            self.handleRetval(retval)
+        self.__current_handler = None
+    def __record_handler(self, state, handlerType, start):
+        if self.stats is not None and self.__current_handler is not nullHandler:
+            self.stats.handler(state, handlerType, time.time() - start)
+    def __async_run_handler(self, stateName=None, handlerType='do', allowFail=False):
+        self.__current_handler = self.getStateHandler(stateName, handlerType, allowFail)
+        state = stateName or self.__state
+        start = time.time()
+        try:
+            retval = self.__current_handler()
+            if isinstance(retval, types.GeneratorType):
+                call = Call(retval)
+                yield call
+                retval = call.result()
+        except:
+            self.__record_handler(state, handlerType, start)
+            raise
+        self.__record_handler(state, handlerType, start)
+        self.handleRetval(retval)
         self.__current_handler = None
     def run(self):
         """Run the state machine. Starts with the current state, and continues until an exception is thrown. This may be a StateMachineFinished exception (in which case a graceful exit occurs), or a different exception (in which case the current state is set to INVALID before the exeception is rethrown).
@@ -354,6 +697,34 @@ class StateMachineHandler(Retargetable):
             self.setState('INVALID')
             raise
 
+    def asyncRun(self):
+        """A coroutine (see isg.util.reactor) equivalent to run(), so that many machines can be run from one thread by a Reactor. Its result is what run() would have returned.
+
+        Handlers are looked up exactly as run() looks them up. A handler which is itself a coroutine (a generator method) is run to completion, and whatever it yields in a Return is handled as a plain handler's return value would be; plain handlers are simply called, and so block every other machine on the reactor until they return."""
+        try:
+            while True:
+                try:
+                    currState = self.__state
+
+                    for kwargs in ({'handlerType': 'pre', 'allowFail': True},
+                                   {'allowFail': False},
+                                   {'stateName': currState, 'handlerType': 'post', 'allowFail': True}):
+                        call = Call(self.__async_run_handler(**kwargs))
+                        yield call
+                        call.result()
+                except NonFatalException, e:
+                    self.__logger.error('Non-fatal exception follows:')
+                    self.__logger.exception(e)
+                    self.setState('%s__UNKNOWN' % self.__state, e)
+        except StateMachineFinished, e:
+            if e.newState is not None:
+                self.setState(e.newState, e.newStateData)
+            yield Return(e.retval)
+        except:
+            self.resetStack()
+            self.setState('INVALID')
+            raise
+
 def _test():
     import doctest, StateMachine
     return doctest.testmod(StateMachine)
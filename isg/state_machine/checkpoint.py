@@ -0,0 +1,68 @@
+"""On-disk checkpoints of state machine position.
+
+A checkpoint is the dict returned by StateMachineHandler.checkpoint();
+dumps() packs it as a short header followed by a zlib-compressed pickle,
+and save() writes that atomically (to a temporary file, renamed into
+place) so a crash mid-write never leaves a truncated checkpoint behind.
+
+Classes (those requested of inherit()) are pickled by reference, so
+must be importable, under the same names, by the process resuming.
+Checkpoints are pickles: load only those you wrote yourself.
+
+>>> loads(dumps({'state': 'MENU', 'stack': [('LOGIN', None)]}))['stack']
+[('LOGIN', None)]
+"""
+
+import cPickle
+import os
+import zlib
+
+__all__ = ['dumps', 'loads', 'save', 'load', 'CheckpointError']
+
+MAGIC = 'ISGCKPT'
+FORMAT_VERSION = 1
+
+class CheckpointError(Exception): """The data is not a checkpoint this version can read"""
+
+def dumps(checkpoint):
+    return MAGIC + chr(FORMAT_VERSION) + zlib.compress(cPickle.dumps(checkpoint, cPickle.HIGHEST_PROTOCOL))
+
+def loads(data):
+    if not data.startswith(MAGIC) or len(data) <= len(MAGIC):
+        raise CheckpointError('not a checkpoint')
+    version = ord(data[len(MAGIC)])
+    if version != FORMAT_VERSION:
+        raise CheckpointError('checkpoint format %d is not supported (expected %d)' % (version, FORMAT_VERSION))
+    try:
+        return cPickle.loads(zlib.decompress(data[len(MAGIC) + 1:]))
+    except (zlib.error, cPickle.UnpicklingError, EOFError), e:
+        raise CheckpointError('corrupt checkpoint: %s' % e)
+
+def save(checkpoint, filename):
+    data = dumps(checkpoint)
+    tmpname = '%s.%d.tmp' % (filename, os.getpid())
+    f = open(tmpname, 'wb')
+    try:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(tmpname, filename)
+
+def load(filename):
+    f = open(filename, 'rb')
+    try:
+        return loads(f.read())
+    finally:
+        f.close()
+
+def _test():
+    import doctest
+    from isg.state_machine import checkpoint
+    return doctest.testmod(checkpoint)
+
+if __name__ == '__main__':
+    _test()
+
+# vim: sw=4 ts=4 sts=4 sta et ai
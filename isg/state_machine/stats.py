@@ -0,0 +1,189 @@
+"""Counters and latency histograms of state machine activity.
+
+A StateStats is attached to a StateMachineHandler by enableStats(); while
+one is attached, run() and asyncRun() time each pre-, primary and
+post-handler, transitionTo() times each transition handler, and
+BaseConnection.image_screen() records, per screen, the time spent
+settling and verifying and the bytes read. With none attached (the
+default) each of these costs one attribute test.
+
+Latencies are counted into power-of-two buckets of microseconds, so
+recording one is a few arithmetic operations and a histogram is a fixed
+32 counters however long the session runs. Percentiles are estimated
+from the buckets (each is reported as the top of the bucket it falls in,
+capped at the largest value seen).
+
+Anything implementing handler(), transition(), screen() and count() may
+be passed to enableStats() in place of a StateStats, e.g. to forward
+measurements elsewhere.
+
+>>> stats = StateStats()
+>>> for seconds in [0.001, 0.002, 0.003, 0.5]:
+...     stats.handler('MENU', 'do', seconds)
+>>> stats.count('bytes_read', 2000)
+>>> snapshot = stats.snapshot()
+>>> latency = snapshot['latencies']['handler.MENU.do']
+>>> latency['count'], latency['max'], latency['p50'] < 0.005
+(4, 0.5, True)
+>>> snapshot['counters']
+{'bytes_read': 2000}
+"""
+
+import array
+import logging
+import math
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+__all__ = ['Histogram', 'StateStats', 'logDump', 'fileDump']
+
+BUCKETS = 32                              ## the last holds everything over ~35 minutes
+MAXINT = 2 ** 31 - 1                      ## the largest integer XML-RPC can carry
+
+def _marshallable(value):
+    if isinstance(value, (int, long)) and value > MAXINT:
+        return float(value)
+    return value
+
+class Histogram(object):
+    """Latencies (in seconds) counted into power-of-two buckets of microseconds: bucket n holds those under 2**n us."""
+    def __init__(self):
+        self.buckets = array.array('L', [0]) * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+    def add(self, seconds):
+        bucket = math.frexp(seconds * 1e6)[1]
+        if bucket < 0:
+            bucket = 0
+        elif bucket >= BUCKETS:
+            bucket = BUCKETS - 1
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+    def percentile(self, fraction):
+        """Estimate the latency below which the given fraction of those recorded fall."""
+        if not self.count:
+            return None
+        wanted = fraction * self.count
+        seen = 0
+        for bucket in range(BUCKETS):
+            seen += self.buckets[bucket]
+            if seen >= wanted:
+                return min((2 ** bucket) / 1e6, self.max)
+        return self.max
+    def snapshot(self):
+        retval = {'count': _marshallable(self.count), 'total': self.total}
+        if self.count:
+            retval.update({
+                'min': self.min,
+                'max': self.max,
+                'mean': self.total / self.count,
+                'p50': self.percentile(0.5),
+                'p90': self.percentile(0.9),
+                'p99': self.percentile(0.99),
+            })
+        return retval
+
+class StateStats(object):
+    """Per-state, per-transition and per-screen counters and latency histograms, keyed by dotted names:
+
+        handler.<state>.<pre|do|post>           time in each handler
+        transition.<from state>.<to state>      time in each transition handler
+        screen.<class>.<state>.<substate>.settle   time waiting for the screen to settle
+        screen.<class>.<state>.<substate>.verify   time waiting for its verify_ clauses
+        screen.<class>.<state>.<substate>.bytes    bytes read while imaging it (a counter)
+
+    along with counters of screen cache hits and verify timeouts per screen.
+
+    If dump_interval is set, dump is called with a snapshot() at most once every dump_interval seconds, as handlers are timed.
+    """
+    def __init__(self, dump_interval=0, dump=None):
+        self.dump_interval = dump_interval
+        self.dump = dump or logDump
+        self.clear()
+    def clear(self):
+        self.since = time.time()
+        self.next_dump = self.since + self.dump_interval
+        self.latencies = {}
+        self.counters = {}
+    def latency(self, name, seconds):
+        try:
+            histogram = self.latencies[name]
+        except KeyError:
+            histogram = self.latencies[name] = Histogram()
+        histogram.add(seconds)
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+    def handler(self, state, handlerType, seconds):
+        self.latency('handler.%s.%s' % (state, handlerType), seconds)
+        if self.dump_interval and time.time() >= self.next_dump:
+            self.dumpNow()
+    def transition(self, oldState, newState, seconds):
+        self.latency('transition.%s.%s' % (oldState, newState), seconds)
+    def screen(self, path, settle_time=None, verify_time=None, bytes_read=0, cache_hit=False, verify_timeout=False):
+        """Record the imaging of the screen at path, a (class name, state, substate) tuple."""
+        prefix = 'screen.%s.%s.%s' % path
+        if settle_time is not None:
+            self.latency(prefix + '.settle', settle_time)
+        if verify_time is not None:
+            self.latency(prefix + '.verify', verify_time)
+        if bytes_read:
+            self.count(prefix + '.bytes', bytes_read)
+        if cache_hit:
+            self.count(prefix + '.cache_hits')
+        if verify_timeout:
+            self.count(prefix + '.verify_timeouts')
+    def snapshot(self):
+        """Return everything recorded, as a dict fit to be passed over XML-RPC."""
+        latencies = {}
+        for name, histogram in self.latencies.items():
+            latencies[name] = histogram.snapshot()
+        counters = {}
+        for name, value in self.counters.items():
+            counters[name] = _marshallable(value)
+        return {
+            'since': self.since,
+            'time': time.time(),
+            'latencies': latencies,
+            'counters': counters,
+        }
+    def dumpNow(self):
+        self.next_dump = time.time() + self.dump_interval
+        try:
+            self.dump(self.snapshot())
+        except Exception, e:
+            logging.getLogger('StateMachine.stats').exception(e)
+
+def logDump(snapshot):
+    """Log a snapshot, as one line of JSON, to the StateMachine.stats logger"""
+    logging.getLogger('StateMachine.stats').info('%s', json.dumps(snapshot, sort_keys=True))
+
+def fileDump(filename):
+    """Return a dump function appending each snapshot, as one line of JSON, to filename"""
+    def dump(snapshot):
+        f = open(filename, 'a')
+        try:
+            f.write(json.dumps(snapshot, sort_keys=True) + '\n')
+        finally:
+            f.close()
+    return dump
+
+def _test():
+    import doctest
+    from isg.state_machine import stats
+    return doctest.testmod(stats)
+
+if __name__ == '__main__':
+    _test()
+
+# vim: sw=4 ts=4 sts=4 sta et ai
@@ -0,0 +1,77 @@
+"""A compact binary trace of state machine activity.
+
+A TraceBuffer records state changes into a fixed-size ring of typed arrays
+(15 bytes per record) rather than formatting log text, so tracing can be
+left on in production and the recent history read back after the fact.
+
+>>> trace = TraceBuffer(size=2)
+>>> trace.record(SET_STATE, 'CONNECTING', 'DISCONNECTED', 0)
+>>> trace.record(PUSH, 'LOGIN', 'CONNECTING', 1)
+>>> trace.record(POP, 'CONNECTING', 'LOGIN', 0)
+>>> [ record[1:] for record in trace.records() ]
+[('push', 'LOGIN', 'CONNECTING', 1), ('pop', 'CONNECTING', 'LOGIN', 0)]
+"""
+
+import array
+import time
+
+__all__ = [
+    'TraceBuffer',
+    'SET_STATE', 'PUSH', 'POP', 'TRANSITION', 'RESET',
+]
+
+SET_STATE, PUSH, POP, TRANSITION, RESET = range(5)
+eventNames = ['setState', 'push', 'pop', 'transition', 'reset']
+
+MAX_STATE_ID = 0xffff
+
+class TraceBuffer(object):
+    """A ring buffer of (time, event, state, previous state, stack depth) records.
+
+    State names are interned to 16-bit ids; should more than 65535 distinct names be seen, the remainder are all recorded as None.
+    """
+    def __init__(self, size=4096):
+        self.size = size
+        self.times = array.array('d', [0.0]) * size
+        self.events = array.array('B', [0]) * size
+        self.states = array.array('H', [0]) * size
+        self.previous = array.array('H', [0]) * size
+        self.depths = array.array('H', [0]) * size
+        self.count = 0                    ## total records ever written
+        self.stateIds = {None: 0}
+        self.stateNames = [None]
+    def stateId(self, state):
+        try:
+            return self.stateIds[state]
+        except KeyError:
+            if len(self.stateNames) >= MAX_STATE_ID:
+                return MAX_STATE_ID
+            stateId = self.stateIds[state] = len(self.stateNames)
+            self.stateNames.append(state)
+            return stateId
+    def record(self, event, state, previous=None, depth=0):
+        n = self.count % self.size
+        self.times[n] = time.time()
+        self.events[n] = event
+        self.states[n] = self.stateId(state)
+        self.previous[n] = self.stateId(previous)
+        self.depths[n] = min(depth, 0xffff)
+        self.count += 1
+    def stateName(self, stateId):
+        if stateId >= len(self.stateNames):
+            return None
+        return self.stateNames[stateId]
+    def records(self):
+        """A generator yielding the buffered records, oldest first, as (time, event name, state, previous state, depth) tuples."""
+        start = max(0, self.count - self.size)
+        for i in xrange(start, self.count):
+            n = i % self.size
+            yield (self.times[n],
+                   eventNames[self.events[n]],
+                   self.stateName(self.states[n]),
+                   self.stateName(self.previous[n]),
+                   self.depths[n])
+    def clear(self):
+        self.count = 0
+
+# vim: sw=4 ts=4 sts=4 sta et ai
@@ -1,7 +1,12 @@
 ## TODO: "os" should not be special; its functionality should be generalized.
 
+import bisect
+import cStringIO
+import logging
+import os
 import re
-import types
+import sys
+import threading
 
 import configobj
 
@@ -10,9 +15,16 @@ __all__ = [
     'UNDEFINED',
     'BadOptionFormat',
     'update_from_argument_list',
+    'reparse',
+    'clone',
+    'ConfigWatcher',
+    'integer_sort_order',
 ]
 
 UNDEFINED = object()
+MISSING = object()                        ## memoized in place of an absent item
+INDEX = object()                          ## marks key indexes in the config_get cache
+ITEMS = object()                          ## marks config_get_items results in the config_get cache
 
 ### Config option parsing
 
@@ -46,11 +58,26 @@ class ConfigMixIn(object):
         if subtree is None: return False
         return item in subtree
     def config_get(self, section, item, default=UNDEFINED, decode=False, isBoolean=False, isInteger=False, isFloat=False):
-        subtree = self.config_get_section(section)
-        if subtree is None or not item in subtree:
-            if default != UNDEFINED:
+        """Return the value of item in section (a section name, or list of nested section names), decoded or converted as requested. Lookups are memoized; see config_invalidate."""
+        if isinstance(section, list):
+            path = '.'.join(section)
+        else:
+            path = section
+        key = (path, item, decode, isBoolean, isInteger, isFloat)
+        cache = self.config_cache()
+        try:
+            value = cache[key]
+        except KeyError:
+            value = cache[key] = self._config_get(section, item, decode, isBoolean, isInteger, isFloat)
+        if value is MISSING:
+            if default is not UNDEFINED:
                 return default
             raise KeyError((section, item))
+        return value
+    def _config_get(self, section, item, decode, isBoolean, isInteger, isFloat):
+        subtree = self.config_get_section(section)
+        if subtree is None or not item in subtree:
+            return MISSING
         if decode:
             return subtree[item].decode('string_escape')
         if isFloat:
@@ -60,47 +87,210 @@ class ConfigMixIn(object):
         if isBoolean:
             return subtree.as_bool(item)
         return subtree[item]
+    def config_cache(self):
+        """Return the dict memoizing config_get lookups. It is kept on the config object itself, so that every user of the same config shares it."""
+        try:
+            return self.config._config_get_cache
+        except AttributeError:
+            cache = self.config._config_get_cache = {}
+            return cache
+    def config_invalidate(self):
+        """Discard memoized config_get lookups. This is done for you by config_update_from_argument_list; anything else changing the config tree must call it."""
+        self.config._config_get_cache = {}
     def config_update_from_argument_list(self, argument_list):
         """Intended for use in parsing command line options"""
-        for arg in argument_list:
-            match = argMatchRe.match(arg)
-            if not match:
-                raise BadOptionFormat(arg)
-            section, option, value = match.groups()
-            subtree = self.config
-            for subsection in section.split('.'):
-                if not subtree.has_key(subsection):
-                    subtree[subsection] = configobj.Section(
-                        subtree, subtree.depth+1, self.config)
-                subtree = subtree[subsection]
-            subtree[option] = value
+        update_from_argument_list(self.config, argument_list)
+        self.config_invalidate()
+    def config_reload(self, config=None):
+        """Swap in a new config: the given ConfigObj, or else our config's file parsed afresh (see reparse). Then call config_reloaded() so that anything derived from the config can be rebuilt; should that raise, the old config is put back, and config_reloaded() called again to rebuild from it whatever was already rebuilt from the new one, before the exception is passed on."""
+        if config is None:
+            config = reparse(self.config)
+        old_config = self.config
+        self.config = config
+        try:
+            self.config_reloaded()
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            self.config = old_config
+            try:
+                self.config_reloaded()
+            except Exception, e:
+                logger = logging.getLogger('ConfigMixIn')
+                logger.error('Unable to rebuild from the config put back after a failed reload')
+                logger.exception(e)
+            raise exc_type, exc_value, exc_traceback
+    def config_reloaded(self):
+        """Called by config_reload once a new config is in place. Override this to rebuild anything derived from the config; raise to refuse the new config."""
+        pass
     def config_get_items(self, section, prefix, sort=None, **kwargs):
-        if not sort:
-            for key, value in self._config_get_items(section, prefix, **kwargs):
-                yield key, value
-            return
-        d = {}
-        for key, value in self._config_get_items(section, prefix, **kwargs):
-            d[key] = value
-        keys = d.keys()
-        if isinstance(sort, types.FunctionType):
-            keys.sort(sort)
-        else:
-            keys.sort()
-        for key, value in d.items():
+        """Yield the (key, value) pairs of section whose keys start with prefix (with the prefix removed from each key if strip_prefix is true).
+
+        Pairs come in the order the keys appear in the config unless sort is given: sort may be a cmp function over the (possibly stripped) keys, such as integer_sort_order, or any other true value for lexical order. Keys are found through a sorted index of the section, and results are memoized, until config_invalidate."""
+        items = self._config_get_items(section, prefix, **kwargs)
+        if sort:
+            items = items[:]
+            if callable(sort):
+                items.sort(lambda a, b: sort(a[0], b[0]))
+            else:
+                items.sort()
+        for key, value in items:
             yield key, value
-    def _config_get_items(self, section, prefix, strip_prefix=False):
+    def config_key_index(self, section):
+        """Return a sorted list of (key, position) pairs for the items of section, position being the key's place in the config; or None if there is no such section. The index is kept until config_invalidate."""
+        if isinstance(section, list):
+            path = '.'.join(section)
+        else:
+            path = section
+        cache = self.config_cache()
+        key = (INDEX, path)
+        try:
+            return cache[key]
+        except KeyError:
+            pass
         subtree = self.config_get_section(section)
-        if subtree is None: return
-        for key in subtree.keys():
-            if not key[:len(prefix)] == prefix:
-                continue
-            value = subtree[key]
-            if strip_prefix:
-                key = key[len(prefix):]
-            yield key, value
+        if subtree is None:
+            index = None
+        else:
+            index = [ (key_name, position) for position, key_name in enumerate(subtree.keys()) ]
+            index.sort()
+        cache[key] = index
+        return index
+    def _config_get_items(self, section, prefix, strip_prefix=False):
+        if isinstance(section, list):
+            path = '.'.join(section)
+        else:
+            path = section
+        cache = self.config_cache()
+        key = (ITEMS, path, prefix, strip_prefix)
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+        items = []
+        index = self.config_key_index(section)
+        if index is not None:
+            subtree = self.config_get_section(section)
+            matches = []
+            for n in xrange(bisect.bisect_left(index, (prefix,)), len(index)):
+                key_name, position = index[n]
+                if not key_name.startswith(prefix):
+                    break
+                matches.append((position, key_name))
+            matches.sort()
+            for position, key_name in matches:
+                value = subtree[key_name]
+                if strip_prefix:
+                    key_name = key_name[len(prefix):]
+                items.append((key_name, value))
+        cache[key] = items
+        return items
+
+def update_from_argument_list(config, argument_list):
+    """Apply section.option=value arguments to config, and remember them so that reparse() can apply them again."""
+    for arg in argument_list:
+        match = argMatchRe.match(arg)
+        if not match:
+            raise BadOptionFormat(arg)
+        section, option, value = match.groups()
+        subtree = config
+        for subsection in section.split('.'):
+            if not subtree.has_key(subsection):
+                subtree[subsection] = configobj.Section(
+                    subtree, subtree.depth+1, config)
+            subtree = subtree[subsection]
+        subtree[option] = value
+    if not hasattr(config, '_config_arguments'):
+        config._config_arguments = []
+    config._config_arguments.extend(argument_list)
+
+## ConfigObj options carried over by reparse
+reparse_options = ('encoding', 'default_encoding', 'interpolation', 'list_values', 'unrepr', 'write_empty_values', 'indent_type')
+
+## ConfigObj.write turns interpolation off while it writes, so a config
+## shared between threads is only written, or its options read, under this
+_write_lock = threading.Lock()
+
+def _parse_options(config):
+    options = {}
+    for name in reparse_options:
+        if hasattr(config, name):
+            options[name] = getattr(config, name)
+    return options
+
+def reparse(config):
+    """Return a new ConfigObj parsed from config's file, with the same options, and with any arguments applied to config by update_from_argument_list applied again."""
+    if not config.filename:
+        raise ValueError('config was not read from a file, so cannot be reparsed')
+    _write_lock.acquire()
+    try:
+        options = _parse_options(config)
+    finally:
+        _write_lock.release()
+    new_config = configobj.ConfigObj(config.filename, **options)
+    update_from_argument_list(new_config, getattr(config, '_config_arguments', []))
+    return new_config
+
+def clone(config):
+    """Return an independent copy of config, parsed with the same options. Values are copied as written, so interpolate against the copy: setting [Connect] host in a clone changes the spawnString made from it there alone. The copy has no filename."""
+    text = cStringIO.StringIO()
+    _write_lock.acquire()
+    try:
+        config.write(text)
+        options = _parse_options(config)
+    finally:
+        _write_lock.release()
+    return configobj.ConfigObj(text.getvalue().splitlines(), **options)
+
+class ConfigWatcher(object):
+    """Polls a config file every interval seconds, calling callback() whenever its modification time or size changes. Exceptions from callback are logged, and the watch goes on."""
+    def __init__(self, filename, callback, interval=2.0):
+        self.filename = filename
+        self.callback = callback
+        self.interval = interval
+        self.__logger = logging.getLogger('ConfigWatcher')
+        self.__signature = self.signature()
+        self.__stopped = threading.Event()
+    def signature(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+    def check(self):
+        """Call callback() if the file has changed since it was last checked; returns True if it had."""
+        signature = self.signature()
+        if signature is None or signature == self.__signature:
+            return False
+        self.__signature = signature
+        self.__logger.info('%s changed; reloading', self.filename)
+        try:
+            self.callback()
+        except Exception, e:
+            self.__logger.error('Unable to reload %s', self.filename)
+            self.__logger.exception(e)
+        return True
+    def start(self):
+        """Start checking from a daemon thread; returns the thread."""
+        def watch():
+            while not self.__stopped.isSet():
+                self.__stopped.wait(self.interval)
+                if not self.__stopped.isSet():
+                    self.check()
+        thread = threading.Thread(target=watch, name='ConfigWatcher %s' % self.filename)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+    def stop(self):
+        self.__stopped.set()
 
 def integer_sort_order(a, b):
-    return cmp(int(a), int(b))
+    """A cmp function putting keys which are integers first, in numeric order, and any others after them, in lexical order."""
+    return cmp(_integer_sort_key(a), _integer_sort_key(b))
+
+def _integer_sort_key(key):
+    try:
+        return (0, int(key), key)
+    except ValueError:
+        return (1, 0, key)
 
 # vim: sw=4 ts=4 sts=4 sta et ai
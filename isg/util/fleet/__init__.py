@@ -0,0 +1,313 @@
+"""Runs the same state machine flow against many hosts at once.
+
+run_fleet() shares a list of hosts out among worker processes (as many
+as there are cores, by default), each running several sessions at a time
+in threads of its own. Each host's session gets its own copy of a config
+template, with [Connect] host set to the host, so a template whose
+spawnString refers to %(host)s reaches each host in turn. A host may
+instead be given as a dict of [Connect] options.
+
+Results are yielded as FleetResults as each session finishes, in order
+of completion; the retval of a successful one is what run() returned
+(that given to StateMachineFinished). At most max_pending hosts are
+handed out ahead of the results taken, so a host list may be a generator
+of any length, and a slow consumer of results holds back the work rather
+than letting results pile up.
+
+A session which fails, or runs past its timeout, is reconnected (through
+a transition to DISCONNECTED) and run again, up to retries more times.
+Timeouts are enforced by killing the session's child process, so a
+handler stuck reading from the host fails with EOF; one which never
+reads is not interrupted.
+
+From the command line, given a file (or - for stdin) listing a host per
+line, with optional [Connect] option=value pairs after it:
+
+    python -m isg.util.fleet -c template.cfg -f mypackage.sessions:makeSession hosts.txt
+
+writes each result to stdout as a line of JSON.
+
+This needs multiprocessing (standard from Python 2.6, and available as a
+backport for 2.4 and 2.5).
+"""
+
+import cPickle
+import logging
+import multiprocessing
+import optparse
+import os
+import Queue
+import signal
+import sys
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import configobj
+
+from isg.util.config import clone, update_from_argument_list
+
+__all__ = [
+    'FleetResult',
+    'host_config',
+    'run_session',
+    'run_fleet',
+    'read_hosts',
+    'main',
+]
+
+logger = logging.getLogger('Fleet')
+
+class FleetResult(object):
+    """The outcome of the flow on one host.
+
+    index is the host's position in the list given to run_fleet. ok is true if run() returned, retval being what it returned; if every attempt failed, error describes the last failure, and timed_out says whether it was cut short by the timeout. worker is the pid of the process which ran it.
+    """
+    def __init__(self, index, host, ok, retval=None, error=None, timed_out=False, attempts=1, elapsed=0.0, worker=None):
+        self.index = index
+        self.host = host
+        self.ok = ok
+        self.retval = retval
+        self.error = error
+        self.timed_out = timed_out
+        self.attempts = attempts
+        self.elapsed = elapsed
+        self.worker = worker
+    def as_dict(self):
+        return dict(self.__dict__)
+    def __repr__(self):
+        if self.ok:
+            return '<FleetResult %r ok: %r>' % (self.host, self.retval)
+        return '<FleetResult %r failed: %s>' % (self.host, self.error)
+
+def host_config(template, host):
+    """Return a copy of the template ConfigObj for host: a host name, which becomes [Connect] host, or a dict of [Connect] options."""
+    config = clone(template)
+    if isinstance(host, dict):
+        options = host
+    else:
+        options = {'host': host}
+    if not 'Connect' in config:
+        config['Connect'] = {}
+    for name, value in options.items():
+        config['Connect'][name] = value
+    return config
+
+def _host_name(host):
+    if isinstance(host, dict):
+        return host.get('host')
+    return host
+
+def _drop_connection(session):
+    """Kill the child of session, so that whatever is reading from it fails."""
+    child = getattr(session, 'child', None)
+    if child is None:
+        return
+    if child.pid is None:
+        child.close()
+        return
+    try:
+        os.kill(child.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+def _describe(e):
+    """Return the first line of an exception, which for pexpect's is all that is not a dump of the child's state."""
+    lines = str(e).splitlines()
+    return '%s: %s' % (e.__class__.__name__, lines and lines[0] or '')
+
+def _disconnect(session):
+    try:
+        session.transitionTo('DISCONNECTED')
+    except Exception, e:
+        logger.warning('Unable to disconnect: %s', e)
+
+def run_session(session_factory, config, timeout=None, retries=0, retry_delay=1.0):
+    """Run a session made by session_factory (given config through config_reload) to completion, allowing each attempt timeout seconds and making up to retries more, each after retry_delay seconds times the number of attempts so far. The session is disconnected afterwards.
+
+    Returns a tuple of (ok, retval, error, timed_out, attempts)."""
+    session = session_factory()
+    if hasattr(session, 'config_reload'):
+        session.config_reload(config)
+    attempts = 0
+    try:
+        while True:
+            attempts += 1
+            expired = threading.Event()
+            timer = None
+            if timeout:
+                def expire():
+                    expired.set()
+                    _drop_connection(session)
+                timer = threading.Timer(timeout, expire)
+                timer.setDaemon(True)
+                timer.start()
+            try:
+                try:
+                    return (True, session.run(), None, False, attempts)
+                except Exception, e:
+                    error = _describe(e)
+            finally:
+                if timer is not None:
+                    timer.cancel()
+            timed_out = expired.isSet()
+            if timed_out:
+                error = 'timed out after %rs (%s)' % (timeout, error)
+            if attempts > retries:
+                return (False, None, error, timed_out, attempts)
+            logger.info('Attempt %d failed (%s); reconnecting', attempts, error)
+            _disconnect(session)
+            time.sleep(retry_delay * attempts)
+    finally:
+        _disconnect(session)
+
+def _picklable(value):
+    """Return value, or its repr if it cannot be sent back from a worker."""
+    try:
+        cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        return value
+    except Exception:
+        return repr(value)
+
+def _work(tasks, results, session_factory, template, timeout, retries, retry_delay):
+    """Run sessions for the hosts taken from tasks until given None."""
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        index, host = task
+        start = time.time()
+        try:
+            ok, retval, error, timed_out, attempts = run_session(session_factory, host_config(template, host), timeout, retries, retry_delay)
+        except Exception, e:
+            logger.exception(e)
+            ok, retval, error, timed_out, attempts = False, None, _describe(e), False, 0
+        results.put(FleetResult(index, _host_name(host), ok, _picklable(retval), error, timed_out, attempts, time.time() - start, os.getpid()))
+
+def _worker(tasks, results, session_factory, template, sessions, timeout, retries, retry_delay):
+    """The body of a worker process: runs up to sessions sessions at once."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)      ## left to the parent
+    threads = []
+    for n in range(sessions):
+        thread = threading.Thread(target=_work, name='FleetSession-%d' % n,
+                                  args=(tasks, results, session_factory, template, timeout, retries, retry_delay))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+def run_fleet(hosts, session_factory, template, workers=None, sessions_per_worker=4, timeout=None, retries=0, retry_delay=1.0, max_pending=None):
+    """Run a session made by session_factory against each of hosts, from workers processes (by default, one per core) running sessions_per_worker sessions each. Yields a FleetResult for each host as it finishes.
+
+    template is the ConfigObj copied for each host (see host_config). timeout, retries and retry_delay are as for run_session. At most max_pending hosts (by default, twice as many as can run at once) are handed out beyond the results taken. session_factory and template are inherited by the workers when they are forked.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if max_pending is None:
+        max_pending = workers * sessions_per_worker * 2
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    processes = []
+    for n in range(workers):
+        process = multiprocessing.Process(target=_worker, name='FleetWorker-%d' % n,
+                                          args=(tasks, results, session_factory, template, sessions_per_worker, timeout, retries, retry_delay))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+    hosts = iter(hosts)
+    index = 0
+    pending = 0
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and pending < max_pending:
+                try:
+                    host = hosts.next()
+                except StopIteration:
+                    exhausted = True
+                    break
+                tasks.put((index, host))
+                index += 1
+                pending += 1
+            if not pending:
+                break
+            while True:
+                try:
+                    result = results.get(timeout=1.0)
+                    break
+                except Queue.Empty:
+                    dead = [ process.name for process in processes if not process.is_alive() ]
+                    if dead:
+                        raise RuntimeError('fleet worker(s) %s exited with %d session(s) unfinished' % (', '.join(dead), pending))
+            pending -= 1
+            yield result
+    finally:
+        if pending:
+            ## abandoned part way through
+            for process in processes:
+                process.terminate()
+        else:
+            for n in range(workers * sessions_per_worker):
+                tasks.put(None)
+        for process in processes:
+            process.join()
+
+def read_hosts(lines):
+    """Yield the hosts listed in lines: a host per line, optionally followed by option=value pairs giving other [Connect] options, in which case a dict is yielded. Blank lines and those starting with # are skipped."""
+    for line in lines:
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+        if len(fields) == 1:
+            yield fields[0]
+            continue
+        host = {'host': fields[0]}
+        for field in fields[1:]:
+            if not '=' in field:
+                raise ValueError('expected option=value, not %r' % field)
+            name, value = field.split('=', 1)
+            host[name] = value
+        yield host
+
+def _resolve(name):
+    """Return the object named by module:attribute"""
+    if not ':' in name:
+        raise ValueError('expected module:attribute, not %r' % name)
+    module_name, attribute = name.split(':', 1)
+    module = __import__(module_name, {}, {}, [attribute])
+    return getattr(module, attribute)
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog -c TEMPLATE -f MODULE:FACTORY [options] HOSTS [section.option=value ...]')
+    parser.add_option('-c', '--config', help='the config template')
+    parser.add_option('-f', '--factory', help='the callable making a session, as module:attribute')
+    parser.add_option('-w', '--workers', type='int', help='worker processes [one per core]')
+    parser.add_option('-k', '--sessions', type='int', default=4, help='sessions run at once by each worker [%default]')
+    parser.add_option('-t', '--timeout', type='float', help='seconds allowed each attempt')
+    parser.add_option('-r', '--retries', type='int', default=0, help='further attempts at a failed host [%default]')
+    parser.add_option('--retry-delay', type='float', default=1.0, help='seconds to wait before retrying, times the attempts so far [%default]')
+    parser.add_option('--max-pending', type='int', help='hosts handed out ahead of the results written')
+    options, args = parser.parse_args(argv)
+    if not options.config or not options.factory or not args:
+        parser.error('a config template, a session factory and a host list are required')
+    template = configobj.ConfigObj(options.config)
+    update_from_argument_list(template, args[1:])
+    if args[0] == '-':
+        hosts_file = sys.stdin
+    else:
+        hosts_file = open(args[0])
+    failures = 0
+    for result in run_fleet(read_hosts(hosts_file), _resolve(options.factory), template,
+                            options.workers, options.sessions, options.timeout,
+                            options.retries, options.retry_delay, options.max_pending):
+        if not result.ok:
+            failures += 1
+        sys.stdout.write(json.dumps(result.as_dict(), default=repr) + '\n')
+        sys.stdout.flush()
+    return failures and 1 or 0
+
+# vim: sw=4 ts=4 sts=4 sta et ai
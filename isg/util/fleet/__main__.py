@@ -0,0 +1,7 @@
+import sys
+
+from isg.util.fleet import main
+
+sys.exit(main())
+
+# vim: sw=4 ts=4 sts=4 sta et ai
@@ -0,0 +1,126 @@
+"""A bounded mapping which discards its least recently used items.
+
+>>> cache = LRUCache(2)
+>>> cache['a'] = 1
+>>> cache['b'] = 2
+>>> cache.get('a')
+1
+>>> cache['c'] = 3
+>>> cache.keys()
+['a', 'c']
+>>> cache.get('b') is None
+True
+>>> (cache.hits, cache.misses)
+(1, 1)
+"""
+
+import threading
+
+__all__ = ['LRUCache']
+
+_PREV, _NEXT, _KEY, _VALUE = range(4)
+
+class LRUCache(object):
+    """A mapping holding at most max_size items.
+
+    Lookups through get() or [] mark an item as recently used, and are
+    counted in the hits and misses attributes; once the cache is full,
+    storing a new item evicts the item used least recently. A max_size of
+    0 or less disables caching entirely.
+
+    A cache may be shared between threads: every operation holds a lock
+    while it reorders the items.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__map = {}
+        ## circular doubly linked list of [prev, next, key, value] links; most recent last
+        root = self.__root = []
+        root[:] = [root, root, None, None]
+    def clear(self):
+        """Discard all items (the hit and miss counters are left alone)."""
+        self.__lock.acquire()
+        try:
+            self.__map = {}
+            root = self.__root = []
+            root[:] = [root, root, None, None]
+        finally:
+            self.__lock.release()
+    def __len__(self):
+        return len(self.__map)
+    def __contains__(self, key):
+        return key in self.__map
+    has_key = __contains__
+    def __getitem__(self, key):
+        self.__lock.acquire()
+        try:
+            link = self.__map.get(key)
+            if link is None:
+                self.misses += 1
+                raise KeyError(key)
+            self.hits += 1
+            self.__touch(link)
+            return link[_VALUE]
+        finally:
+            self.__lock.release()
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    def __setitem__(self, key, value):
+        if self.max_size <= 0:
+            return
+        self.__lock.acquire()
+        try:
+            link = self.__map.get(key)
+            if link is not None:
+                link[_VALUE] = value
+                self.__touch(link)
+                return
+            if len(self.__map) >= self.max_size:
+                self.__unlink(self.__root[_NEXT])
+            root = self.__root
+            last = root[_PREV]
+            link = [last, root, key, value]
+            last[_NEXT] = root[_PREV] = self.__map[key] = link
+        finally:
+            self.__lock.release()
+    def __delitem__(self, key):
+        self.__lock.acquire()
+        try:
+            self.__unlink(self.__map[key])
+        finally:
+            self.__lock.release()
+    def keys(self):
+        """Return the keys held, least recently used first."""
+        self.__lock.acquire()
+        try:
+            retval = []
+            root = self.__root
+            link = root[_NEXT]
+            while link is not root:
+                retval.append(link[_KEY])
+                link = link[_NEXT]
+            return retval
+        finally:
+            self.__lock.release()
+    def __unlink(self, link):
+        prev, next = link[_PREV], link[_NEXT]
+        prev[_NEXT] = next
+        next[_PREV] = prev
+        del self.__map[link[_KEY]]
+    def __touch(self, link):
+        prev, next = link[_PREV], link[_NEXT]
+        prev[_NEXT] = next
+        next[_PREV] = prev
+        root = self.__root
+        last = root[_PREV]
+        link[_PREV] = last
+        link[_NEXT] = root
+        last[_NEXT] = root[_PREV] = link
+
+# vim: sw=4 ts=4 sts=4 sta et ai
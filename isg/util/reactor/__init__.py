@@ -0,0 +1,254 @@
+"""A minimal select()-based reactor, running many coroutines in one thread.
+
+A coroutine is a generator which yields Waitables. The reactor resumes it
+once what it yielded is done; the coroutine then calls that Waitable's
+result() to learn the outcome (which re-raises any exception). A
+coroutine gives its own result by yielding Return(value) last.
+
+    def fetch(child):
+        ready = WaitReadable(child, timeout=5)
+        yield ready
+        if not ready.result():
+            raise TIMEOUT()
+        yield Return(child.read_nonblocking(1024, 0))
+
+To run another coroutine and receive its result, yield Call(coroutine)
+and then call its result(). A generator yielded bare is run just the same,
+but its result is discarded, and any exception it raises is raised at the
+yield instead.
+
+The same coroutines can also be run without a reactor, blocking in select()
+for each wait, by run_blocking(); this lets blocking APIs share their logic
+with their coroutine counterparts.
+"""
+
+import errno
+import select
+import sys
+import time
+import types
+
+__all__ = [
+    'Waitable',
+    'WaitReadable',
+    'Sleep',
+    'Call',
+    'Return',
+    'Reactor',
+    'run_blocking',
+]
+
+class Waitable(object):
+    """Something a coroutine may wait for. deadline is the absolute time at which the wait times out (None for never)."""
+    deadline = None
+    def __init__(self):
+        self.done = False
+        self.value = None
+        self.exc_info = None
+    def fileno(self):
+        """A file descriptor (or object with a fileno method) whose readability finishes the wait, or None."""
+        return None
+    def finish(self, value=None):
+        self.done = True
+        self.value = value
+    def fail(self, exc_info):
+        self.done = True
+        self.exc_info = exc_info
+    def timed_out(self):
+        """Called by the reactor once deadline has passed."""
+        self.finish(None)
+    def readable(self):
+        """Called by the reactor once fileno() is readable."""
+        self.finish(True)
+    def block(self):
+        """Wait for this, blocking the whole thread, when run outside a reactor."""
+        raise NotImplementedError
+    def result(self):
+        """Return the outcome of the wait, re-raising any exception it ended with."""
+        if self.exc_info is not None:
+            exc_info, self.exc_info = self.exc_info, None
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return self.value
+
+class WaitReadable(Waitable):
+    """Wait up to timeout seconds (forever if None) for source to become readable. The result is True if it did, False on timeout.
+
+    If source has a _wait_readable(timeout) method, that is used to wait when blocking.
+    """
+    def __init__(self, source, timeout=None):
+        Waitable.__init__(self)
+        self.source = source
+        self.timeout = timeout
+        if timeout is not None:
+            self.deadline = time.time() + max(timeout, 0)
+    def fileno(self):
+        if hasattr(self.source, 'fileno'):
+            return self.source.fileno()
+        return self.source
+    def timed_out(self):
+        self.finish(False)
+    def block(self):
+        if hasattr(self.source, '_wait_readable'):
+            self.finish(self.source._wait_readable(self.timeout))
+            return
+        timeout = self.timeout
+        if timeout is not None:
+            timeout = max(timeout, 0)
+        try:
+            r, w, e = select.select([self.source], [], [], timeout)
+        except select.error, e:
+            if e[0] != errno.EINTR:
+                raise
+            r = []
+        self.finish(bool(r))
+
+class Sleep(Waitable):
+    """Wait for the given number of seconds."""
+    def __init__(self, seconds):
+        Waitable.__init__(self)
+        self.seconds = seconds
+        self.deadline = time.time() + seconds
+    def block(self):
+        time.sleep(max(self.deadline - time.time(), 0))
+        self.finish(None)
+
+class Call(Waitable):
+    """Run another coroutine; the result is whatever it yields in a Return."""
+    def __init__(self, coroutine):
+        Waitable.__init__(self)
+        self.coroutine = coroutine
+
+class Return(object):
+    """Yielded by a coroutine to finish with the given result."""
+    def __init__(self, value=None):
+        self.value = value
+
+class _Task(object):
+    """A stack of (coroutine, Call) pairs, innermost last."""
+    def __init__(self, call):
+        self.stack = [(call.coroutine, call)]
+        self.waiting_on = None
+
+def _advance(task):
+    """Run task until it waits on something other than a coroutine, or finishes. Returns the Waitable being waited on, or None when finished."""
+    stack = task.stack
+    exc_info = None                       ## to be thrown into the next coroutine resumed
+    while stack:
+        coroutine, call = stack[-1]
+        try:
+            if exc_info is not None:
+                exc_info, thrown = None, exc_info
+                item = coroutine.throw(*thrown)
+            else:
+                item = coroutine.next()
+        except StopIteration:
+            stack.pop()
+            call.finish(None)
+            continue
+        except:
+            stack.pop()
+            call.fail(sys.exc_info())
+            if stack and getattr(call, '_implicit', False):
+                ## nobody holds this Call to see the error, so raise it in the caller
+                exc_info = call.exc_info
+                call.exc_info = None
+            continue
+        if isinstance(item, Return):
+            stack.pop()
+            call.finish(item.value)
+            continue
+        if isinstance(item, types.GeneratorType):
+            item = Call(item)
+            item._implicit = True
+        if isinstance(item, Call):
+            stack.append((item.coroutine, item))
+            continue
+        if not isinstance(item, Waitable):
+            stack.pop()
+            call.fail((TypeError, TypeError('coroutine yielded %r, not a Waitable' % (item,)), None))
+            continue
+        if item.done:
+            continue
+        return item
+    return None
+
+def run_blocking(coroutine):
+    """Run coroutine to completion in this thread, blocking on each wait. Returns its result."""
+    call = Call(coroutine)
+    task = _Task(call)
+    while True:
+        waitable = _advance(task)
+        if waitable is None:
+            return call.result()
+        waitable.block()
+
+class Reactor(object):
+    """Runs any number of coroutines, multiplexing their waits through a single select().
+
+    Every Waitable a coroutine waits on must have a deadline or a fileno();
+    one with neither fails at once with ValueError, raised by its result().
+    """
+    def __init__(self):
+        self.runnable = []
+        self.waiting = []                 ## tasks waiting on a Waitable
+    def spawn(self, coroutine):
+        """Start running coroutine (once run() is called). Returns a Call whose result() gives the coroutine's."""
+        call = Call(coroutine)
+        self.runnable.append(_Task(call))
+        return call
+    def __len__(self):
+        return len(self.runnable) + len(self.waiting)
+    def run_once(self, timeout=None):
+        """Advance every runnable task, then wait up to timeout seconds for some waiting task to become runnable."""
+        runnable, self.runnable = self.runnable, []
+        for task in runnable:
+            waitable = task.waiting_on = _advance(task)
+            if waitable is None:
+                continue
+            if waitable.deadline is None and waitable.fileno() is None:
+                ## nothing here would ever finish it, and with nothing to select on we would spin
+                waitable.fail((ValueError, ValueError('%r has neither a deadline nor a fileno() to wait on' % (waitable,)), None))
+                self.runnable.append(task)
+                continue
+            self.waiting.append(task)
+        if not self.waiting:
+            return
+        now = time.time()
+        readers = []
+        for task in self.waiting:
+            waitable = task.waiting_on
+            if waitable.deadline is not None:
+                delay = max(waitable.deadline - now, 0)
+                if timeout is None or delay < timeout:
+                    timeout = delay
+            if waitable.fileno() is not None:
+                readers.append(waitable)
+        try:
+            if readers:
+                ready, w, e = select.select(readers, [], [], timeout)
+            else:
+                if timeout:
+                    time.sleep(timeout)
+                ready = []
+        except select.error, e:
+            if e[0] != errno.EINTR:
+                raise
+            ready = []
+        for waitable in ready:
+            waitable.readable()
+        now = time.time()
+        waiting, self.waiting = self.waiting, []
+        for task in waiting:
+            waitable = task.waiting_on
+            if not waitable.done and waitable.deadline is not None and waitable.deadline <= now:
+                waitable.timed_out()
+            if waitable.done:
+                self.runnable.append(task)
+            else:
+                self.waiting.append(task)
+    def run(self):
+        """Run until every spawned coroutine has finished."""
+        while self.runnable or self.waiting:
+            self.run_once()
+
+# vim: sw=4 ts=4 sts=4 sta et ai
@@ -1,13 +1,21 @@
+import itertools
 import logging
 import os
-import re
 import sys
-
-import ANSI
+import threading
+import time
 
 from isg.util.screen_scraper import pxtty
-from isg.util.state_machine import HandlerSet
+from isg.util.screen_scraper.captures import CaptureStream, capture_record, open_sink, sink_formats
+from isg.util.screen_scraper.screens import compile_screens, compile_verify, ScreenConfigError, EMPTY_SCREEN
+from isg.util.screen_scraper.spawnpool import SpawnPool, reaper
+from isg.util.screen_scraper.recording import Recorder, ReplaySpawn, load as load_recording
+from isg.util.screen_scraper.terminal import TrackingANSI, ArrayANSI, capture_fields, screen_text
+from isg.state_machine import HandlerSet
+from isg.state_machine.stats import StateStats, logDump, fileDump
 from isg.util.config import ConfigMixIn, UNDEFINED, integer_sort_order
+from isg.util.lru import LRUCache
+from isg.util.reactor import Call, Return, run_blocking
 
 __all__ = ['BaseConnection', 'KEYS', ]
 
@@ -35,6 +43,20 @@ keys_dict = {
     'F12':'\x1b[24~',
 }
 
+# terminal emulators selectable with [General] terminal_backend
+terminal_backends = {
+    'ansi': TrackingANSI,
+    'array': ArrayANSI,
+}
+
+## numbers the recordings made by this process
+recording_serial = itertools.count(1)
+
+## SpawnPools, keyed as by BaseConnection.spawn_pool_key, and how many sessions share each
+spawn_pools = {}
+spawn_pool_users = {}
+spawn_pools_lock = threading.Lock()
+
 class KEYS: """Container for key constants"""
 
 for key in keys_dict.keys():
@@ -45,11 +67,271 @@ class BaseConnection(HandlerSet, ConfigMixIn):
     def __init__(self):
         ConfigMixIn.__init__(self)
         self.child = None
-        self.term = ANSI.ANSI()
+        self.recorder = None              ## Recorder of the current connection, if [Record] is enabled
+        self.pool_key = None              ## key of the SpawnPool we share, if any
+        self.last_screen = None           ## (class name, state, substate) of the screen last imaged
+        self.capture_sinks = []           ## see add_capture_sink
+        self.capture_serial = itertools.count(1)
+        self.capture_stream = None        ## CaptureStream of the run started by start_capture_run
+        self.configured_sink = None       ## (format, filename, sink) of [Captures] sink, if set
+        backend = self.config_get('General', 'terminal_backend', default='ansi')
+        if backend not in terminal_backends:
+            raise KeyError('Terminal backend %r not defined' % backend)
+        self.term = terminal_backends[backend]()
+        self.compile_screens()
+        self.screen_cache = LRUCache(self.config_get('General', 'screen_cache_size', isInteger=True, default=0))
         super(BaseConnection, self).__init__()
-    def cmd_connect(self):
-        os.environ['TERM'] = self.config_get('General', 'term', default='ANSI')
-        self.child = pxtty.spawn(self.config_get('Connect', 'spawnString'), self.term)
+        self.configure_stats()
+        self.configure_captures()
+    def compile_screens(self):
+        """Compile the [screens] section into ScreenSpecs. Raises ScreenConfigError if any definition is malformed."""
+        self.screen_specs = compile_screens(self.config_get_section('screens'))
+    def config_reloaded(self):
+        """Recompile screens from the new config, and start a fresh screen cache. The live connection and terminal are kept."""
+        self.compile_screens()
+        self.screen_cache = LRUCache(self.config_get('General', 'screen_cache_size', isInteger=True, default=0))
+        self.configure_stats()
+        self.configure_captures()
+        if self.pool_key is not None and self.pool_key != self.spawn_pool_key():
+            self.release_spawn_pool()
+    def configure_stats(self):
+        """Enable or disable instrumentation (see isg.state_machine.stats) as [Stats] enabled says, dumping a snapshot every dump_interval seconds (if set) to the StateMachine.stats logger, or to dump_file if given. Statistics already gathered are kept."""
+        if not self.config_get('Stats', 'enabled', isBoolean=True, default=False):
+            self.disableStats()
+            return
+        if self.stats is None:
+            self.enableStats(StateStats())
+        dump_file = self.config_get('Stats', 'dump_file', default=None)
+        if dump_file:
+            self.stats.dump = fileDump(dump_file)
+        else:
+            self.stats.dump = logDump
+        self.stats.dump_interval = self.config_get('Stats', 'dump_interval', isFloat=True, default=0)
+        self.stats.next_dump = time.time() + self.stats.dump_interval
+    def state_stats(self):
+        """Return the counters and latency histograms gathered since instrumentation was enabled (or last reset); empty if it is disabled"""
+        if self.stats is None:
+            return {}
+        return self.stats.snapshot()
+    state_stats.expose = True
+    def reset_state_stats(self):
+        """Discard the statistics gathered so far"""
+        if self.stats is not None:
+            self.stats.clear()
+        return True
+    reset_state_stats.expose = True
+    def configure_captures(self):
+        """Read [Captures]: retain says how much captured data image_screen keeps in the __data attributes, and sink and file name a file every capture record is appended to (see isg.util.screen_scraper.captures)."""
+        retain = self.config_get('Captures', 'retain', default='all')
+        if retain not in ('all', 'screen', 'none'):
+            raise KeyError('Captures retain %r not defined' % retain)
+        format = self.config_get('Captures', 'sink', default=None)
+        filename = self.config_get('Captures', 'file', default=None)
+        if format and format not in sink_formats:
+            raise KeyError('Capture sink format %r not defined' % format)
+        self.capture_retain = retain
+        if self.configured_sink is not None:
+            if self.configured_sink[:2] == (format, filename):
+                return
+            self.remove_capture_sink(self.configured_sink[2])
+            self.configured_sink[2].close()
+            self.configured_sink = None
+        if format and filename:
+            sink = open_sink(format, filename)
+            self.add_capture_sink(sink)
+            self.configured_sink = (format, filename, sink)
+    def add_capture_sink(self, sink):
+        """Hand sink (anything with a write method) a record of the data captured from each screen imaged from now on."""
+        self.capture_sinks.append(sink)
+    def remove_capture_sink(self, sink):
+        if sink in self.capture_sinks:
+            self.capture_sinks.remove(sink)
+    def _emit_capture(self, path, captured):
+        """Keep data captured from the screen at path in its class's __data attribute, as [Captures] retain says, and pass it on to the capture sinks."""
+        if not captured:
+            return
+        if self.capture_retain != 'none':
+            data_dict = self._data_dict(path[0])
+            if self.capture_retain == 'screen':
+                data_dict.clear()
+            data_dict.update(captured)
+        if self.capture_sinks:
+            record = capture_record(self.capture_serial.next(), path, captured)
+            for sink in self.capture_sinks:
+                sink.write(record)
+    def iter_captures(self, max_pending=100):
+        """Run the state machine in another thread, yielding a capture record (see isg.util.screen_scraper.captures) for each screen captured, as it is captured. The machine is held up while max_pending records are waiting to be consumed. If run() fails, its exception is raised once every record has been yielded. Closing the generator early makes the machine fail at its next capture."""
+        stream = self._start_capture_thread(max_pending)
+        try:
+            for record in stream:
+                yield record
+        except:
+            stream.close()
+            raise
+    def _start_capture_thread(self, max_pending):
+        stream = CaptureStream(max_pending)
+        def run():
+            self.add_capture_sink(stream)
+            try:
+                try:
+                    retval = self.run()
+                except Exception, e:
+                    stream.finish(error=e)
+                else:
+                    stream.finish(retval)
+            finally:
+                self.remove_capture_sink(stream)
+        thread = threading.Thread(target=run, name='Capture run of %r' % self)
+        thread.setDaemon(True)
+        thread.start()
+        return stream
+    def start_capture_run(self, max_pending=100):
+        """Start running the state machine in the background, keeping up to max_pending capture records at a time for read_captures; until it finishes, call nothing but read_captures."""
+        if self.capture_stream is not None and not self.capture_stream.finished:
+            raise Exception('A capture run is already in progress')
+        self.capture_stream = self._start_capture_thread(max_pending)
+        return True
+    start_capture_run.expose = True
+    def read_captures(self, since=0, limit=100, timeout=10):
+        """Return up to limit capture records of the run started by start_capture_run, after the one numbered since (which, with those before it, are discarded), waiting up to timeout seconds for one. The result has the records, the number to pass as since next time, whether the run has finished (and everything has been read), and once it has, the run's retval or error, where there is one."""
+        stream = self.capture_stream
+        if stream is None:
+            raise Exception('No capture run has been started')
+        records, finished = stream.read_status(since, limit, timeout)
+        result = {'records': records, 'next': records and records[-1]['seq'] or since,
+                  'finished': finished}
+        if result['finished']:
+            if stream.error is not None:
+                result['error'] = '%s: %s' % (stream.error.__class__.__name__, stream.error)
+            elif stream.retval is not None:
+                result['retval'] = stream.retval
+        return result
+    read_captures.expose = True
+    def reload_config(self):
+        """Re-read the configuration file, keeping the connection up"""
+        self.config_reload()
+        return True
+    reload_config.expose = True
+    def screen_spec(self, class_name, state, substate='default'):
+        """Return the ScreenSpec for the given screen (EMPTY_SCREEN if it has no definition)."""
+        return self.screen_specs.get((class_name, state, substate), EMPTY_SCREEN)
+    def cmd_connect(self, resume=False):
+        """Spawn the connection. When resuming a checkpoint, [Connect] resumeSpawnString is used if set (e.g. to reattach to a session kept alive on the far side).
+
+        Otherwise, if a [SpawnPool] is configured, an already logged-in child is taken from it if one is ready; True is then returned, and the session should go straight to [SpawnPool] ready_state.
+
+        If [Connect] replayFile is set, no host is contacted: the recording it names (see isg.util.screen_scraper.recording) is replayed instead, at [Connect] replaySpeed (0, the default, for as fast as possible; 1 for real time). If [Record] directory is set, the connection is recorded there (and a pooled child is never used, so that recordings start from the beginning)."""
+        replay_file = self.config_get('Connect', 'replayFile', default=None)
+        if replay_file:
+            self.child = ReplaySpawn(load_recording(replay_file), self.term,
+                                     speed=self.config_get('Connect', 'replaySpeed', isFloat=True, default=0))
+            return False
+        spawnString = self.config_get('Connect', 'spawnString')
+        record_directory = self.config_get('Record', 'directory', default=None)
+        if resume:
+            spawnString = self.config_get('Connect', 'resumeSpawnString', default=spawnString)
+        elif not record_directory:
+            pool = self.spawn_pool()
+            if pool is not None:
+                child = pool.acquire(timeout=self.config_get('SpawnPool', 'acquire_timeout', isFloat=True, default=0))
+                if child is not None:
+                    self.child = child
+                    self.term = child.term
+                    return True
+        self.child = pxtty.spawn(spawnString, self.term, env=self.spawn_env())
+        if record_directory:
+            self.start_recording(record_directory)
+        return False
+    def spawn_env(self):
+        """Return the environment for a spawned child: ours, with TERM set from [General] term. (Setting TERM in os.environ instead would race between sessions, and with SpawnPool warmers, spawning at once.)"""
+        env = dict(os.environ)
+        env['TERM'] = self.config_get('General', 'term', default='ANSI')
+        return env
+    def start_recording(self, directory):
+        """Record the current connection into a new file in directory, gzipped if [Record] compress is true. Returns the file's name."""
+        filename = os.path.join(directory, '%s-%d-%d.isgpty' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid(), recording_serial.next()))
+        if self.config_get('Record', 'compress', isBoolean=True, default=False):
+            filename += '.gz'
+        self.stop_recording()
+        self.recorder = Recorder(filename)
+        self.recorder.attach(self.child)
+        logger.info('Recording connection to %s', filename)
+        return filename
+    def stop_recording(self):
+        if self.recorder is not None:
+            if self.child is not None:
+                self.recorder.detach(self.child)
+            self.recorder.close()
+            self.recorder = None
+    def spawn_pool_key(self):
+        """Return the key identifying the SpawnPool our config calls for: our spawnString, terminal backend and TERM, and the whole [SpawnPool] section; or None if [SpawnPool] size is 0 (as it is by default)."""
+        if self.config_get('SpawnPool', 'size', isInteger=True, default=0) <= 0:
+            return None
+        settings = []
+        for name, value in self.config_get_section('SpawnPool').items():
+            if isinstance(value, list):
+                value = tuple(value)
+            settings.append((name, value))
+        settings.sort()
+        return (self.config_get('Connect', 'spawnString'),
+                self.config_get('General', 'terminal_backend', default='ansi'),
+                self.config_get('General', 'term', default='ANSI'),
+                tuple(settings))
+    def spawn_pool(self):
+        """Return the SpawnPool shared by sessions whose config calls for the same one (see spawn_pool_key), starting it if need be; or None if [SpawnPool] size is 0."""
+        key = self.spawn_pool_key()
+        spawn_pools_lock.acquire()
+        try:
+            if key != self.pool_key:
+                self._release_spawn_pool()
+            if key is None:
+                return None
+            pool = spawn_pools.get(key)
+            if pool is None:
+                spawnString, backend = key[:2]
+                pool = self.make_spawn_pool(spawnString, terminal_backends[backend],
+                                            self.config_get('SpawnPool', 'size', isInteger=True))
+                pool.start()
+                spawn_pools[key] = pool
+                spawn_pool_users[key] = 0
+            if key != self.pool_key:
+                spawn_pool_users[key] += 1
+                self.pool_key = key
+            return pool
+        finally:
+            spawn_pools_lock.release()
+    def release_spawn_pool(self):
+        """Stop sharing the SpawnPool we last took children from. Once no session shares a pool, it is stopped and its children reaped."""
+        spawn_pools_lock.acquire()
+        try:
+            self._release_spawn_pool()
+        finally:
+            spawn_pools_lock.release()
+    def _release_spawn_pool(self):
+        """Does the work of release_spawn_pool; the caller holds spawn_pools_lock."""
+        key, self.pool_key = self.pool_key, None
+        if key is None:
+            return
+        spawn_pool_users[key] -= 1
+        if spawn_pool_users[key] <= 0:
+            del spawn_pool_users[key]
+            spawn_pools.pop(key).stop()
+    def make_spawn_pool(self, spawnString, terminal_class, size):
+        """Build a SpawnPool from the [SpawnPool] section: login_<n> = pattern, text pairs (run in numeric order; text is decoded as for [os] options), verify_<n> clauses as for screens, and verify_timeout, settle_time and check_interval in seconds. Sessions given a pooled child go to ready_state, which defaults to CONNECTING (as is right if there is no login script)."""
+        env = self.spawn_env()
+        def spawn():
+            return pxtty.spawn(spawnString, terminal_class(), env=env)
+        login = []
+        for name, value in self.config_get_items('SpawnPool', 'login_', sort=integer_sort_order, strip_prefix=True):
+            if not isinstance(value, list) or len(value) != 2:
+                raise ScreenConfigError('SpawnPool: login_%s should be a list of a pattern and the text to send, not %r' % (name, value))
+            login.append((value[0], value[1].decode('string_escape')))
+        verifies = [ compile_verify(['SpawnPool'], name, value)
+                     for name, value in self.config_get_items('SpawnPool', 'verify_', sort=integer_sort_order) ]
+        return SpawnPool(spawn, size, login, verifies,
+                         verify_timeout=self.config_get('SpawnPool', 'verify_timeout', isFloat=True, default=10.0),
+                         settle_time=self.config_get('SpawnPool', 'settle_time', isFloat=True, default=self.settle_time),
+                         check_interval=self.config_get('SpawnPool', 'check_interval', isFloat=True, default=5.0))
     def cmd_disconnect(self):
         self.transitionTo('DISCONNECTED')
     def sendline(self, content=None):
@@ -59,6 +341,10 @@ class BaseConnection(HandlerSet, ConfigMixIn):
     @property
     def settle_time(self):
         return self.config_get('General', 'settle_time', isFloat=True, default=0.5)
+    @property
+    def settle_pattern(self):
+        """Incoming data matching this regex ends a settle wait early; None if not configured."""
+        return self.config_get('General', 'settle_pattern', decode=True, default=None)
     def send_key(self, key):
         config_key = 'term_key_%s' % key
         if key in keys_dict:
@@ -87,84 +373,166 @@ class BaseConnection(HandlerSet, ConfigMixIn):
         outfile.write('Cursor pos: (%d,%d)\n' % (self.child.term.cur_r, self.child.term.cur_c))
     def image_screen(self, expect_updates=False, settle_time=None, substate='default'):
         """Wait for the screen state to settle; then capture any content"""
+        self._image_screen(expect_updates, settle_time, substate)
+    def async_image_screen(self, expect_updates=False, settle_time=None, substate='default'):
+        """A coroutine (see isg.util.reactor) version of image_screen, for use by handlers run with asyncRun()."""
+        call = Call(self._async_image_screen(expect_updates, settle_time, substate))
+        yield call
+        call.result()
+    def _image_screen(self, expect_updates, settle_time, substate):
+        """Does the work of image_screen; returns the substate finally imaged (after any redirects) and a dict of the data captured from it."""
+        return run_blocking(self._async_image_screen(expect_updates, settle_time, substate))
+    def _async_image_screen(self, expect_updates, settle_time, substate):
         # FIXME: We only validate on the way in, not the way out -- so validate handlers are not inherited.
         # Probably each of these steps should be broken down into separate methods.
         current_handler = self._StateMachineHandler__current_handler
         current_state = self._StateMachineHandler__state
         current_class_name = current_handler.im_func._origin_class.__name__
-        config_path = [
-            'screens',
-            current_class_name,
-            current_state,
-            substate,
-        ]
+        spec = self.screen_spec(current_class_name, current_state, substate)
         if settle_time is None:
             settle_time = self.settle_time
+        stats = self.stats
+        if stats is not None:
+            bytes_before = self.child.bytes_read
+            start = time.time()
         ## wait for initial updates
-        self.child.expect_delay(delay_time=settle_time, require_input=int(expect_updates))
+        call = Call(self.child.async_expect_delay(delay_time=settle_time, require_input=int(expect_updates), settle_pattern=self.settle_pattern))
+        yield call
+        call.result()
+        if stats is not None:
+            settled = time.time()
         ## dump the screen if we're in debugging mode
         if self.config_get('General', 'dump_screen', isBoolean=True, default=False):
             self.screen_dump()
+        if self.capture_retain != 'none':
+            ## handlers may look for it before anything is captured
+            self._data_dict(current_class_name)
+        ## a screen identical to one already imaged here gets the same result
+        cache_key = None
+        if self.screen_cache.max_size > 0:
+            cache_key = (current_class_name, current_state, substate, screen_text(self.child.term))
+            cached = self.screen_cache.get(cache_key)
+            if cached is not None:
+                logger.debug('Screen cache hit for %r', spec)
+                self._emit_capture((current_class_name, current_state, cached[0]), cached[1])
+                self.last_screen = (current_class_name, current_state, cached[0])
+                if stats is not None:
+                    stats.screen((current_class_name, current_state, substate), settle_time=settled - start, bytes_read=self.child.bytes_read - bytes_before, cache_hit=True)
+                yield Return(cached)
+                return
+        result = None
         ## validate any verify_* clauses
-        for name, value in self.config_get_items(config_path, 'verify_'):
-            logger.debug('Validating %r', ((name, value),))
-            assert isinstance(value, list)
-            assert len(value) == 2 or len(value) == 3
-            if len(value) == 2:
-                verify_timeout = settle_time
-            else:
-                verify_timeout = float(value[2])
-            self.child.expect_line_matching(value[1], lineno=int(value[0]), timeout=verify_timeout)
+        call = Call(self._async_verify(spec, settle_time))
+        yield call
+        if stats is None:
+            call.result()
+        else:
+            try:
+                call.result()
+            except pxtty.TIMEOUT:
+                stats.screen((current_class_name, current_state, substate), settle_time=settled - start, verify_time=time.time() - settled, bytes_read=self.child.bytes_read - bytes_before, verify_timeout=True)
+                raise
+            stats.screen((current_class_name, current_state, substate), settle_time=settled - start, verify_time=time.time() - settled, bytes_read=self.child.bytes_read - bytes_before)
         ## perform any redirects
-        for name, value in self.config_get_items(config_path, 'redirect_', strip_prefix=True, sort=integer_sort_order):
-            logger.debug('Processing redirect_%s (%r)', (name, value))
-            if value[0] == 'regex':
-                lineno, startcol, length = [ int(n) for n in value[1:4] ]
-                re_text, target = value[4:6]
-                text = self.child.term.get_region(lineno, startcol, lineno, startcol+length)[0]
-                if re.match(re_text, text):
-                    return self.image_screen(expect_updates=False, settle_time=settle_time, substate=target)
-            elif value[0] == 'always':
-                target = value[1]
-                return self.image_screen(expect_updates=False, settle_time=settle_time, substate=target)
-            elif value[0] == 'error':
-                raise Exception(value[1:])
-            else:
-                raise Exception('Unknown redirect evaluation type: %r' % value[0])
-        ## perform any captures
-        if not hasattr(self, '_%s__data' % current_class_name):
-            setattr(self, '_%s__data' % current_class_name, {})
-        current_data_dict = getattr(self, '_%s__data' % current_class_name)
-        while True:
-            logger.debug('Evaluating captures for %r', config_path)
-            for name, value in self.config_get_items(config_path, 'data__', strip_prefix=True):
-                if value[0] == 'fixedpos':
-                    lineno,startcol,length,strip = [ int(n) for n in value[1:] ]
-                    retval = self.child.term.get_region(lineno, startcol, lineno, startcol+length)[0]
-                    if strip:
-                        retval = retval.strip()
-                else:
-                    raise Exception('Unknown data retrieval type: %r' % value[0])
-                current_data_dict[name] = retval
-            if not self.config_exists(config_path, 'inherit_from'):
+        for redirect in spec.redirects:
+            logger.debug('Processing redirect_%s', redirect.name)
+            if redirect.kind == 'regex':
+                text = self.child.term.get_region(redirect.lineno, redirect.startcol, redirect.lineno, redirect.startcol+redirect.length)[0]
+                if redirect.pattern.match(text):
+                    call = Call(self._async_image_screen(False, settle_time, redirect.target))
+                    yield call
+                    result = call.result()
+                    break
+            elif redirect.kind == 'always':
+                call = Call(self._async_image_screen(False, settle_time, redirect.target))
+                yield call
+                result = call.result()
                 break
-            config_path[2] = self.config_get(config_path, 'inherit_from')
+            elif redirect.kind == 'error':
+                raise Exception(redirect.args)
+        ## perform any captures
+        if result is None:
+            logger.debug('Evaluating captures for %r', spec)
+            captured = {}
+            if spec.captures:
+                captured = capture_fields(self.child.term, spec.capture_plan)
+                self._emit_capture((current_class_name, current_state, substate), captured)
+            result = (substate, captured)
+            self.last_screen = (current_class_name, current_state, substate)
+        ## only cache the result if the screen didn't change while we worked
+        if cache_key is not None and screen_text(self.child.term) == cache_key[3]:
+            self.screen_cache[cache_key] = result
+        yield Return(result)
+    def _async_verify(self, spec, settle_time):
+        """Wait for every verify_ clause of spec to match, each within its timeout (settle_time by default)."""
+        for verify in spec.verifies:
+            logger.debug('Validating line %r against %r', verify.lineno, verify.pattern.pattern)
+            if verify.timeout is None:
+                verify_timeout = settle_time
+            else:
+                verify_timeout = verify.timeout
+            call = Call(self.child.async_expect_line_matching_list([verify.pattern], lineno=verify.lineno, timeout=verify_timeout))
+            yield call
+            call.result()
+    def _data_dict(self, class_name):
+        """Return the dict holding data captured by the given class's screens."""
+        if not hasattr(self, '_%s__data' % class_name):
+            setattr(self, '_%s__data' % class_name, {})
+        return getattr(self, '_%s__data' % class_name)
+    def screen_cache_stats(self):
+        """Return the size, capacity, hit and miss counts of the screen cache"""
+        return {
+            'size': len(self.screen_cache),
+            'max_size': self.screen_cache.max_size,
+            'hits': self.screen_cache.hits,
+            'misses': self.screen_cache.misses,
+        }
+    screen_cache_stats.expose = True
+    def checkpointExtra(self):
+        return {'last_screen': self.last_screen}
+    def restoreExtra(self, extra):
+        self.last_screen = (extra or {}).get('last_screen')
+    def resume(self, checkpoint, settle_time=None):
+        """Restore checkpoint (see StateMachineHandler.checkpoint) into this session (which, to have this method, must already have inherited its connection class), reconnect, and check that the screen last imaged before the checkpoint is showing again, by its verify_ clauses. If it is, navigation can be skipped: run() carries on from the checkpointed state, and True is returned. If not (or if that screen has nothing to verify it by), the connection is dropped and the session put back in DISCONNECTED, to start afresh; False is returned."""
+        self.restore(checkpoint)
+        if settle_time is None:
+            settle_time = self.settle_time
+        self.cmd_connect(resume=True)
+        spec = EMPTY_SCREEN
+        if self.last_screen is not None:
+            spec = self.screen_spec(*self.last_screen)
+        try:
+            if not spec.verifies:
+                raise pxtty.TIMEOUT('no verify_ clauses for screen %r' % (self.last_screen,))
+            self.child.expect_delay(delay_time=settle_time, settle_pattern=self.settle_pattern)
+            run_blocking(self._async_verify(spec, settle_time))
+        except (pxtty.TIMEOUT, pxtty.EOF), e:
+            logger.info('Unable to resume at %r (%s); starting afresh', self.last_screen, e)
+            self.transitionTo('DISCONNECTED')
+            ## if the checkpoint was itself in DISCONNECTED, that transition did nothing
+            self.drop_child()
+            self.resetStack()
+            for name in checkpoint['data'].keys():
+                setattr(self, name, {})
+            self.last_screen = None
+            return False
+        return True
     def do__INITIAL_STATE(self):
         return 'DISCONNECTED'
     def do__INVALID(self):
         self.cmd_disconnect()
     def do__DISCONNECTED(self):
-        self.cmd_connect()
+        if self.cmd_connect():
+            return self.config_get('SpawnPool', 'ready_state', default='CONNECTING')
         return 'CONNECTING'
-    def transition__default__to__DISCONNECTED(self):
+    def drop_child(self):
+        """Stop any recording, and have the child (if any) terminated and waited for in the background."""
+        self.stop_recording()
         if self.child is not None:
-            try:
-                os.kill(self.child.pid, 15)
-                os.waitpid(self.child.pid, 0)
-            except OSError, e:
-                logging.getLogger('OSConnection').error('Unable to kill process %s: %s' %
-                                  (self.child.pid, str(e)))
+            reaper.reap(self.child)
             self.child = None
+    def transition__default__to__DISCONNECTED(self):
+        self.drop_child()
         self.resetStack()
         self.setState('DISCONNECTED')
 
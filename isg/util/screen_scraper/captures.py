@@ -0,0 +1,207 @@
+"""Delivery of captured screen data as each screen is imaged.
+
+Each time image_screen captures fields, a BaseConnection hands a capture
+record to every sink attached to it (see BaseConnection.add_capture_sink).
+A record is a dict:
+
+    seq        1 for the first screen captured by the connection, and so on
+    time       when the screen was imaged
+    class      the class, state and substate of the screen definition
+    state
+    substate
+    data       a dict of the fields captured, by name
+
+A sink is anything with a write(record) method (and optionally close()).
+JSONLinesSink and CSVSink write records to a file; a CaptureStream holds
+them for a consumer in another thread, which reads them by iterating over
+it or, across an RPC boundary, with read(). A CaptureStream may be
+bounded, in which case a producer finding it full waits for records to be
+consumed, so that a long extraction runs in bounded memory end to end.
+"""
+
+import csv
+import itertools
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from collections import deque
+
+__all__ = [
+    'CaptureStream',
+    'CaptureStreamClosed',
+    'JSONLinesSink',
+    'CSVSink',
+    'capture_record',
+    'open_sink',
+]
+
+## columns of a CSVSink ahead of those of the data
+RECORD_COLUMNS = ['seq', 'time', 'class', 'state', 'substate']
+
+class CaptureStreamClosed(Exception): """The consumer of a CaptureStream has gone away"""
+
+def capture_record(seq, path, data, when=None):
+    """Return the record of data captured from the screen whose (class name, state, substate) is path."""
+    if when is None:
+        when = time.time()
+    class_name, state, substate = path
+    return {
+        'seq': seq,
+        'time': when,
+        'class': class_name,
+        'state': state,
+        'substate': substate,
+        'data': data,
+    }
+
+class CaptureStream(object):
+    """A thread-safe queue of capture records, between the thread running a session and a consumer.
+
+    With max_pending set, write() waits while that many records are
+    unconsumed. Records are consumed by iterating over the stream, which
+    ends once the producer has called finish() and every record has been
+    read (re-raising the producer's exception, if it gave one); or by
+    read(), which takes a cursor so that a remote caller can acknowledge
+    what it has received. Closing the stream makes the producer's next
+    write() raise CaptureStreamClosed.
+    """
+    def __init__(self, max_pending=None):
+        self.max_pending = max_pending
+        self.finished = False
+        self.closed = False
+        self.retval = None
+        self.error = None                 ## the exception the producer finished with, if any
+        self.__records = deque()
+        self.__condition = threading.Condition()
+    def __len__(self):
+        return len(self.__records)
+    def write(self, record):
+        self.__condition.acquire()
+        try:
+            while not self.closed and self.max_pending and len(self.__records) >= self.max_pending:
+                self.__condition.wait()
+            if self.closed:
+                raise CaptureStreamClosed('the consumer of the capture stream has gone away')
+            self.__records.append(record)
+            self.__condition.notifyAll()
+        finally:
+            self.__condition.release()
+    def finish(self, retval=None, error=None):
+        """Called by the producer when there will be no more records."""
+        self.__condition.acquire()
+        try:
+            self.finished = True
+            self.retval = retval
+            self.error = error
+            self.__condition.notifyAll()
+        finally:
+            self.__condition.release()
+    def close(self):
+        """Called by the consumer when it wants no more records; those unread are discarded."""
+        self.__condition.acquire()
+        try:
+            self.closed = True
+            self.__records.clear()
+            self.__condition.notifyAll()
+        finally:
+            self.__condition.release()
+    def read(self, since=0, limit=None, timeout=0):
+        """Discard the records numbered since and before, as received, and return a list of up to limit of those after. If there are none, wait up to timeout seconds (None for as long as it takes) for one, or for the producer to finish. See read_status for whether the stream is then done."""
+        return self.read_status(since, limit, timeout)[0]
+    def read_status(self, since=0, limit=None, timeout=0):
+        """As read, but return a tuple of the records and whether every record has now been read from the finished stream (as seen at the same moment, so that no record can slip in between)."""
+        self.__condition.acquire()
+        try:
+            records = self.__records
+            while records and records[0]['seq'] <= since:
+                records.popleft()
+                self.__condition.notifyAll()
+            if not records and not self.finished and not self.closed and timeout != 0:
+                if timeout is None:
+                    while not records and not self.finished and not self.closed:
+                        self.__condition.wait()
+                else:
+                    end_time = time.time() + timeout
+                    while not records and not self.finished and not self.closed:
+                        remaining = end_time - time.time()
+                        if remaining <= 0:
+                            break
+                        self.__condition.wait(remaining)
+            if limit is None:
+                result = list(records)
+            else:
+                result = list(itertools.islice(records, limit))
+            return result, self.finished and not records
+        finally:
+            self.__condition.release()
+    def __iter__(self):
+        since = 0
+        while True:
+            records = self.read(since, timeout=None)
+            if not records:
+                if self.closed:
+                    return
+                ## finished, and everything read
+                self.read(since)
+                if self.error is not None:
+                    raise self.error
+                return
+            for record in records:
+                yield record
+            since = records[-1]['seq']
+
+class _FileSink(object):
+    def __init__(self, f):
+        if isinstance(f, basestring):
+            self.file = open(f, 'a')
+            self.file.seek(0, 2)
+            self.own_file = True
+        else:
+            self.file = f
+            self.own_file = False
+    def close(self):
+        if self.own_file and not self.file.closed:
+            self.file.close()
+
+class JSONLinesSink(_FileSink):
+    """Appends each record, as a line of JSON, to a file (given by name or as an open file). Strings are decoded as latin-1, so that screen text of any bytes is written."""
+    def write(self, record):
+        self.file.write(json.dumps(record, encoding='latin-1', separators=(',', ':')) + '\n')
+        self.file.flush()
+
+class CSVSink(_FileSink):
+    """Appends each record as a row to a CSV file (given by name or as an open file): seq, time, class, state and substate, then the fields captured. The data columns are those given as fields or, by default, those of the first record written (sorted by name); fields a record lacks are left empty, and those the columns lack are left out. A header row is written to a file which is empty."""
+    def __init__(self, f, fields=None):
+        _FileSink.__init__(self, f)
+        self.fields = fields
+        self.writer = None
+    def write(self, record):
+        if self.writer is None:
+            if self.fields is None:
+                self.fields = record['data'].keys()
+                self.fields.sort()
+            self.writer = csv.writer(self.file)
+            if self.file.tell() == 0:
+                self.writer.writerow(RECORD_COLUMNS + list(self.fields))
+        data = record['data']
+        self.writer.writerow([ record[column] for column in RECORD_COLUMNS ] + [ data.get(field, '') for field in self.fields ])
+        self.file.flush()
+
+## file formats selectable with [Captures] sink
+sink_formats = {
+    'jsonl': JSONLinesSink,
+    'csv': CSVSink,
+}
+
+def open_sink(format, filename):
+    """Return a sink appending records to filename in the named format (jsonl or csv)."""
+    if format not in sink_formats:
+        raise KeyError('Capture sink format %r not defined' % format)
+    return sink_formats[format](filename)
+
+# vim: sw=4 ts=4 sts=4 sta et ai
@@ -5,12 +5,24 @@ input data to it.
 """
 
 import ANSI
+import errno
+import re
+import select
 import time
+import warnings
 
 from pexpect import EOF, TIMEOUT
 from pexpect import spawn as pexpect_spawn
 
+from isg.util.reactor import WaitReadable, Return, run_blocking
+
 READ_CHUNK_SIZE=1024
+## how much trailing input to keep when looking for a settle_pattern split across reads
+SETTLE_PATTERN_WINDOW=256
+
+def _warn_resolution(resolution):
+    if resolution is not None:
+        warnings.warn('resolution is ignored: input is waited for, not polled', DeprecationWarning, stacklevel=3)
 
 __all__ = ['pxtty']
 
@@ -19,38 +31,84 @@ class spawn(pexpect_spawn):
         assert isinstance(term, ANSI.term), 'pxtty should be passed a terminal instance'
         pexpect_spawn.__init__(self, command, timeout=timeout, maxread=maxread, searchwindowsize=searchwindowsize, logfile=logfile, cwd=cwd, env=env)
         self.term = term
+        self.bytes_read = 0               ## total read from the child, for instrumentation
         self.logfiles_read.append(self.term)
         ## TODO: if we're set for local echo, also logfiles_send and logfiles_interact
-    def expect_delay(self, delay_time, timeout=30, resolution=0.25, require_input=0):
-        """Wait for input to settle for a period not less than delay_time.
-        resolution specifies the delay between tests. Raises timeout if we fail
-        to settle down within timeout seconds. If require_input is greater than
-        zero, we will not start counting for delay until after require_input bytes have
-        been read.
+    def read_nonblocking(self, size=1, timeout=-1):
+        data = pexpect_spawn.read_nonblocking(self, size, timeout)
+        self.bytes_read += len(data)
+        return data
+    def _wait_readable(self, timeout):
+        """Wait up to timeout seconds (forever if None) for the child to
+        have output ready to read. Returns True if it does, False otherwise."""
+        if timeout is not None:
+            timeout = max(timeout, 0)
+        try:
+            r, w, e = select.select([self.child_fd], [], [], timeout)
+        except select.error, e:
+            if e[0] == errno.EINTR:
+                return False
+            raise
+        return bool(r)
+    def expect_delay(self, delay_time, timeout=30, resolution=None, require_input=0, settle_pattern=None):
+        """Wait for input to settle for a period not less than delay_time,
+        timed from the arrival of the last byte received. Raises timeout if
+        we fail to settle down within timeout seconds. If require_input is
+        greater than zero, we will not start counting for delay until after
+        require_input bytes have been read. If settle_pattern (a regex,
+        compiled or not) is given, return as soon as incoming data matches
+        it rather than waiting out the rest of delay_time.
+        resolution is no longer used, and is retained for compatibility;
+        giving it raises a DeprecationWarning.
         """
-        time_since_last_input = 0
+        _warn_resolution(resolution)
+        return run_blocking(self.async_expect_delay(delay_time, timeout, require_input=require_input, settle_pattern=settle_pattern))
+    def async_expect_delay(self, delay_time, timeout=30, require_input=0, settle_pattern=None):
+        """A coroutine (see isg.util.reactor) version of expect_delay."""
         end_time = time.time() + timeout
+        if isinstance(settle_pattern, basestring):
+            settle_pattern = re.compile(settle_pattern)
+        recent_input = ''
         if require_input:
-            self.read_nonblocking(size=int(require_input), timeout=timeout)
+            ready = WaitReadable(self, timeout)
+            yield ready
+            ## should the wait have timed out, this raises TIMEOUT (or EOF)
+            ## just as a blocking read_nonblocking() would have
+            recent_input = self.read_nonblocking(size=int(require_input), timeout=0)
+        last_input = time.time()
         while True:
-            if time.time() > end_time:
+            if settle_pattern is not None and settle_pattern.search(recent_input):
+                return
+            now = time.time()
+            if now - last_input >= delay_time:
+                return
+            if now > end_time:
                 raise TIMEOUT('Client has not stopped sending data within %r seconds' % timeout)
-            try:
-                self.read_nonblocking(size=READ_CHUNK_SIZE, timeout=resolution)
-                time_since_last_input = 0
-            except TIMEOUT:
-                time_since_last_input += resolution
-                if time_since_last_input >= delay_time:
-                    return
-    def expect_cursor_position(self, row, column, timeout=30, resolution=0.05):
-        """Expect the cursor to seek to a given row and column. Polls,
-        so this should be used only in cases where the cursor settles
-        on the correct position (rather than just passing through)."""
+            ready = WaitReadable(self, min(last_input + delay_time, end_time) - now)
+            yield ready
+            if not ready.result():
+                continue
+            data = self.read_nonblocking(size=READ_CHUNK_SIZE, timeout=0)
+            last_input = time.time()
+            if settle_pattern is not None:
+                recent_input = recent_input[-SETTLE_PATTERN_WINDOW:] + data
+    def expect_cursor_position(self, row, column, timeout=30, resolution=None):
+        """Expect the cursor to seek to a given row and column. Checks
+        only as input arrives, so this should be used only in cases where
+        the cursor settles on the correct position (rather than just
+        passing through). resolution is no longer used, as for
+        expect_delay."""
+        _warn_resolution(resolution)
+        return run_blocking(self.async_expect_cursor_position(row, column, timeout))
+    def async_expect_cursor_position(self, row, column, timeout=30):
+        """A coroutine (see isg.util.reactor) version of expect_cursor_position."""
         end_time = time.time() + timeout
         if self.term.cur_r == row and self.term.cur_c == column:
             return
         while True:
-            self.read_nonblocking(self.maxread, timeout)
+            ready = WaitReadable(self, timeout)
+            yield ready
+            self.read_nonblocking(self.maxread, timeout=0)
             if (row is None or self.term.cur_r == row) and (column is None or self.term.cur_c == column):
                 return
             if time.time() > end_time:
@@ -63,32 +121,57 @@ class spawn(pexpect_spawn):
         """
         compiled_pattern_list = self.compile_pattern_list(pattern)
         return self.expect_line_matching_list(compiled_pattern_list, lineno=lineno, timeout=timeout)
+    def async_expect_line_matching(self, pattern, lineno=0, timeout=-1):
+        """A coroutine (see isg.util.reactor) version of expect_line_matching. Its result is the index of the pattern matched."""
+        compiled_pattern_list = self.compile_pattern_list(pattern)
+        return self.async_expect_line_matching_list(compiled_pattern_list, lineno=lineno, timeout=timeout)
     def expect_line_matching_list(self, pattern_list, timeout=-1, lineno=0):
+        return run_blocking(self.async_expect_line_matching_list(pattern_list, timeout, lineno))
+    def async_expect_line_matching_list(self, pattern_list, timeout=-1, lineno=0):
+        """A coroutine (see isg.util.reactor) version of expect_line_matching_list."""
         if timeout == -1:
             timeout = self.timeout
-        end_time = time.time() + timeout
+        if timeout is not None:
+            end_time = time.time() + timeout
+        ## Rows which have not changed since they were last checked cannot
+        ## have started matching, so (given a terminal which tracks changes)
+        ## only changed rows are rescanned after the first pass.
+        term = self.term
+        tracking = hasattr(term, 'changed_rows')
+        checked_version = None
+        match_index = None
         try:
             incoming = self.buffer
-            while True:
+            while match_index is None:
+                if checked_version is None:
+                    rows = range(term.rows)
+                else:
+                    rows = term.changed_rows(checked_version)
+                if tracking:
+                    checked_version = term.version
                 for cre in pattern_list:
                     if cre is EOF or cre is TIMEOUT:
                         continue
+                    match = None
                     if lineno:
-                        line = self.term.dump_row(lineno-1)
-                        match = cre.search(line)
+                        if lineno-1 in rows:
+                            match = cre.search(term.dump_row(lineno-1))
                     else:
-                        for line in self.term.dump_rows():
-                            match = cre.search(line)
+                        for n in rows:
+                            match = cre.search(term.dump_row(n))
                             if match is not None: break
                     if match is None: continue
                     self.buffer = ''
                     self.before = incoming
                     self.after = ''
                     self.match = match
-                    self.match_index = pattern_list.index(cre)
-                    return self.match_index
-                c = self.read_nonblocking(self.maxread, timeout)
-                time.sleep(0.0001)
+                    self.match_index = match_index = pattern_list.index(cre)
+                    break
+                if match_index is not None:
+                    break
+                ready = WaitReadable(self, timeout)
+                yield ready
+                c = self.read_nonblocking(self.maxread, timeout=0)
                 incoming += c
                 if timeout is not None:
                     timeout = end_time - time.time()
@@ -101,7 +184,7 @@ class spawn(pexpect_spawn):
             if EOF in pattern_list:
                 self.match = EOF
                 self.match_index = pattern_list.index(EOF)
-                return self.match_index
+                match_index = self.match_index
             else:
                 self.match = None
                 self.match_index = None
@@ -112,7 +195,7 @@ class spawn(pexpect_spawn):
             if TIMEOUT in pattern_list:
                 self.match = TIMEOUT
                 self.match_index = pattern_list.index(TIMEOUT)
-                return self.match_index
+                match_index = self.match_index
             else:
                 self.match = None
                 self.match_index = None
@@ -123,5 +206,6 @@ class spawn(pexpect_spawn):
             self.match = None
             self.match_index = None
             raise
+        yield Return(match_index)
 
 # vim: sw=4 ts=4 sts=4 sta et ai
@@ -0,0 +1,293 @@
+"""Recording of pxtty sessions, and their replay without a host.
+
+A Recorder attached to a spawn writes everything read from the child
+(output) and sent to it (input), with the time of each, to a compact
+binary file: a header, then for each chunk a direction byte, its offset
+in seconds from the start of the recording (a double) and its length,
+all big-endian, followed by the bytes. Files whose names end in .gz are
+gzip-compressed.
+
+ReplaySpawn stands in for pxtty.spawn, feeding a recording back through
+the terminal emulator. Output recorded after some input is held back
+until that input has been sent, and what is sent must match what was
+recorded (else ReplayDivergence is raised), so a handler set can be run
+against a recording as it would against the host, and checked for having
+done the same thing. With speed 0, output is delivered as fast as it can
+be consumed, and a settle wait (expect_delay) ends as soon as everything
+the host sent before its next input has been read; otherwise recorded
+gaps are reproduced, divided by speed. When the recording runs out, the
+child reads as EOF.
+"""
+
+import gzip
+import os
+import struct
+import time
+
+from pexpect import EOF, TIMEOUT, ExceptionPexpect
+
+from isg.util.lru import LRUCache
+from isg.util.reactor import Return
+from isg.util.screen_scraper import pxtty
+
+__all__ = ['Recorder', 'Recording', 'ReplaySpawn', 'ReplayDivergence', 'RecordingError', 'load']
+
+MAGIC = 'ISGPTY'
+FORMAT_VERSION = 1
+HEADER_FORMAT = '>6sBd'                   ## magic, version, start time
+RECORD_FORMAT = '>BdI'                    ## direction, offset, length
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+OUTPUT, INPUT = ord('o'), ord('i')
+
+class RecordingError(Exception): """The file is not a recording this version can read"""
+
+class ReplayDivergence(ExceptionPexpect):
+    """What was sent to a ReplaySpawn is not what was sent when the session was recorded."""
+
+def _open(filename, mode):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+class _Channel(object):
+    """The file-like face of one direction of a Recorder, as pexpect logs to."""
+    def __init__(self, recorder, direction):
+        self.recorder = recorder
+        self.direction = direction
+    def write(self, data):
+        self.recorder.record(self.direction, data)
+    def flush(self):
+        pass
+
+class Recorder(object):
+    """Writes a recording of whatever is read from or sent to the children it is attached to."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.start = time.time()
+        self.file = _open(filename, 'wb')
+        self.file.write(struct.pack(HEADER_FORMAT, MAGIC, FORMAT_VERSION, self.start))
+        self.output = _Channel(self, OUTPUT)
+        self.input = _Channel(self, INPUT)
+    def record(self, direction, data):
+        if data and self.file is not None:
+            self.file.write(struct.pack(RECORD_FORMAT, direction, time.time() - self.start, len(data)) + data)
+    def attach(self, child):
+        child.logfiles_read.append(self.output)
+        child.logfile_send = self.input
+    def detach(self, child):
+        if self.output in child.logfiles_read:
+            child.logfiles_read.remove(self.output)
+        if child.logfile_send is self.input:
+            child.logfile_send = None
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class Recording(object):
+    """A recording read back: start is the time it began; records is a list of (direction, offset, data) tuples."""
+    def __init__(self, start, records):
+        self.start = start
+        self.records = records
+    def __len__(self):
+        return len(self.records)
+    def output(self):
+        """Return everything the host sent"""
+        return ''.join([ data for direction, offset, data in self.records if direction == OUTPUT ])
+    def input(self):
+        """Return everything sent to the host"""
+        return ''.join([ data for direction, offset, data in self.records if direction == INPUT ])
+
+def parse(data):
+    """Return the Recording in data, the contents of a recording file."""
+    if len(data) < HEADER_SIZE:
+        raise RecordingError('not a recording')
+    magic, version, start = struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])
+    if magic != MAGIC:
+        raise RecordingError('not a recording')
+    if version != FORMAT_VERSION:
+        raise RecordingError('recording format %d is not supported (expected %d)' % (version, FORMAT_VERSION))
+    records = []
+    position = HEADER_SIZE
+    while position < len(data):
+        if position + RECORD_SIZE > len(data):
+            raise RecordingError('truncated recording')
+        direction, offset, length = struct.unpack(RECORD_FORMAT, data[position:position + RECORD_SIZE])
+        position += RECORD_SIZE
+        if direction not in (OUTPUT, INPUT) or position + length > len(data):
+            raise RecordingError('corrupt recording')
+        records.append((direction, offset, data[position:position + length]))
+        position += length
+    return Recording(start, records)
+
+## parsed recordings, keyed by filename, size and modification time
+_recordings = LRUCache(32)
+
+def load(filename):
+    """Read the recording in filename. Recordings are immutable, so the last few loaded are kept and shared."""
+    info = os.stat(filename)
+    key = (filename, info.st_size, info.st_mtime)
+    recording = _recordings.get(key)
+    if recording is None:
+        f = _open(filename, 'rb')
+        try:
+            recording = parse(f.read())
+        finally:
+            f.close()
+        _recordings[key] = recording
+    return recording
+
+class ReplaySpawn(pxtty.spawn):
+    """Plays the host's side of a Recording, in place of a spawned child.
+
+    The replay has no process (its pid is None); its file descriptor is
+    one end of a pipe which is kept readable while there is output to be
+    delivered, so it may be waited on by a Reactor as a real child would be.
+    When replaying at a finite speed, a read made before the next output
+    is due sleeps until it is, blocking any Reactor it is run from.
+    """
+    def __init__(self, recording, term, speed=0, timeout=30, maxread=2000):
+        pxtty.spawn.__init__(self, None, term, timeout=timeout, maxread=maxread)
+        self.recording = recording
+        self.speed = speed
+        self.name = '<replay of %d records>' % len(recording)
+        self.delaybeforesend = 0
+        self.closed = False
+        self.terminated = False
+        self.__records = recording.records
+        self.__position = 0               ## index of the next record to read output from
+        self.__unread = ''                ## what remains of the output record last read
+        self.__expected = ''              ## what remains of the input record being matched
+        self.__nextInput = self.__findInput(0)
+        self.__anchor = (time.time(), 0.0)   ## (when, recorded offset) of the last input sent
+        self.__readFd, self.__writeFd = os.pipe()
+        self.__signalled = False
+        self.child_fd = self.__readFd
+        self.__signal()
+    def __findInput(self, start):
+        """Return the index of the first input record from start on (or the number of records, if none)."""
+        records = self.__records
+        for n in xrange(start, len(records)):
+            if records[n][0] == INPUT:
+                return n
+        return len(records)
+    def __nextOutput(self):
+        """Return the index of the next output record which may be read, or None if the replay is waiting for input (or at its end)."""
+        records = self.__records
+        while self.__position < self.__nextInput and records[self.__position][0] != OUTPUT:
+            self.__position += 1
+        if self.__position < self.__nextInput:
+            return self.__position
+        return None
+    def __atEnd(self):
+        return not self.__unread and self.__nextInput >= len(self.__records) and self.__nextOutput() is None
+    def __pending(self):
+        return bool(self.__unread) or self.__nextOutput() is not None or self.__atEnd()
+    def __signal(self):
+        """Make our descriptor readable exactly when there is output to read (or EOF to report)."""
+        if self.closed:
+            return
+        pending = self.__pending()
+        if pending and not self.__signalled:
+            os.write(self.__writeFd, 'x')
+            self.__signalled = True
+        elif not pending and self.__signalled:
+            os.read(self.__readFd, 1)
+            self.__signalled = False
+    def __due(self, index):
+        """Return the time at which the output record at index is due (now, at speed 0)."""
+        if not self.speed:
+            return 0
+        when, offset = self.__anchor
+        return when + (self.__records[index][1] - offset) / self.speed
+    def _wait_readable(self, timeout):
+        if self.__unread or self.__atEnd():
+            return True
+        index = self.__nextOutput()
+        if index is None:
+            ## waiting for input, which will not come while we wait
+            if self.speed and timeout:
+                time.sleep(timeout)
+            return False
+        delay = self.__due(index) - time.time()
+        if delay <= 0:
+            return True
+        if timeout is not None and timeout < delay:
+            time.sleep(max(timeout, 0))
+            return False
+        time.sleep(delay)
+        return True
+    def read_nonblocking(self, size=1, timeout=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file in read_nonblocking().')
+        if not self.__unread:
+            index = self.__nextOutput()
+            if index is None:
+                if self.__atEnd():
+                    self.flag_eof = True
+                    raise EOF('End of recording')
+                raise TIMEOUT('Timeout exceeded in read_nonblocking(): the recording is waiting for input.')
+            delay = self.__due(index) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.__unread = self.__records[index][2]
+            self.__position += 1
+        data, self.__unread = self.__unread[:size], self.__unread[size:]
+        self.__signal()
+        self.bytes_read += len(data)
+        if self.logfile is not None:
+            self.logfile.write(data)
+            self.logfile.flush()
+        for f in self.logfiles_read:
+            f.write(data)
+            f.flush()
+        return data
+    def async_expect_delay(self, delay_time, timeout=30, require_input=0, settle_pattern=None):
+        if self.speed:
+            return pxtty.spawn.async_expect_delay(self, delay_time, timeout, require_input=require_input, settle_pattern=settle_pattern)
+        return self.__settle()
+    def __settle(self):
+        """Read everything the host sent before its next input."""
+        while self.__unread or self.__nextOutput() is not None:
+            self.read_nonblocking(pxtty.READ_CHUNK_SIZE, timeout=0)
+        yield Return()
+    def send(self, s):
+        if self.logfile is not None:
+            self.logfile.write(s)
+            self.logfile.flush()
+        if self.logfile_send is not None:
+            self.logfile_send.write(s)
+            self.logfile_send.flush()
+        remaining = s
+        while remaining:
+            if not self.__expected:
+                if self.__nextInput >= len(self.__records):
+                    raise ReplayDivergence('sent %r after the end of the recording' % remaining)
+                self.__expected = self.__records[self.__nextInput][2]
+            length = min(len(remaining), len(self.__expected))
+            if remaining[:length] != self.__expected[:length]:
+                raise ReplayDivergence('sent %r where the recording has %r' % (remaining, self.__expected))
+            remaining, self.__expected = remaining[length:], self.__expected[length:]
+            if not self.__expected:
+                ## the input is complete, so the host's response may follow
+                self.__anchor = (time.time(), self.__records[self.__nextInput][1])
+                self.__nextInput = self.__findInput(self.__nextInput + 1)
+        self.__signal()
+        return len(s)
+    def isalive(self):
+        return not self.closed and not self.__atEnd()
+    def terminate(self, force=False):
+        self.close()
+        return True
+    def kill(self, sig):
+        self.close()
+    def close(self, force=True):
+        if not self.closed:
+            os.close(self.__readFd)
+            os.close(self.__writeFd)
+            self.child_fd = -1
+            self.closed = True
+            self.terminated = True
+
+# vim: sw=4 ts=4 sts=4 sta et ai
@@ -0,0 +1,203 @@
+"""Compiled screen definitions.
+
+The [screens] section of the configuration describes, for each
+(class, state, substate), how to recognize a screen and what to capture
+from it; see example.cfg. compile_screens() turns the whole section into
+ScreenSpec objects ahead of time -- patterns compiled, coordinates
+converted to integers, redirects sorted and inherit_from chains resolved
+-- so that malformed definitions are reported at load time, and imaging
+a screen does no parsing at all.
+
+"""
+
+import re
+
+from isg.util.screen_scraper.terminal import FieldPlan
+
+__all__ = [
+    'ScreenConfigError',
+    'ScreenSpec',
+    'Verify',
+    'Redirect',
+    'Capture',
+    'compile_screens',
+    'EMPTY_SCREEN',
+]
+
+class ScreenConfigError(Exception): """A screen definition is malformed"""
+
+class Verify(object):
+    """A line which must match pattern (on lineno, or on any line if lineno is 0) before the screen is accepted. A timeout of None means the settle time is used."""
+    __slots__ = ('lineno', 'pattern', 'timeout')
+    def __init__(self, lineno, pattern, timeout):
+        self.lineno = lineno
+        self.pattern = pattern
+        self.timeout = timeout
+
+class Redirect(object):
+    """A switch to another substate. kind is one of 'regex' (switch if the region matches pattern), 'always' or 'error' (raise an exception carrying args)."""
+    __slots__ = ('name', 'kind', 'lineno', 'startcol', 'length', 'pattern', 'target', 'args')
+    def __init__(self, name, kind, lineno=None, startcol=None, length=None, pattern=None, target=None, args=()):
+        self.name = name
+        self.kind = kind
+        self.lineno = lineno
+        self.startcol = startcol
+        self.length = length
+        self.pattern = pattern
+        self.target = target
+        self.args = args
+
+class Capture(object):
+    """A fixed-position field to be captured under name."""
+    __slots__ = ('name', 'lineno', 'startcol', 'length', 'strip')
+    def __init__(self, name, lineno, startcol, length, strip):
+        self.name = name
+        self.lineno = lineno
+        self.startcol = startcol
+        self.length = length
+        self.strip = strip
+
+class ScreenSpec(object):
+    """The compiled definition of a single screen.
+
+    captures includes those inherited (via inherit_from) from other states, in the order they are to be applied; capture_plan holds the same fields as a FieldPlan, for capturing in a single pass.
+    """
+    __slots__ = ('path', 'verifies', 'redirects', 'captures', 'capture_plan')
+    def __init__(self, path, verifies=(), redirects=(), captures=()):
+        self.path = path
+        self.verifies = tuple(verifies)
+        self.redirects = tuple(redirects)
+        self.captures = tuple(captures)
+        self.capture_plan = FieldPlan([ (capture.name, capture.lineno, capture.startcol, capture.length, capture.strip)
+                                        for capture in self.captures ])
+    def __repr__(self):
+        return '<ScreenSpec %r>' % (self.path,)
+
+EMPTY_SCREEN = ScreenSpec(None)
+
+def _as_list(path, name, value, lengths):
+    if not isinstance(value, list) or len(value) not in lengths:
+        raise ScreenConfigError('%s: %s should be a list of %s items, not %r'
+                                % ('.'.join(path), name, ' or '.join([ str(n) for n in lengths ]), value))
+    return value
+
+def _as_int(path, name, value):
+    try:
+        return int(value)
+    except ValueError:
+        raise ScreenConfigError('%s: %s expects an integer, not %r' % ('.'.join(path), name, value))
+
+def _as_regex(path, name, value, flags=0):
+    try:
+        return re.compile(value, flags)
+    except re.error, e:
+        raise ScreenConfigError('%s: %s has an invalid regex %r: %s' % ('.'.join(path), name, value, e))
+
+def _redirect_order(name):
+    """Redirects with integer names run in numeric order, before any others (in lexical order)."""
+    if name.isdigit():
+        return (0, int(name), name)
+    return (1, 0, name)
+
+def compile_verify(path, name, value):
+    value = _as_list(path, name, value, (2, 3))
+    timeout = None
+    if len(value) == 3:
+        try:
+            timeout = float(value[2])
+        except ValueError:
+            raise ScreenConfigError('%s: %s has an invalid timeout %r' % ('.'.join(path), name, value[2]))
+    ## DOTALL, as pexpect would compile a pattern given as a string
+    return Verify(_as_int(path, name, value[0]), _as_regex(path, name, value[1], re.DOTALL), timeout)
+
+def compile_redirect(path, name, value):
+    if not isinstance(value, list):
+        value = [value]
+    if not value:
+        raise ScreenConfigError('%s: redirect_%s is empty' % ('.'.join(path), name))
+    kind = value[0]
+    if kind == 'regex':
+        _as_list(path, 'redirect_' + name, value, (6,))
+        lineno, startcol, length = [ _as_int(path, 'redirect_' + name, n) for n in value[1:4] ]
+        return Redirect(name, kind, lineno, startcol, length,
+                        pattern=_as_regex(path, 'redirect_' + name, value[4]), target=value[5])
+    elif kind == 'always':
+        _as_list(path, 'redirect_' + name, value, (2,))
+        return Redirect(name, kind, target=value[1])
+    elif kind == 'error':
+        return Redirect(name, kind, args=tuple(value[1:]))
+    raise ScreenConfigError('%s: unknown redirect evaluation type %r' % ('.'.join(path), kind))
+
+def compile_capture(path, name, value):
+    if not isinstance(value, list) or not value or value[0] != 'fixedpos':
+        raise ScreenConfigError('%s: unknown data retrieval type for data__%s: %r' % ('.'.join(path), name, value))
+    _as_list(path, 'data__' + name, value, (5,))
+    lineno, startcol, length, strip = [ _as_int(path, 'data__' + name, n) for n in value[1:] ]
+    return Capture(name, lineno, startcol, length, bool(strip))
+
+def _own_captures(screens, class_name, state, substate):
+    section = _section(screens, class_name, state, substate)
+    if section is None:
+        return [], None
+    path = ['screens', class_name, state, substate]
+    captures = []
+    for key in section.keys():
+        if key.startswith('data__'):
+            captures.append(compile_capture(path, key[len('data__'):], section[key]))
+    return captures, section.get('inherit_from')
+
+def _section(screens, *path):
+    for element in path:
+        if not isinstance(screens, dict) or not element in screens:
+            return None
+        screens = screens[element]
+    if not isinstance(screens, dict):
+        return None
+    return screens
+
+def compile_screen(screens, class_name, state, substate):
+    """Compile the definition of a single screen from the given [screens] section."""
+    path = ['screens', class_name, state, substate]
+    section = _section(screens, class_name, state, substate)
+    if section is None:
+        return EMPTY_SCREEN
+    verifies = []
+    redirects = []
+    for key in section.keys():
+        if key.startswith('verify_'):
+            verifies.append(compile_verify(path, key, section[key]))
+        elif key.startswith('redirect_'):
+            name = key[len('redirect_'):]
+            redirects.append((_redirect_order(name), compile_redirect(path, name, section[key])))
+    redirects.sort()
+    captures = []
+    seen = [state]
+    while True:
+        own_captures, inherit_from = _own_captures(screens, class_name, state, substate)
+        captures.extend(own_captures)
+        if inherit_from is None:
+            break
+        if inherit_from in seen:
+            raise ScreenConfigError('%s: inherit_from loops back to %s' % ('.'.join(path), inherit_from))
+        seen.append(inherit_from)
+        state = inherit_from
+    return ScreenSpec(tuple(path[1:]), verifies, [ redirect for order, redirect in redirects ], captures)
+
+def compile_screens(screens):
+    """Compile every screen defined in the given [screens] section (which may be None). Returns a dict mapping (class name, state, substate) to ScreenSpec; raises ScreenConfigError if any definition is malformed."""
+    specs = {}
+    if screens is None:
+        return specs
+    for class_name, states in screens.items():
+        if not isinstance(states, dict):
+            continue
+        for state, substates in states.items():
+            if not isinstance(substates, dict):
+                continue
+            for substate, section in substates.items():
+                if not isinstance(section, dict):
+                    continue
+                specs[(class_name, state, substate)] = compile_screen(screens, class_name, state, substate)
+    return specs
+
+# vim: sw=4 ts=4 sts=4 sta et ai
@@ -0,0 +1,302 @@
+"""A pool of pre-spawned, logged-in pxtty children, and a reaper which
+disposes of finished children without blocking their owner.
+
+A SpawnPool keeps up to size children ready from a background thread:
+each is spawned, taken through a scripted login (pairs of a pattern to
+wait for on screen and text to send), and then health-checked against
+a verify screen. acquire() hands a ready child over at once (after
+checking, without waiting, that it is still alive), so neither the
+fork/exec nor the login is on the critical path of a request; ready
+children are verified afresh in the background every check_interval.
+
+ChildReaper terminates children and collects their exit status from a
+thread of its own, escalating from SIGTERM to SIGKILL if a child outlives
+its grace period.
+"""
+
+import errno
+import logging
+import os
+import signal
+import threading
+import time
+
+from pexpect import EOF, TIMEOUT
+
+__all__ = ['SpawnPool', 'ChildReaper', 'reaper']
+
+logger = logging.getLogger(__name__)
+
+class ChildReaper(object):
+    """Terminates children (pexpect spawn objects) and reaps them in the background."""
+    def __init__(self, grace=5.0, interval=0.1):
+        self.grace = grace
+        self.interval = interval
+        self.__condition = threading.Condition()
+        self.__pending = []               ## (child, time SIGTERM was sent, SIGKILL sent?)
+        self.__thread = None
+    def reap(self, child):
+        """Send child SIGTERM, and see that it is waited for (and killed outright after the grace period). A child with no process (such as a replay) is simply closed."""
+        if child.pid is None:
+            child.close()
+            return
+        self.__signal(child, signal.SIGTERM)
+        self.__condition.acquire()
+        try:
+            self.__pending.append((child, time.time(), False))
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name='ChildReaper')
+                self.__thread.setDaemon(True)
+                self.__thread.start()
+            self.__condition.notify()
+        finally:
+            self.__condition.release()
+    def __len__(self):
+        return len(self.__pending)
+    def __signal(self, child, signum):
+        try:
+            os.kill(child.pid, signum)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                logger.error('Unable to kill process %s: %s' % (child.pid, str(e)))
+    def __collect(self, child):
+        """Return True once child has exited (and release its pty)."""
+        try:
+            pid, status = os.waitpid(child.pid, os.WNOHANG)
+        except OSError, e:
+            if e.errno != errno.ECHILD:
+                raise
+            pid = child.pid               ## already reaped, e.g. by isalive()
+        if pid == 0:
+            return False
+        if not child.closed:
+            try:
+                os.close(child.child_fd)
+            except OSError:
+                pass
+            child.closed = True
+        return True
+    def __run(self):
+        while True:
+            self.__condition.acquire()
+            try:
+                while not self.__pending:
+                    self.__condition.wait()
+                pending, self.__pending = self.__pending, []
+            finally:
+                self.__condition.release()
+            remaining = []
+            now = time.time()
+            for child, since, killed in pending:
+                try:
+                    if self.__collect(child):
+                        continue
+                except Exception, e:
+                    logger.exception(e)
+                    continue
+                if not killed and now - since > self.grace:
+                    self.__signal(child, signal.SIGKILL)
+                    killed = True
+                remaining.append((child, since, killed))
+            self.__condition.acquire()
+            try:
+                self.__pending.extend(remaining)
+            finally:
+                self.__condition.release()
+            if remaining:
+                time.sleep(self.interval)
+
+## shared by every connection
+reaper = ChildReaper()
+
+class SpawnPool(object):
+    """Keeps up to size children, made by spawn(), logged in and ready.
+
+    login is a sequence of (pattern, text) pairs: for each, the child's
+    screen is waited on for a line matching pattern, and text sent.
+    verifies is a sequence of screens.Verify, all of which must pass for
+    a child to be considered healthy; each is given verify_timeout seconds
+    unless it has a timeout of its own. Ready children are checked to be
+    healthy every check_interval seconds, and to be alive as they are
+    handed out.
+    """
+    def __init__(self, spawn, size=2, login=(), verifies=(), verify_timeout=10.0, settle_time=0.5, check_interval=5.0):
+        self.spawn = spawn
+        self.size = size
+        self.login = tuple(login)
+        self.verifies = tuple(verifies)
+        self.verify_timeout = verify_timeout
+        self.settle_time = settle_time
+        self.check_interval = check_interval
+        self.__condition = threading.Condition()
+        self.__ready = []
+        self.__stopped = False
+        self.__thread = None
+        self.__next_sweep = 0             ## when the ready children are next health-checked
+    def start(self):
+        """Start warming children from a daemon thread (if not already started)."""
+        self.__condition.acquire()
+        try:
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name='SpawnPool')
+                self.__thread.setDaemon(True)
+                self.__thread.start()
+        finally:
+            self.__condition.release()
+    def stop(self):
+        """Stop warming, and reap any children still waiting."""
+        self.__condition.acquire()
+        try:
+            self.__stopped = True
+            ready, self.__ready = self.__ready, []
+            self.__condition.notifyAll()
+        finally:
+            self.__condition.release()
+        for child in ready:
+            reaper.reap(child)
+    def ready(self):
+        """Return the number of children ready to hand out."""
+        return len(self.__ready)
+    def acquire(self, timeout=0):
+        """Return a ready, healthy child, waiting up to timeout seconds for one; or None if there is none, in which case the caller should spawn its own."""
+        end_time = time.time() + timeout
+        while True:
+            self.__condition.acquire()
+            try:
+                while not self.__ready and not self.__stopped:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        break
+                    self.__condition.wait(remaining)
+                if not self.__ready:
+                    return None
+                child = self.__ready.pop(0)
+                self.__condition.notifyAll()      ## wake the warmer to replace it
+            finally:
+                self.__condition.release()
+            if self.alive(child):
+                return child
+            reaper.reap(child)
+    def alive(self, child, max_reads=16):
+        """Return True if child is alive and has not closed its end, without waiting on it: the check made as a child is handed out. Any output waiting is read (and so reaches the child's terminal), up to max_reads reads."""
+        try:
+            if not child.isalive():
+                return False
+            for i in range(max_reads):
+                child.read_nonblocking(child.maxread, timeout=0)
+        except TIMEOUT:
+            pass
+        except EOF, e:
+            logger.info('Pooled child %s has closed its end: %s', child.pid, e)
+            return False
+        return True
+    def check(self, child, settle_time=None):
+        """Return True if child is alive and showing the verify screen."""
+        if settle_time is None:
+            settle_time = self.settle_time
+        try:
+            if not child.isalive():
+                return False
+            if settle_time:
+                child.expect_delay(delay_time=settle_time, timeout=self.verify_timeout)
+            for verify in self.verifies:
+                timeout = verify.timeout
+                if timeout is None:
+                    timeout = self.verify_timeout
+                child.expect_line_matching_list([verify.pattern], lineno=verify.lineno, timeout=timeout)
+        except (TIMEOUT, EOF), e:
+            logger.info('Pooled child %s failed its health check: %s', child.pid, e)
+            return False
+        return True
+    def warm(self):
+        """Spawn and log in one child; return it if it passes its health check, else reap it and return None."""
+        child = self.spawn()
+        try:
+            for pattern, text in self.login:
+                child.expect_line_matching(pattern, timeout=self.verify_timeout)
+                child.send(text)
+        except (TIMEOUT, EOF), e:
+            logger.info('Pooled child %s failed to log in: %s', child.pid, e)
+            reaper.reap(child)
+            return None
+        if not self.check(child):
+            reaper.reap(child)
+            return None
+        return child
+    def __prune(self):
+        """Reap any ready children which have died, and, every check_interval, any which fail their health check."""
+        self.__condition.acquire()
+        try:
+            dead = [ child for child in self.__ready if not child.isalive() ]
+            for child in dead:
+                self.__ready.remove(child)
+            waiting = self.__ready[:]
+        finally:
+            self.__condition.release()
+        for child in dead:
+            logger.info('Pooled child %s died while waiting', child.pid)
+            reaper.reap(child)
+        if time.time() < self.__next_sweep:
+            return
+        for child in waiting:
+            ## taken out while it is checked, so that it is not handed out meanwhile
+            self.__condition.acquire()
+            try:
+                if not child in self.__ready:
+                    continue
+                self.__ready.remove(child)
+            finally:
+                self.__condition.release()
+            ## settling reads in whatever the child has sent while it waited
+            if not self.check(child):
+                reaper.reap(child)
+                continue
+            self.__condition.acquire()
+            try:
+                if self.__stopped:
+                    reaper.reap(child)
+                else:
+                    self.__ready.append(child)
+                    self.__condition.notifyAll()
+            finally:
+                self.__condition.release()
+        self.__next_sweep = time.time() + self.check_interval
+    def __run(self):
+        failures = 0
+        while True:
+            self.__condition.acquire()
+            try:
+                if self.__stopped:
+                    return
+                if len(self.__ready) >= self.size:
+                    self.__condition.wait(self.check_interval)
+                    needed = False
+                else:
+                    needed = True
+            finally:
+                self.__condition.release()
+            self.__prune()
+            if not needed:
+                continue
+            try:
+                child = self.warm()
+            except Exception, e:
+                logger.exception(e)
+                child = None
+            if child is None:
+                ## back off while the far end is refusing us
+                failures += 1
+                time.sleep(min(2 ** failures, 60) * 0.1)
+                continue
+            failures = 0
+            self.__condition.acquire()
+            try:
+                if self.__stopped:
+                    reaper.reap(child)
+                    return
+                self.__ready.append(child)
+                self.__condition.notifyAll()
+            finally:
+                self.__condition.release()
+
+# vim: sw=4 ts=4 sts=4 sta et ai
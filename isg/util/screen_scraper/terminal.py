@@ -0,0 +1,228 @@
+"""Terminal emulators for use with pxtty which keep track of which screen
+rows have changed, so that consumers need only re-examine those rows;
+and FieldPlans, for capturing many fixed-position fields in one pass.
+
+"""
+
+import ANSI
+import array
+import logging
+
+__all__ = ['TrackingANSI', 'ArrayANSI', 'FieldPlan', 'capture_fields', 'screen_text']
+
+logger = logging.getLogger(__name__)
+
+def log_unhandled(fsm):
+    """In place of ANSI.DoLog, which appends every escape sequence it does not handle to a file named log in the current directory: discard the sequence as DoLog does, but log it at debug level."""
+    fsm.memory = [fsm.memory[0]]
+    logger.debug('Unhandled escape sequence: %r in state %s', fsm.input_symbol, fsm.current_state)
+
+def quiet_unhandled(fsm):
+    """Replace every DoLog action of the FSM with log_unhandled."""
+    for table in (fsm.state_transitions, fsm.state_transitions_any):
+        for key, (action, next_state) in table.items():
+            if action is ANSI.DoLog:
+                table[key] = (log_unhandled, next_state)
+    if fsm.default_transition is not None and fsm.default_transition[0] is ANSI.DoLog:
+        fsm.default_transition = (log_unhandled, fsm.default_transition[1])
+
+def constrain(n, min, max):
+    if n < min:
+        return min
+    if n > max:
+        return max
+    return n
+
+class FieldPlan(object):
+    """A precompiled list of fixed-position fields to capture in one pass.
+
+    fields is a sequence of (name, lineno, startcol, length, strip) tuples,
+    with lineno and startcol indexed from 1. Each field covers the same
+    text as get_region(lineno, startcol, lineno, startcol+length) would.
+    """
+    def __init__(self, fields):
+        self.fields = tuple([ tuple(field) for field in fields ])
+        self._offsets = {}
+    def __len__(self):
+        return len(self.fields)
+    def offsets(self, rows, cols):
+        """Return (name, start, end, strip) tuples giving each field's slice of a rows x cols screen laid out row after row."""
+        try:
+            return self._offsets[(rows, cols)]
+        except KeyError:
+            pass
+        offsets = []
+        for name, lineno, startcol, length, strip in self.fields:
+            row = constrain(lineno, 1, rows) - 1
+            cs = constrain(startcol, 1, cols)
+            ce = constrain(startcol + length, 1, cols)
+            if cs > ce:
+                cs, ce = ce, cs
+            offsets.append((name, row * cols + cs - 1, row * cols + ce, strip))
+        offsets = self._offsets[(rows, cols)] = tuple(offsets)
+        return offsets
+    def capture(self, screen, rows, cols):
+        """Capture every field from screen, the contents of a rows x cols terminal as a single string. Returns a dict mapping field names to their text."""
+        retval = {}
+        for name, start, end, strip in self.offsets(rows, cols):
+            if strip:
+                retval[name] = screen[start:end].strip()
+            else:
+                retval[name] = screen[start:end]
+        return retval
+
+def capture_fields(term, plan):
+    """Capture the fields of plan from term, in one pass if term supports it."""
+    if hasattr(term, 'capture_fields'):
+        return term.capture_fields(plan)
+    retval = {}
+    for name, lineno, startcol, length, strip in plan.fields:
+        text = term.get_region(lineno, startcol, lineno, startcol+length)[0]
+        if strip:
+            text = text.strip()
+        retval[name] = text
+    return retval
+
+def screen_text(term):
+    """Return the whole screen of term as a single string, row after row."""
+    if hasattr(term, 'dump_screen'):
+        return term.dump_screen()
+    return ''.join(term.dump_rows())
+
+class TrackingANSI(ANSI.ANSI):
+    """An ANSI terminal which keeps a version number for every row.
+
+    self.version is incremented on every change to the screen, and
+    self.row_versions[n] holds the version at which (0-indexed) row n was
+    last changed; changed_rows() uses these to report what has changed
+    since a given version. Row text returned by dump_row() is cached
+    until the row next changes.
+    """
+    def __init__(self, r=24, c=80):
+        self.version = 0
+        self.row_versions = [0] * r
+        self._row_text = [None] * r
+        self._row_text_versions = [-1] * r
+        self._screen_text = None
+        self._screen_text_version = -1
+        ANSI.ANSI.__init__(self, r, c)
+        quiet_unhandled(self.state)
+    def _touch_rows(self, start, end):
+        """Mark (0-indexed) rows start through end, inclusive, as changed."""
+        self.version += 1
+        version = self.version
+        row_versions = self.row_versions
+        for n in range(start, end + 1):
+            row_versions[n] = version
+    def put_abs(self, r, c, ch):
+        ANSI.ANSI.put_abs(self, r, c, ch)
+        self.version += 1
+        self.row_versions[constrain(r, 1, self.rows) - 1] = self.version
+    def scroll_up(self):
+        ANSI.ANSI.scroll_up(self)
+        self._touch_rows(self.scroll_row_start - 1, self.scroll_row_end - 1)
+    def scroll_down(self):
+        ANSI.ANSI.scroll_down(self)
+        self._touch_rows(self.scroll_row_start - 1, self.scroll_row_end - 1)
+    def changed_rows(self, since_version):
+        """Return the (0-indexed) numbers of the rows changed after since_version."""
+        return [ n for n, version in enumerate(self.row_versions)
+                 if version > since_version ]
+    def dump_row(self, n):
+        """Return the text of (0-indexed) row n."""
+        version = self.row_versions[n]
+        if self._row_text_versions[n] != version:
+            self._row_text[n] = self._render_row(n)
+            self._row_text_versions[n] = version
+        return self._row_text[n]
+    def dump_rows(self):
+        return [ self.dump_row(n) for n in range(self.rows) ]
+    def dump_screen(self):
+        """Return the whole screen as a single string, row after row."""
+        if self._screen_text_version != self.version:
+            self._screen_text = self._render_screen()
+            self._screen_text_version = self.version
+        return self._screen_text
+    def capture_fields(self, plan):
+        """Capture every field of a FieldPlan; see FieldPlan.capture."""
+        return plan.capture(self.dump_screen(), self.rows, self.cols)
+    def _render_row(self, n):
+        return ''.join(self.w[n])
+    def _render_screen(self):
+        return ''.join(self.dump_rows())
+
+class ArrayANSI(TrackingANSI):
+    """A TrackingANSI keeping the screen in a single contiguous character
+    array (self.buf, row after row) rather than in nested lists.
+
+    row_view() exposes rows as zero-copy buffer slices, and rendering a
+    row or the whole screen is a single copy out of the array. This is
+    a drop-in replacement for ANSI.ANSI, except that self.w is not
+    maintained.
+    """
+    def __init__(self, r=24, c=80):
+        TrackingANSI.__init__(self, r, c)
+        self.buf = array.array('c', ' ' * (r * c))
+        self.w = None
+    def __str__(self):
+        return '\n'.join(self.dump_rows())
+    def dump(self):
+        return self.dump_screen()
+    def row_view(self, n):
+        """Return a read-only, zero-copy view of (0-indexed) row n. The view reflects later changes to the row."""
+        return buffer(self.buf, n * self.cols, self.cols)
+    def _render_row(self, n):
+        return self.row_view(n)[:]
+    def _render_screen(self):
+        return self.buf.tostring()
+    def put_abs(self, r, c, ch):
+        r = constrain(r, 1, self.rows)
+        c = constrain(c, 1, self.cols)
+        self.buf[(r-1) * self.cols + c-1] = str(ch)[0]
+        self.version += 1
+        self.row_versions[r-1] = self.version
+    def get_abs(self, r, c):
+        r = constrain(r, 1, self.rows)
+        c = constrain(c, 1, self.cols)
+        return self.buf[(r-1) * self.cols + c-1]
+    def get_region(self, rs, cs, re, ce):
+        rs = constrain(rs, 1, self.rows)
+        re = constrain(re, 1, self.rows)
+        cs = constrain(cs, 1, self.cols)
+        ce = constrain(ce, 1, self.cols)
+        if rs > re:
+            rs, re = re, rs
+        if cs > ce:
+            cs, ce = ce, cs
+        cols = self.cols
+        return [ buffer(self.buf, (r-1) * cols + cs-1, ce - cs + 1)[:]
+                 for r in range(rs, re + 1) ]
+    def fill_region(self, rs, cs, re, ce, ch=' '):
+        rs = constrain(rs, 1, self.rows)
+        re = constrain(re, 1, self.rows)
+        cs = constrain(cs, 1, self.cols)
+        ce = constrain(ce, 1, self.cols)
+        if rs > re:
+            rs, re = re, rs
+        if cs > ce:
+            cs, ce = ce, cs
+        cols = self.cols
+        fill = array.array('c', str(ch)[0] * (ce - cs + 1))
+        for r in range(rs, re + 1):
+            start = (r-1) * cols + cs-1
+            self.buf[start:start + len(fill)] = fill
+        self._touch_rows(rs - 1, re - 1)
+    def scroll_up(self):
+        s = self.scroll_row_start - 1
+        e = self.scroll_row_end - 1
+        cols = self.cols
+        self.buf[s * cols:e * cols] = self.buf[(s+1) * cols:(e+1) * cols]
+        self._touch_rows(s, e)
+    def scroll_down(self):
+        s = self.scroll_row_start - 1
+        e = self.scroll_row_end - 1
+        cols = self.cols
+        self.buf[(s+1) * cols:(e+1) * cols] = self.buf[s * cols:e * cols]
+        self._touch_rows(s, e)
+
+# vim: sw=4 ts=4 sts=4 sta et ai
@@ -1,74 +1,480 @@
-from types import MethodType
+from types import ClassType, MethodType
 
 from SimpleXMLRPCServer import SimpleXMLRPCServer
+import SocketServer
 import logging
 import pprint
+import random
+import re
+import sys
 import threading
+import time
 import xmlrpclib
 
-__all__ = [ 'runServer', 'ServerObject' ]
+from isg.util.config import ConfigWatcher, reparse
+
+__all__ = [
+    'runServer',
+    'runPoolServer',
+    'runConfiguredServer',
+    'pool_options',
+    'ServerObject',
+    'SessionPool',
+    'PoolServerObject',
+    'PoolBusy',
+]
+
+class PoolBusy(Exception): """Too many requests are already waiting for a free session"""
+
+## the form of the tokens given out by SessionPool.open_session
+sessionTokenRe = re.compile(r'^s[0-9a-f]{32}$')
+
+## faultCode of a call naming a session token which is not (or no longer) open
+UNKNOWN_SESSION = 2
+
+def _exposed_methods(clazz):
+    """Return a dict mapping the name of each exposed method of clazz to its docstring."""
+    methods = {}
+    for name in dir(clazz):
+        ## look on the class, so that properties aren't evaluated
+        m = getattr(clazz, name, None)
+        if isinstance(m, MethodType) and getattr(m, 'expose', False):
+            methods[name] = m.__doc__ or ''
+    return methods
 
 class ServerObject(object):
     def __init__(self, shared_object):
         self.so = shared_object
         self.__logger = logging.getLogger('XMLRPCServer.ServerObject')
         self.__lock = threading.Lock()
+        self.__registry = (None, {})      ## (class of self.so, registry built for it)
     
     ### XML-RPC server internals
+    def _registry(self):
+        """Return a dict mapping the name of each exposed method of the shared object to a (bound method, docstring) pair. The dict is rebuilt only when the shared object's class has changed (as Retargetable.inherit may do)."""
+        clazz = self.so.__class__
+        registry_class, registry = self.__registry
+        if registry_class is clazz:
+            return registry
+        registry = {}
+        for name, doc in _exposed_methods(clazz).items():
+            registry[name] = (getattr(self.so, name), doc)
+        self.__registry = (clazz, registry)
+        return registry
     def _listMethods(self):
         """Provide a list of available methods"""
-        retval = []
-        for name in dir(self.so):
-            m = getattr(self.so, name)
-            if isinstance(m, MethodType) and hasattr(m, 'expose') and m.expose:
-                retval.append(name)
+        retval = self._registry().keys()
+        retval.sort()
+        retval.append('system.batch')
         return retval
     def _method_is_exposed(self, method_name):
-        if not hasattr(self.so, method_name) \
-            or not isinstance(getattr(self.so, method_name), MethodType) \
-            or not hasattr(getattr(self.so, method_name), 'expose') \
-            or not getattr(getattr(self.so, method_name), 'expose'):
-                return False
-        return True
-    def _method_nameHelp(self, method_name):
+        return method_name in self._registry()
+    def _methodHelp(self, method_name):
         """Provide help info for a given method_name"""
-        if not self._method_is_exposed(method_name) \
-            or not hasattr(getattr(self.__class__, method_name), '__doc__'):
-                return ''
-        return getattr(getattr(self.__class__, method_name), '__doc__')
+        try:
+            return self._registry()[method_name][1]
+        except KeyError:
+            return ''
+    _method_nameHelp = _methodHelp
     def _dispatch(self, method_name, params):
         """Call a given method_name"""
-        if not self._method_is_exposed(method_name):
+        if method_name == 'system.batch':
+            return self._batch(*params)
+        try:
+            func = self._registry()[method_name][0]
+        except KeyError:
             raise Exception('method_name "%s" is not supported' % method_name)
-        func = getattr(self.so, method_name)
         self.__lock.acquire()
         try:
-            try:
-                return func(*params)
-            except Exception, e:
-                ## FIXME: We're trying to be type-agnostic, right? So this isn't permissible.
-                #errstr = 'Exception passing through; dumping state machine status'
-                #if hasattr(self.so, 'child') and self.so.child != None:
-                #   errstr += ('\n  before: %s\n  after: %s' %
-                #       (repr(self.so.child.before),repr(self.so.child.after)))
-                #errstr += '\n  Current state: %s' % repr(self.so.lastState)
-                #errstr += '\n  Using handlers from classes: %s' % repr(self.so.__class__.__bases__)
-                errstr = 'Exception passing through'
-                self.__logger.error(errstr)
-                self.__logger.exception(e)
-                raise
+            return self._call(func, params)
         finally:
             self.__lock.release()
+    def _try_lock(self):
+        """Take the lock if no call is in progress, returning True; else return False at once. Release it with _unlock."""
+        return self.__lock.acquire(False)
+    def _unlock(self):
+        self.__lock.release()
+    def _locked_call(self, func, *args):
+        """Call func (for example, to change the shared object's config) once no other call is in progress"""
+        self.__lock.acquire()
+        try:
+            return func(*args)
+        finally:
+            self.__lock.release()
+    def watch_config(self, filename, interval=2.0):
+        """Reload the shared object's config whenever filename changes, between calls; see ConfigWatcher."""
+        watcher = ConfigWatcher(filename, lambda: self._locked_call(self.so.config_reload), interval)
+        watcher.start()
+        return watcher
+    def _call(self, func, params):
+        """Call a given exposed method; the caller holds the lock"""
+        try:
+            return func(*params)
+        except Exception, e:
+            ## FIXME: We're trying to be type-agnostic, right? So this isn't permissible.
+            #errstr = 'Exception passing through; dumping state machine status'
+            #if hasattr(self.so, 'child') and self.so.child != None:
+            #   errstr += ('\n  before: %s\n  after: %s' %
+            #       (repr(self.so.child.before),repr(self.so.child.after)))
+            #errstr += '\n  Current state: %s' % repr(self.so.lastState)
+            #errstr += '\n  Using handlers from classes: %s' % repr(self.so.__class__.__bases__)
+            errstr = 'Exception passing through'
+            self.__logger.error(errstr)
+            self.__logger.exception(e)
+            raise
+    def _batch(self, calls, stop_on_error=False):
+        """Run a list of calls, given as for system.multicall ({'methodName': ..., 'params': [...]} structs), holding the lock throughout so that no other request is interleaved. Returns a list with, for each call, either a single-item list holding its result or a fault struct. If stop_on_error is true, calls after the first fault are not run (and have no entry)."""
+        results = []
+        self.__lock.acquire()
+        try:
+            for call in calls:
+                try:
+                    method_name = call['methodName']
+                    params = call.get('params', [])
+                    try:
+                        func = self._registry()[method_name][0]
+                    except KeyError:
+                        raise Exception('method_name "%s" is not supported' % method_name)
+                    results.append([self._call(func, params)])
+                    continue
+                except xmlrpclib.Fault, fault:
+                    results.append({'faultCode': fault.faultCode, 'faultString': fault.faultString})
+                except:
+                    exc_type, exc_value = sys.exc_info()[:2]
+                    results.append({'faultCode': 1, 'faultString': '%s:%s' % (exc_type, exc_value)})
+                if stop_on_error:
+                    break
+        finally:
+            self.__lock.release()
+        return results
+
+class SessionPool(object):
+    """A pool of up to size independent sessions, each wrapped in its own ServerObject.
+
+    Sessions are created with session_factory as they are first needed.
+    acquire() hands out a free session (waiting for one if need be, unless
+    queue_depth requests are already waiting); open_session() instead
+    reserves one under a token until close_session() is called. Sessions
+    left idle for more than idle_timeout seconds are closed (with
+    close_session_hook, which defaults to calling cmd_disconnect) by
+    reap_idle(). template_config, if given, is the ConfigObj sessions are
+    created with, whose file reload_config parses afresh.
+    """
+    def __init__(self, session_factory, size=4, idle_timeout=None, queue_depth=None, close_session_hook=None, template_config=None):
+        self.session_factory = session_factory
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.queue_depth = queue_depth
+        self.close_session_hook = close_session_hook
+        self.__logger = logging.getLogger('XMLRPCServer.SessionPool')
+        self.__condition = threading.Condition()
+        self.__count = 0                  ## sessions created and not yet closed
+        self.__open = []                  ## ServerObjects of every session created and not yet closed
+        self.__free = []                  ## ServerObjects not in use
+        self.__sticky = {}                ## token -> ServerObject
+        self.__last_used = {}             ## ServerObject -> time last released
+        self.__waiting = 0
+        self.config = None                ## config last reloaded into every session, if any
+        self.template_config = template_config
+    def acquire(self, timeout=None):
+        """Return a free session's ServerObject, creating a session if there is room. Raises PoolBusy if queue_depth requests are already waiting, or if no session comes free within timeout seconds."""
+        self.__condition.acquire()
+        try:
+            if not self.__free and self.__count >= self.size:
+                if self.queue_depth is not None and self.__waiting >= self.queue_depth:
+                    raise PoolBusy('%d requests already waiting for a session' % self.__waiting)
+                if timeout is not None:
+                    end_time = time.time() + timeout
+                self.__waiting += 1
+                try:
+                    while not self.__free and self.__count >= self.size:
+                        if timeout is None:
+                            self.__condition.wait()
+                        else:
+                            remaining = end_time - time.time()
+                            if remaining <= 0:
+                                raise PoolBusy('No session came free within %r seconds' % timeout)
+                            self.__condition.wait(remaining)
+                finally:
+                    self.__waiting -= 1
+            if self.__free:
+                return self.__free.pop()
+            self.__count += 1
+        finally:
+            self.__condition.release()
+        try:
+            session = self.session_factory()
+            if self.config is not None:
+                session.config_reload(self.config)
+            so = ServerObject(session)
+        except:
+            self.__condition.acquire()
+            try:
+                self.__count -= 1
+                self.__condition.notify()
+            finally:
+                self.__condition.release()
+            raise
+        self.__condition.acquire()
+        try:
+            self.__open.append(so)
+        finally:
+            self.__condition.release()
+        return so
+    def release(self, so):
+        """Return a session acquired with acquire() to the pool."""
+        self.__condition.acquire()
+        try:
+            self.__last_used[so] = time.time()
+            self.__free.append(so)
+            self.__condition.notify()
+        finally:
+            self.__condition.release()
+    def open_session(self):
+        """Reserve a session for the caller's exclusive use; returns the token identifying it."""
+        so = self.acquire()
+        self.__condition.acquire()
+        try:
+            token = 's%032x' % random.getrandbits(128)     ## as matched by sessionTokenRe
+            self.__sticky[token] = so
+            self.__last_used[so] = time.time()
+        finally:
+            self.__condition.release()
+        return token
+    def sticky_session(self, token):
+        """Return the ServerObject reserved under token, or None if there is none."""
+        self.__condition.acquire()
+        try:
+            so = self.__sticky.get(token)
+            if so is not None:
+                self.__last_used[so] = time.time()
+            return so
+        finally:
+            self.__condition.release()
+    def close_session(self, token):
+        """Return the session reserved under token to the pool."""
+        self.__condition.acquire()
+        try:
+            so = self.__sticky.pop(token)
+        finally:
+            self.__condition.release()
+        self.release(so)
+    def session_class(self):
+        """Return the class of the sessions served, as far as it can be known without creating one: that of an open session, else session_factory if it is a class, else None."""
+        sessions = self.sessions()
+        if sessions:
+            return sessions[0].so.__class__
+        if isinstance(self.session_factory, (type, ClassType)):
+            return self.session_factory
+        return None
+    def sessions(self):
+        """Return the ServerObjects of every session currently open."""
+        self.__condition.acquire()
+        try:
+            return self.__open[:]
+        finally:
+            self.__condition.release()
+    def reap_idle(self):
+        """Close any free or reserved session left idle for more than idle_timeout seconds. A session with a call in progress is never idle, however long ago the call began."""
+        if self.idle_timeout is None:
+            return
+        cutoff = time.time() - self.idle_timeout
+        idle = []                         ## ServerObjects to close, each locked against calls until it is
+        self.__condition.acquire()
+        try:
+            for so in self.__free[:]:
+                if self.__last_used.get(so, 0) < cutoff and so._try_lock():
+                    self.__free.remove(so)
+                    idle.append(so)
+            for token, so in self.__sticky.items():
+                if self.__last_used.get(so, 0) < cutoff and so._try_lock():
+                    del self.__sticky[token]
+                    idle.append(so)
+            for so in idle:
+                self.__last_used.pop(so, None)
+                self.__open.remove(so)
+            self.__count -= len(idle)
+            self.__condition.notifyAll()
+        finally:
+            self.__condition.release()
+        for so in idle:
+            self.__logger.info('closing idle session %r', so.so)
+            try:
+                try:
+                    self._close(so.so)
+                except Exception, e:
+                    self.__logger.error('Unable to close idle session %r', so.so)
+                    self.__logger.exception(e)
+            finally:
+                so._unlock()
+    def _close(self, session):
+        if self.close_session_hook is not None:
+            self.close_session_hook(session)
+        elif hasattr(session, 'cmd_disconnect'):
+            session.cmd_disconnect()
+    def reload_config(self, config=None):
+        """Swap a new config (by default, that of the sessions' config file parsed afresh) into every session, each as soon as it is between calls; sessions created later get it too. Returns the new config. With no config given, one must have been reloaded before, or a session be open, or the pool have a template_config, to find the file by."""
+        sessions = self.sessions()
+        if config is None:
+            if self.config is not None:
+                config = reparse(self.config)
+            elif self.template_config is not None:
+                config = reparse(self.template_config)
+            elif sessions:
+                config = reparse(sessions[0].so.config)
+            else:
+                raise Exception('No config file to reload: no session is open, and the pool has no template_config')
+        for so in sessions:
+            so._locked_call(so.so.config_reload, config)
+        self.config = config
+        return config
+    def watch_config(self, filename, interval=2.0):
+        """Reload every session's config whenever filename changes; see ConfigWatcher."""
+        watcher = ConfigWatcher(filename, self.reload_config, interval)
+        watcher.start()
+        return watcher
+    def start_reaper(self):
+        """Start a daemon thread calling reap_idle() periodically (if idle_timeout is set)."""
+        if self.idle_timeout is None:
+            return None
+        def reaper():
+            while True:
+                time.sleep(max(self.idle_timeout / 2.0, 1))
+                self.reap_idle()
+        thread = threading.Thread(target=reaper, name='SessionPool reaper')
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+class PoolServerObject(object):
+    """Dispatches XML-RPC calls to the sessions of a SessionPool.
+
+    A plain call (e.g. image_screen) runs on any free session. Calling
+    session.open returns a token reserving a session; calls named
+    <token>.<method> then always run on that session, until
+    session.close(token) is called; once it is closed (or reaped as idle),
+    such calls fail with a Fault whose faultCode is UNKNOWN_SESSION.
+    pool.reload_config reloads the config of every session.
+
+    The calls of a system.multicall are routed one by one, and so may land
+    on different sessions unless they are named with a token; the calls of
+    a system.batch always run together on a single session.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+    def _exposed_methods(self):
+        """Return the exposed methods of the pool's sessions, by their class (see SessionPool.session_class), so that no session need be acquired, or created, to answer introspection."""
+        clazz = self.pool.session_class()
+        if clazz is None:
+            return {}
+        return _exposed_methods(clazz)
+    def _listMethods(self):
+        """Provide a list of available methods"""
+        methods = self._exposed_methods().keys()
+        methods.sort()
+        return ['session.open', 'session.close', 'pool.reload_config'] + methods + ['system.batch']
+    def _methodHelp(self, method_name):
+        """Provide help info for a given method_name"""
+        return self._exposed_methods().get(method_name, '')
+    def _dispatch(self, method_name, params):
+        """Call a given method_name on a pooled session"""
+        if method_name == 'session.open':
+            return self.pool.open_session()
+        if method_name == 'session.close':
+            self.pool.close_session(*params)
+            return True
+        if method_name == 'pool.reload_config':
+            self.pool.reload_config()
+            return True
+        if '.' in method_name and not method_name.startswith('system.'):
+            token, name = method_name.split('.', 1)
+            so = self.pool.sticky_session(token)
+            if so is not None:
+                try:
+                    return so._dispatch(name, params)
+                finally:
+                    ## idle time runs from the end of a call, not its start
+                    self.pool.sticky_session(token)
+            if sessionTokenRe.match(token):
+                ## closed, or reaped as idle; running the call on any other session would be wrong
+                raise xmlrpclib.Fault(UNKNOWN_SESSION, 'unknown or expired session token %r' % token)
+        so = self.pool.acquire()
+        try:
+            return so._dispatch(method_name, params)
+        finally:
+            self.pool.release(so)
+
+class ThreadingXMLRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+def pool_options(config):
+    """Read runPoolServer's options from the [Action] section of a ConfigMixIn: pool_size, pool_idle_timeout (seconds), pool_queue_depth and config_watch_interval (seconds). Its config becomes the pool's template_config."""
+    return {
+        'config_watch': config_watch(config),
+        'pool_size': config.config_get('Action', 'pool_size', isInteger=True, default=4),
+        'idle_timeout': config.config_get('Action', 'pool_idle_timeout', isFloat=True, default=None),
+        'queue_depth': config.config_get('Action', 'pool_queue_depth', isInteger=True, default=None),
+        'template_config': config.config,
+    }
+
+def config_watch(config):
+    """Return the (filename, interval) for watching the config file of a ConfigMixIn, given [Action] config_watch_interval; or None if it is not set."""
+    interval = config.config_get('Action', 'config_watch_interval', isFloat=True, default=None)
+    if not interval or not config.config.filename:
+        return None
+    return (config.config.filename, interval)
+
+def runPoolServer(session_factory, rpc_host, rpc_port, pool_size=4, idle_timeout=None, queue_depth=None, config_watch=None, template_config=None):
+    """Serve a pool of up to pool_size sessions, each created by session_factory, from a threading XML-RPC server. See PoolServerObject for how calls are routed. config_watch may give a (filename, interval) to watch for config changes; template_config is as for SessionPool."""
+    pool = SessionPool(session_factory, size=pool_size, idle_timeout=idle_timeout, queue_depth=queue_depth, template_config=template_config)
+    pool.start_reaper()
+    if config_watch is not None:
+        pool.watch_config(*config_watch)
+    server = ThreadingXMLRPCServer((rpc_host, rpc_port))
+    server.register_introspection_functions()
+    server.register_multicall_functions()
+    server.register_instance(PoolServerObject(pool))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        for so in pool.sessions():
+            pool._close(so.so)
+
+def runConfiguredServer(config, session_factory, rpc_host, rpc_port):
+    """Serve sessions created by session_factory as [Action] mode in the given ConfigMixIn directs:
+
+    xmlrpc           a single session over XML-RPC (runServer)
+    xmlrpc_pool      a pool of sessions over XML-RPC (runPoolServer)
+    framed           a single session over the framed transport (see isg.util.xmlrpc.framed)
+    framed_pool      a pool of sessions over the framed transport
+
+    The framed modes listen on the Unix socket [Action] rpc_socket if it is set, else on rpc_host and rpc_port, and encode with [Action] rpc_codec (json by default)."""
+    mode = config.config_get('Action', 'mode', default='xmlrpc')
+    if mode == 'xmlrpc':
+        return runServer(session_factory(), rpc_host, rpc_port, config_watch(config))
+    if mode == 'xmlrpc_pool':
+        return runPoolServer(session_factory, rpc_host, rpc_port, **pool_options(config))
+    if mode in ('framed', 'framed_pool'):
+        from isg.util.xmlrpc import framed
+        address = config.config_get('Action', 'rpc_socket', default=None) or (rpc_host, rpc_port)
+        codec = config.config_get('Action', 'rpc_codec', default='json')
+        if mode == 'framed':
+            return framed.runFramedServer(session_factory(), address, codec, config_watch(config))
+        return framed.runFramedPoolServer(session_factory, address, codec, **pool_options(config))
+    raise KeyError('Action mode %r not defined' % mode)
 
-def runServer(shared_object, rpc_host, rpc_port):
+def runServer(shared_object, rpc_host, rpc_port, config_watch=None):
     so = ServerObject(shared_object)
+    if config_watch is not None:
+        so.watch_config(*config_watch)
     server = SimpleXMLRPCServer((rpc_host, rpc_port))
     server.register_introspection_functions()
+    server.register_multicall_functions()
     server.register_instance(so)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
-        ## FIXME: We're trying to be type-agnostic, right? So this isn't permissible.
-        so.do_disconnect()
+        if hasattr(shared_object, 'cmd_disconnect'):
+            shared_object.cmd_disconnect()
 
 # vim: sw=4 ts=4 sts=4 sta et ai
@@ -0,0 +1,279 @@
+"""A compact alternative to XML-RPC: length-prefixed frames over a TCP
+or Unix socket, encoded as JSON (or msgpack, where installed).
+
+Each frame is a 4-byte big-endian length followed by that many bytes of
+payload. A request is {"id": n, "method": name, "params": [...]}; its
+response is {"id": n, "result": value} or {"id": n, "error": {"faultCode":
+code, "faultString": text}}. A connection may carry any number of
+requests, one after another.
+
+Calls are dispatched through a ServerObject (or PoolServerObject), so the
+same expose-flagged methods, locking and session routing apply as over
+XML-RPC, as do system.batch, system.listMethods and system.methodHelp.
+FramedProxy is the client side, and raises xmlrpclib.Fault as
+ServerProxy would.
+
+JSON strings are encoded as latin-1, so that screen text of any bytes
+survives the trip, and arrive as byte strings again at the other end.
+"""
+
+import SocketServer
+import errno
+import logging
+import os
+import socket
+import stat
+import struct
+import sys
+import threading
+import xmlrpclib
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from isg.util.xmlrpc import ServerObject, SessionPool, PoolServerObject
+
+__all__ = [
+    'codecs',
+    'FramedProxy',
+    'FramedTCPServer',
+    'FramedUnixServer',
+    'makeFramedServer',
+    'runFramedServer',
+    'runFramedPoolServer',
+]
+
+HEADER_FORMAT = '>I'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+def _as_bytes(obj):
+    """Turn the unicode strings in a decoded JSON value back into byte strings, where they fit in latin-1."""
+    if isinstance(obj, unicode):
+        try:
+            return obj.encode('latin-1')
+        except UnicodeEncodeError:
+            return obj
+    if isinstance(obj, list):
+        return [ _as_bytes(item) for item in obj ]
+    if isinstance(obj, dict):
+        return dict([ (_as_bytes(key), _as_bytes(value)) for key, value in obj.items() ])
+    return obj
+
+def _json_dumps(obj):
+    return json.dumps(obj, encoding='latin-1', separators=(',', ':'))
+
+def _json_loads(payload):
+    return _as_bytes(json.loads(payload))
+
+## name -> (encode, decode)
+codecs = {
+    'json': (_json_dumps, _json_loads),
+}
+if msgpack is not None:
+    codecs['msgpack'] = (msgpack.packb, msgpack.unpackb)
+
+def _codec(name):
+    try:
+        return codecs[name]
+    except KeyError:
+        raise KeyError('RPC codec %r not available (have %s)' % (name, ', '.join(sorted(codecs.keys()))))
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            if chunks:
+                raise EOFError('connection closed mid-frame')
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def read_frame(sock):
+    """Read one frame's payload from sock; returns None if the connection was closed between frames."""
+    header = _recv_exactly(sock, HEADER_SIZE)
+    if header is None:
+        return None
+    size, = struct.unpack(HEADER_FORMAT, header)
+    if size > MAX_FRAME_SIZE:
+        raise ValueError('frame of %d bytes exceeds the %d byte limit' % (size, MAX_FRAME_SIZE))
+    payload = _recv_exactly(sock, size)
+    if payload is None:
+        raise EOFError('connection closed mid-frame')
+    return payload
+
+def write_frame(sock, payload):
+    sock.sendall(struct.pack(HEADER_FORMAT, len(payload)) + payload)
+
+class FramedRequestHandler(SocketServer.BaseRequestHandler):
+    """Serves the requests of one connection, in order, until the client closes it."""
+    def handle(self):
+        encode, decode = self.server.codec
+        dispatcher = self.server.dispatcher
+        logger = self.server.logger
+        while True:
+            try:
+                payload = read_frame(self.request)
+            except (EOFError, socket.error), e:
+                logger.info('dropping connection: %s', e)
+                return
+            if payload is None:
+                return
+            request_id = None
+            try:
+                request = decode(payload)
+                request_id = request.get('id')
+                method_name = str(request['method'])
+                params = request.get('params', [])
+                if method_name == 'system.listMethods':
+                    result = dispatcher._listMethods()
+                elif method_name == 'system.methodHelp':
+                    result = dispatcher._methodHelp(*params)
+                else:
+                    result = dispatcher._dispatch(method_name, params)
+                response = {'id': request_id, 'result': result}
+            except xmlrpclib.Fault, fault:
+                response = {'id': request_id, 'error': {'faultCode': fault.faultCode, 'faultString': fault.faultString}}
+            except:
+                exc_type, exc_value = sys.exc_info()[:2]
+                response = {'id': request_id, 'error': {'faultCode': 1, 'faultString': '%s:%s' % (exc_type, exc_value)}}
+            try:
+                write_frame(self.request, encode(response))
+            except socket.error, e:
+                logger.info('dropping connection: %s', e)
+                return
+
+class FramedTCPServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    def __init__(self, address, dispatcher, codec='json'):
+        self.dispatcher = dispatcher
+        self.codec = _codec(codec)
+        self.logger = logging.getLogger('FramedServer')
+        SocketServer.ThreadingTCPServer.__init__(self, address, FramedRequestHandler)
+    def server_bind(self):
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        SocketServer.ThreadingTCPServer.server_bind(self)
+
+class FramedUnixServer(SocketServer.ThreadingUnixStreamServer):
+    daemon_threads = True
+    def __init__(self, path, dispatcher, codec='json'):
+        self.dispatcher = dispatcher
+        self.codec = _codec(codec)
+        self.logger = logging.getLogger('FramedServer')
+        ## remove a socket left behind by an earlier server, but nothing else
+        try:
+            mode = os.lstat(path).st_mode
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise ValueError('%s exists and is not a socket' % path)
+            os.unlink(path)
+        SocketServer.ThreadingUnixStreamServer.__init__(self, path, FramedRequestHandler)
+
+def makeFramedServer(dispatcher, address, codec='json'):
+    """Return a server dispatching to the given ServerObject (or PoolServerObject). address is either a (host, port) pair or the path of a Unix socket."""
+    if isinstance(address, basestring):
+        return FramedUnixServer(address, dispatcher, codec)
+    return FramedTCPServer(address, dispatcher, codec)
+
+def runFramedServer(shared_object, address, codec='json', config_watch=None):
+    """The framed counterpart of runServer."""
+    so = ServerObject(shared_object)
+    if config_watch is not None:
+        so.watch_config(*config_watch)
+    server = makeFramedServer(so, address, codec)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        if hasattr(shared_object, 'cmd_disconnect'):
+            shared_object.cmd_disconnect()
+
+def runFramedPoolServer(session_factory, address, codec='json', pool_size=4, idle_timeout=None, queue_depth=None, config_watch=None, template_config=None):
+    """The framed counterpart of runPoolServer."""
+    pool = SessionPool(session_factory, size=pool_size, idle_timeout=idle_timeout, queue_depth=queue_depth, template_config=template_config)
+    pool.start_reaper()
+    if config_watch is not None:
+        pool.watch_config(*config_watch)
+    server = makeFramedServer(PoolServerObject(pool), address, codec)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        for so in pool.sessions():
+            pool._close(so.so)
+
+class _Method(object):
+    def __init__(self, proxy, name):
+        self.__proxy = proxy
+        self.__name = name
+    def __getattr__(self, name):
+        return _Method(self.__proxy, '%s.%s' % (self.__name, name))
+    def __call__(self, *params):
+        return self.__proxy._call(self.__name, params)
+
+class FramedProxy(object):
+    """Client for a framed server, used as xmlrpclib.ServerProxy is (proxy.image_screen(), proxy.system.batch([...]) and so on). One connection is kept open, and shared by any threads using the proxy."""
+    def __init__(self, address, codec='json', timeout=None):
+        self.__address = address
+        self.__encode, self.__decode = _codec(codec)
+        self.__timeout = timeout
+        self.__lock = threading.Lock()
+        self.__sock = None
+        self.__next_id = 0
+    def __connect(self):
+        if isinstance(self.__address, basestring):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(self.__timeout)
+        sock.connect(self.__address)
+        return sock
+    def close(self):
+        self.__lock.acquire()
+        try:
+            if self.__sock is not None:
+                self.__sock.close()
+                self.__sock = None
+        finally:
+            self.__lock.release()
+    def _call(self, method_name, params):
+        self.__lock.acquire()
+        try:
+            self.__next_id += 1
+            request = self.__encode({'id': self.__next_id, 'method': method_name, 'params': list(params)})
+            if self.__sock is None:
+                self.__sock = self.__connect()
+            try:
+                write_frame(self.__sock, request)
+                payload = read_frame(self.__sock)
+                if payload is None:
+                    raise EOFError('connection closed by server')
+            except:
+                self.__sock.close()
+                self.__sock = None
+                raise
+        finally:
+            self.__lock.release()
+        response = self.__decode(payload)
+        if 'error' in response:
+            error = response['error']
+            raise xmlrpclib.Fault(error['faultCode'], error['faultString'])
+        return response['result']
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _Method(self, name)
+
+# vim: sw=4 ts=4 sts=4 sta et ai
@@ -5,7 +5,7 @@ from setuptools import setup, find_packages
 setup(
     name = 'isg_state_machine_framework',
     version = '0.2',
-    packages = find_packages(),
+    packages = find_packages(exclude=['benchmarks', 'benchmarks.*', 'tests', 'tests.*']),
 )
 
 # vim: sw=4 ts=4 sts=4 sta et ai
@@ -0,0 +1,108 @@
+"""Running the benchmark flow against a fleet of fake hosts."""
+
+import logging
+import sys
+import threading
+import unittest
+
+from isg.util.fleet import FleetResult, host_config, read_hosts, run_fleet, run_session
+
+from benchmarks import flows
+
+class FleetScreens(flows.BenchScreens):
+    """The benchmark flow through one report, finishing with what it captured and the host it ran on."""
+    def do__MENU(self):
+        self.image_screen()
+        if not self.reports:
+            self.sendline('x')
+            self.exitStateMachine(retval={'captured': self.captured, 'host': self.config['Connect']['host']}, newState='DONE')
+        self.sendline(str(self.reports.pop(0)))
+        return 'REPORT'
+
+## the host is the fake host's seed; extra gives it more options
+TEMPLATE = flows.makeConfig('unused')
+TEMPLATE['Connect']['spawnString'] = flows.fakehostCommand(pages=1).replace('--seed 0', '--seed %(host)s') + ' %(extra)s'
+TEMPLATE['Connect']['extra'] = ''
+
+def makeSession():
+    FleetScreens.config = TEMPLATE
+    machine = flows.Machine()
+    machine.inherit(FleetScreens)
+    machine.send_delay = 0
+    machine.latencies = []
+    machine.steps = 0
+    machine.captured = 0
+    machine.reports = [1]
+    return machine
+
+class HostsTest(unittest.TestCase):
+    def testHostConfig(self):
+        config = host_config(TEMPLATE, '7')
+        self.assertEqual(config['Connect']['host'], '7')
+        self.failIf('host' in TEMPLATE['Connect'])
+        config = host_config(TEMPLATE, {'host': '8', 'extra': '--think 1'})
+        self.assertEqual((config['Connect']['host'], config['Connect']['extra']), ('8', '--think 1'))
+    def testHostConfigThreads(self):
+        ## the sessions of a worker each copy the template at once
+        errors = []
+        def copy(n):
+            for i in range(200):
+                host = '%d' % (n * 1000 + i)
+                spawnString = host_config(TEMPLATE, host)['Connect']['spawnString']
+                if not '--seed %s ' % host in spawnString:
+                    errors.append(spawnString)
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            threads = [ threading.Thread(target=copy, args=(n,)) for n in range(4) ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setcheckinterval(interval)
+        self.assertEqual(errors, [])
+        self.failUnless(TEMPLATE.interpolation)
+    def testReadHosts(self):
+        lines = ['# hosts', '', 'alpha', 'beta port=2323 user=me']
+        self.assertEqual(list(read_hosts(lines)), ['alpha', {'host': 'beta', 'port': '2323', 'user': 'me'}])
+        self.assertRaises(ValueError, list, read_hosts(['gamma port']))
+
+class RunTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+    def testRunSession(self):
+        ok, retval, error, timed_out, attempts = run_session(makeSession, host_config(TEMPLATE, '3'))
+        self.failUnless(ok, error)
+        self.assertEqual(retval['host'], '3')
+        self.failUnless(retval['captured'] > 0)
+        self.assertEqual(attempts, 1)
+    def testTimeoutAndRetry(self):
+        ## a host thinking for 3s per request cannot finish within the timeout
+        config = host_config(TEMPLATE, {'host': '4', 'extra': '--think 3'})
+        ok, retval, error, timed_out, attempts = run_session(makeSession, config, timeout=0.25, retries=1, retry_delay=0.05)
+        self.failIf(ok)
+        self.failUnless(timed_out)
+        self.assertEqual(attempts, 2)
+    def testRunFleet(self):
+        hosts = ['1', '2', 'bogus', '4', '5', '6']
+        results = list(run_fleet(hosts, makeSession, TEMPLATE, workers=2, sessions_per_worker=2, max_pending=3))
+        self.assertEqual(sorted([ result.index for result in results ]), range(len(hosts)))
+        for result in results:
+            self.failUnless(isinstance(result, FleetResult))
+            self.assertEqual(result.host, hosts[result.index])
+            if result.host == 'bogus':
+                ## the fake host refuses a seed which is not a number
+                self.failIf(result.ok)
+                self.failUnless(result.error)
+            else:
+                self.failUnless(result.ok, (result.host, result.error))
+                self.assertEqual(result.retval['host'], result.host)
+        self.assertEqual(len(set([ result.worker for result in results ])), 2)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: sw=4 ts=4 sts=4 sta et ai
@@ -0,0 +1,92 @@
+"""LRUCache and GeneratedClassCache shared between threads."""
+
+import random
+import sys
+import threading
+import unittest
+
+from isg.util.lru import LRUCache
+from isg.state_machine import GeneratedClassCache, HandlerSet, Retargetable, StateMachineHandler
+
+class LoginScreens(HandlerSet):
+    def do__LOGIN(self): pass
+
+class MenuScreens(HandlerSet):
+    def do__MENU(self): pass
+
+class ReportScreens(HandlerSet):
+    def do__REPORT(self): pass
+
+class Machine(StateMachineHandler):
+    pass
+
+FAMILIES = [ (LoginScreens,), (MenuScreens,), (ReportScreens,), (MenuScreens, ReportScreens), (LoginScreens, MenuScreens) ]
+
+def hammer(target, threads=8):
+    """Run target(n) in threads threads at once, switching between them as often as possible; return the exceptions raised."""
+    errors = []
+    def run(n):
+        try:
+            target(n)
+        except Exception, e:
+            errors.append(e)
+    interval = sys.getcheckinterval()
+    sys.setcheckinterval(1)
+    try:
+        workers = [ threading.Thread(target=run, args=(n,)) for n in range(threads) ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        sys.setcheckinterval(interval)
+    return errors
+
+class LRUCacheThreadTest(unittest.TestCase):
+    def testConcurrentUse(self):
+        cache = LRUCache(4)
+        def use(n):
+            rng = random.Random(n)
+            for i in range(5000):
+                key = rng.randrange(8)
+                if cache.get(key) is None:
+                    cache[key] = i
+                if not i % 97:
+                    try:
+                        del cache[key]
+                    except KeyError:
+                        pass
+        self.assertEqual(hammer(use), [])
+        keys = cache.keys()
+        self.assertEqual(len(keys), len(set(keys)))
+        self.assertEqual(len(keys), len(cache))
+        self.failUnless(len(cache) <= 4)
+
+class GeneratedClassCacheThreadTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = Retargetable.generatedClasses
+        ## smaller than the families in use, so that classes are evicted and looked up again
+        Retargetable.generatedClasses = GeneratedClassCache(2)
+    def tearDown(self):
+        Retargetable.generatedClasses = self.saved
+    def testConcurrentInherit(self):
+        machines = [ Machine() for n in range(8) ]
+        def retarget(n):
+            machine = machines[n]
+            rng = random.Random(n)
+            for i in range(500):
+                family = rng.choice(FAMILIES)
+                machine.inherit(family)
+                self.failUnless(isinstance(machine, family[-1]))
+        self.assertEqual(hammer(retarget), [])
+        ## machines ending up with the same family share its class
+        classes = {}
+        for machine in machines:
+            family = machine.getRequestedClasses()
+            self.failUnless(classes.setdefault(family, machine.__class__) is machine.__class__)
+            self.failUnless(Retargetable.generatedClasses.get((Machine,) + family) is machine.__class__)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: sw=4 ts=4 sts=4 sta et ai
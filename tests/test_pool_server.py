@@ -0,0 +1,127 @@
+"""SessionPool and PoolServerObject, served over XML-RPC."""
+
+import configobj
+import itertools
+import threading
+import time
+import unittest
+import xmlrpclib
+
+from isg.util.config import ConfigMixIn
+from isg.util.xmlrpc import PoolServerObject, SessionPool, ThreadingXMLRPCServer, UNKNOWN_SESSION
+
+class Session(ConfigMixIn):
+    """A session which counts its calls, and can be made to block in one."""
+    config = configobj.ConfigObj({'General': {'greeting': 'hello'}})
+    serials = itertools.count(1)
+    def __init__(self):
+        self.serial = self.serials.next()
+        self.calls = 0
+        self.disconnected = False
+        self.proceed = threading.Event()
+        self.proceed.set()
+        self.blocked = threading.Event()
+    def whoami(self):
+        """Return the serial number of the session, and how many calls it has had."""
+        self.calls += 1
+        return [self.serial, self.calls]
+    whoami.expose = True
+    def greeting(self):
+        return self.config_get('General', 'greeting')
+    greeting.expose = True
+    def block(self):
+        self.blocked.set()
+        self.proceed.wait()
+        return True
+    block.expose = True
+    def cmd_disconnect(self):
+        self.disconnected = True
+
+class PoolServerTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = SessionPool(Session, size=2)
+        self.server = ThreadingXMLRPCServer(('127.0.0.1', 0), logRequests=False)
+        self.server.register_introspection_functions()
+        self.server.register_multicall_functions()
+        self.server.register_instance(PoolServerObject(self.pool))
+        thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        thread.setDaemon(True)
+        thread.start()
+        self.proxy = self.client()
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+    def client(self):
+        return xmlrpclib.ServerProxy('http://127.0.0.1:%d' % self.server.server_address[1])
+    def testPlainCall(self):
+        self.assertEqual(self.proxy.whoami()[1], 1)
+        self.assertEqual(self.proxy.greeting(), 'hello')
+        self.assertEqual(len(self.pool.sessions()), 1)
+    def testIntrospectionCreatesNoSession(self):
+        methods = self.proxy.system.listMethods()
+        for name in ['session.open', 'session.close', 'pool.reload_config', 'whoami', 'greeting', 'system.batch']:
+            self.failUnless(name in methods, name)
+        self.failIf('cmd_disconnect' in methods)
+        self.assertEqual(self.proxy.system.methodHelp('whoami'), Session.whoami.__doc__)
+        self.assertEqual(self.pool.sessions(), [])
+    def testStickySession(self):
+        token = self.proxy.session.open()
+        call = getattr(self.proxy, token + '.whoami')
+        first = call()
+        self.assertEqual(call(), [first[0], 2])
+        ## plain calls go to the other session, the reserved one not being free
+        self.assertNotEqual(self.proxy.whoami()[0], first[0])
+        self.proxy.session.close(token)
+    def testUnknownToken(self):
+        try:
+            getattr(self.proxy, 's%032x.whoami' % 0)()
+        except xmlrpclib.Fault, fault:
+            self.assertEqual(fault.faultCode, UNKNOWN_SESSION)
+        else:
+            self.fail('a call on an unknown token succeeded')
+        self.assertEqual(self.pool.sessions(), [])
+    def testClosedToken(self):
+        token = self.proxy.session.open()
+        self.proxy.session.close(token)
+        self.assertRaises(xmlrpclib.Fault, getattr(self.proxy, token + '.whoami'))
+    def testReapIdle(self):
+        self.pool.idle_timeout = 0.05
+        token = self.proxy.session.open()
+        session = self.pool.sticky_session(token).so
+        time.sleep(0.1)
+        self.pool.reap_idle()
+        self.failUnless(session.disconnected)
+        self.assertEqual(self.pool.sessions(), [])
+        self.assertRaises(xmlrpclib.Fault, getattr(self.proxy, token + '.whoami'))
+    def testNoReapMidCall(self):
+        self.pool.idle_timeout = 0.05
+        token = self.proxy.session.open()
+        session = self.pool.sticky_session(token).so
+        session.proceed.clear()
+        results = []
+        thread = threading.Thread(target=lambda: results.append(getattr(self.client(), token + '.block')()))
+        thread.start()
+        session.blocked.wait(5)
+        time.sleep(0.1)
+        self.pool.reap_idle()
+        self.failIf(session.disconnected)
+        session.proceed.set()
+        thread.join()
+        self.assertEqual(results, [True])
+        ## idle time runs from the end of the call
+        self.pool.reap_idle()
+        self.failIf(session.disconnected)
+        self.assertEqual(getattr(self.proxy, token + '.whoami')()[0], session.serial)
+    def testReloadConfig(self):
+        self.proxy.whoami()
+        self.pool.reload_config(configobj.ConfigObj({'General': {'greeting': 'bonjour'}}))
+        self.assertEqual(self.proxy.greeting(), 'bonjour')
+    def testBatch(self):
+        results = self.proxy.system.batch([{'methodName': 'whoami'}, {'methodName': 'nonesuch'}, {'methodName': 'whoami'}])
+        self.assertEqual(results[0][0][1] + 1, results[2][0][1])
+        self.failUnless('faultCode' in results[1])
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: sw=4 ts=4 sts=4 sta et ai
@@ -0,0 +1,33 @@
+"""pxtty's waits on a child's output."""
+
+import unittest
+import warnings
+
+from isg.util.screen_scraper import pxtty
+from isg.util.screen_scraper.terminal import TrackingANSI
+
+class ExpectDelayTest(unittest.TestCase):
+    def setUp(self):
+        self.child = pxtty.spawn('/bin/cat', TrackingANSI())
+    def tearDown(self):
+        self.child.close(force=True)
+    def testSettle(self):
+        self.child.send('hello')
+        self.child.expect_delay(0.1, timeout=5, require_input=5)
+        self.assertEqual(self.child.term.dump_row(0).strip(), 'hello')
+    def testResolutionDeprecated(self):
+        caught = warnings.catch_warnings(record=True)
+        log = caught.__enter__()
+        try:
+            warnings.simplefilter('always', DeprecationWarning)
+            self.child.expect_delay(0.05, timeout=5)
+            self.assertEqual(log, [])
+            self.child.expect_delay(0.05, timeout=5, resolution=0.25)
+            self.assertEqual([ warning.category for warning in log ], [DeprecationWarning])
+        finally:
+            caught.__exit__()
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: sw=4 ts=4 sts=4 sta et ai
@@ -0,0 +1,57 @@
+"""The Reactor, running coroutines together."""
+
+import os
+import time
+import unittest
+
+from isg.util.reactor import Reactor, Return, Sleep, Waitable, WaitReadable
+
+def sleeper(seconds, log):
+    yield Sleep(seconds)
+    log.append(seconds)
+    yield Return(seconds)
+
+def waitForever():
+    waitable = Waitable()
+    yield waitable
+    yield Return(waitable.result())
+
+class ReactorTest(unittest.TestCase):
+    def testSleepsInterleave(self):
+        reactor = Reactor()
+        log = []
+        calls = [ reactor.spawn(sleeper(seconds, log)) for seconds in (0.2, 0.1) ]
+        start = time.time()
+        reactor.run()
+        self.failUnless(time.time() - start < 0.3)
+        self.assertEqual(log, [0.1, 0.2])
+        self.assertEqual([ call.result() for call in calls ], [0.2, 0.1])
+    def testWaitReadable(self):
+        r, w = os.pipe()
+        try:
+            def reader():
+                ready = WaitReadable(r, timeout=5)
+                yield ready
+                yield Return((ready.result(), os.read(r, 5)))
+            def writer():
+                yield Sleep(0.05)
+                os.write(w, 'hello')
+            reactor = Reactor()
+            call = reactor.spawn(reader())
+            reactor.spawn(writer())
+            reactor.run()
+            self.assertEqual(call.result(), (True, 'hello'))
+        finally:
+            os.close(r)
+            os.close(w)
+    def testWaitableWithNothingToWaitOn(self):
+        ## would otherwise spin in run() for ever
+        reactor = Reactor()
+        call = reactor.spawn(waitForever())
+        reactor.run()
+        self.assertRaises(ValueError, call.result)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: sw=4 ts=4 sts=4 sta et ai
@@ -0,0 +1,86 @@
+"""Recording sessions against the fake host, and replaying them without it."""
+
+import glob
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+
+from isg.util.screen_scraper import recording
+from isg.util.screen_scraper.recording import RecordingError, ReplayDivergence
+
+from benchmarks import flows
+
+class RecordingTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.directory = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        logging.disable(logging.NOTSET)
+    def record(self, compress=False):
+        """Run the flow against the fake host, recording it; return the recording's filename and what was captured."""
+        config = flows.makeConfig(flows.fakehostCommand(pages=2))
+        config['Record'] = {'directory': self.directory, 'compress': str(compress)}
+        machine = flows.makeMachine(config)
+        machine.run()
+        captured = (machine.captured, dict(machine._BenchScreens__data))
+        machine.transitionTo('DISCONNECTED')
+        filenames = glob.glob(os.path.join(self.directory, '*'))
+        self.assertEqual(len(filenames), 1)
+        return filenames[0], captured
+    def replayMachine(self, filename, speed=None):
+        config = flows.makeConfig('unused')
+        config['Connect']['replayFile'] = filename
+        if speed is not None:
+            config['Connect']['replaySpeed'] = str(speed)
+        return flows.makeMachine(config)
+    def replay(self, filename, speed=None):
+        machine = self.replayMachine(filename, speed)
+        try:
+            machine.run()
+            return machine.captured, dict(machine._BenchScreens__data)
+        finally:
+            machine.transitionTo('DISCONNECTED')
+    def testReplay(self):
+        filename, captured = self.record()
+        parsed = recording.load(filename)
+        self.failUnless(parsed.output())
+        self.failUnless(parsed.input().startswith('bench'))
+        self.assertEqual(self.replay(filename), captured)
+        ## and again, from the cached recording
+        self.failUnless(recording.load(filename) is parsed)
+        self.assertEqual(self.replay(filename), captured)
+    def testCompressed(self):
+        filename, captured = self.record(compress=True)
+        self.failUnless(filename.endswith('.gz'))
+        self.assertEqual(self.replay(filename), captured)
+    def testRealTime(self):
+        filename, captured = self.record()
+        parsed = recording.load(filename)
+        duration = parsed.records[-1][1]
+        start = time.time()
+        self.assertEqual(self.replay(filename, speed=1), captured)
+        ## gaps are reproduced, give or take the settle waits
+        self.failUnless(time.time() - start >= duration * 0.5)
+    def testDivergence(self):
+        filename, captured = self.record()
+        machine = self.replayMachine(filename)
+        machine.reports.reverse()
+        try:
+            self.assertRaises(ReplayDivergence, machine.run)
+        finally:
+            machine.transitionTo('DISCONNECTED')
+    def testNotARecording(self):
+        self.assertRaises(RecordingError, recording.parse, 'nonsense')
+        header = struct.pack(recording.HEADER_FORMAT, recording.MAGIC, recording.FORMAT_VERSION, 0)
+        self.assertEqual(len(recording.parse(header)), 0)
+        self.assertRaises(RecordingError, recording.parse, header + struct.pack(recording.RECORD_FORMAT, recording.OUTPUT, 0, 10) + 'short')
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: sw=4 ts=4 sts=4 sta et ai
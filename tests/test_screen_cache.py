@@ -0,0 +1,74 @@
+"""The screen cache, imaging the same screen more than once."""
+
+import configobj
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from isg.state_machine import StateMachineHandler
+from isg.util.screen_scraper import BaseConnection
+
+## draws a menu which redirects to its "other" substate, then waits to be killed
+HOST = r'''
+import sys, time
+sys.stdout.write('\x1b[2J\x1b[H MAIN MENU\r\nACCT 12345\r\nTHIS OTHER\r\n')
+sys.stdout.flush()
+time.sleep(60)
+'''
+
+SCREENS = '''
+[General]
+settle_time = 0.1
+screen_cache_size = 4
+[screens]
+[[CacheScreens]]
+[[[MENU]]]
+[[[[default]]]]
+verify_1 = 1, MAIN MENU
+redirect_1 = regex, 3, 1, 10, THIS OTHER, other
+[[[[other]]]]
+data__acct = fixedpos, 2, 6, 5, 1
+'''.splitlines()
+
+class CacheScreens(BaseConnection):
+    def do__MENU(self):
+        for i in range(2):
+            self._CacheScreens__data = {}
+            self.image_screen()
+            self.imaged.append((self.last_screen, dict(self._CacheScreens__data)))
+        self.exitStateMachine()
+
+class Machine(StateMachineHandler):
+    pass
+
+class RedirectCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        script = os.path.join(self.directory, 'host.py')
+        open(script, 'w').write(HOST)
+        config = configobj.ConfigObj(SCREENS)
+        config['Connect'] = {'spawnString': '%s %s' % (sys.executable, script)}
+        CacheScreens.config = config
+        self.machine = Machine()
+        self.machine.inherit(CacheScreens)
+        self.machine.imaged = []
+    def tearDown(self):
+        self.machine.transitionTo('DISCONNECTED')
+        shutil.rmtree(self.directory)
+    def testRedirectedScreenImagedTwice(self):
+        machine = self.machine
+        machine.cmd_connect()
+        machine.setState('MENU')
+        machine.run()
+        redirected = ('CacheScreens', 'MENU', 'other')
+        self.assertEqual(machine.imaged, [(redirected, {'acct': '12345'})] * 2)
+        stats = machine.screen_cache_stats()
+        ## the first imaging misses on both the menu and the screen it redirects to
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: sw=4 ts=4 sts=4 sta et ai
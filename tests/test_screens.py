@@ -0,0 +1,34 @@
+"""Compiling [screens] definitions, and reporting malformed ones."""
+
+import configobj
+import unittest
+
+from isg.util.screen_scraper.screens import ScreenConfigError, compile_screens
+
+def screens(*lines):
+    return configobj.ConfigObj(['[Screens]', '[[MENU]]', '[[[default]]]'] + list(lines))
+
+class CompileScreensTest(unittest.TestCase):
+    def testCompile(self):
+        specs = compile_screens(screens(
+            "verify_1 = 1, MAIN MENU",
+            "redirect_1 = regex, 3, 1, 10, THIS OTHER, other",
+            "data__acct = fixedpos, 2, 6, 5, 1"))
+        spec = specs[('Screens', 'MENU', 'default')]
+        self.assertEqual([ verify.lineno for verify in spec.verifies ], [1])
+        self.assertEqual([ redirect.target for redirect in spec.redirects ], ['other'])
+        self.assertEqual([ (capture.name, capture.lineno, capture.startcol, capture.length) for capture in spec.captures ],
+                         [('acct', 2, 6, 5)])
+    def testEmptyCapture(self):
+        self.assertRaises(ScreenConfigError, compile_screens, screens("data__acct = ,"))
+    def testEmptyRedirect(self):
+        self.assertRaises(ScreenConfigError, compile_screens, screens("redirect_1 = ,"))
+    def testMalformed(self):
+        for line in ["data__acct = fixedpos, 2, 6", "data__acct = regex, 2, 6, 5, 1",
+                     "verify_1 = x, MAIN MENU", "redirect_1 = regex, 3, 1, 10, (, other"]:
+            self.assertRaises(ScreenConfigError, compile_screens, screens(line))
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: sw=4 ts=4 sts=4 sta et ai
@@ -0,0 +1,121 @@
+"""SpawnPool: warming children, handing them out, and health-checking those waiting."""
+
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import unittest
+
+from isg.util.screen_scraper import pxtty
+from isg.util.screen_scraper.screens import compile_verify
+from isg.util.screen_scraper.spawnpool import SpawnPool, reaper
+from isg.util.screen_scraper.terminal import TrackingANSI
+
+from benchmarks import flows
+
+## logs in, shows the menu, and after lock_after seconds (if given) replaces it with a lock screen
+HOST = r'''
+import sys, time
+sys.stdout.write('\x1b[2J\x1b[Hlogin: ')
+sys.stdout.flush()
+sys.stdin.readline()
+sys.stdout.write('\x1b[2J\x1b[HMAIN MENU\r\n')
+sys.stdout.flush()
+if len(sys.argv) > 1:
+    time.sleep(float(sys.argv[1]))
+    sys.stdout.write('\x1b[2J\x1b[HLOCKED\r\n')
+    sys.stdout.flush()
+time.sleep(60)
+'''
+
+def waitFor(condition, timeout=10):
+    end_time = time.time() + timeout
+    while not condition():
+        if time.time() > end_time:
+            return False
+        time.sleep(0.01)
+    return True
+
+class SpawnPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.script = os.path.join(self.directory, 'host.py')
+        open(self.script, 'w').write(HOST)
+        self.pools = []
+        self.children = []
+    def tearDown(self):
+        for pool in self.pools:
+            pool.stop()
+        for child in self.children:
+            reaper.reap(child)
+        waitFor(lambda: not len(reaper))
+        shutil.rmtree(self.directory)
+    def makePool(self, size=1, lock_after=None, check_interval=60):
+        command = '%s %s' % (sys.executable, self.script)
+        if lock_after is not None:
+            command += ' %r' % lock_after
+        def spawn():
+            return pxtty.spawn(command, TrackingANSI())
+        pool = SpawnPool(spawn, size, login=[('login:', 'me\r')],
+                         verifies=[compile_verify(['SpawnPool'], '1', ['1', 'MAIN MENU'])],
+                         verify_timeout=2, settle_time=0.1, check_interval=check_interval)
+        self.pools.append(pool)
+        pool.start()
+        self.failUnless(waitFor(lambda: pool.ready() == size), 'the pool did not warm')
+        return pool
+    def acquire(self, pool, timeout=0):
+        child = pool.acquire(timeout)
+        if child is not None:
+            self.children.append(child)
+        return child
+    def testAcquire(self):
+        pool = self.makePool(size=2)
+        child = self.acquire(pool)
+        self.failUnless(child.isalive())
+        self.assertEqual(child.term.dump_row(0).strip(), 'MAIN MENU')
+        ## the pool is refilled in the background
+        self.failUnless(waitFor(lambda: pool.ready() == 2))
+    def testAcquireDoesNotVerify(self):
+        ## the screen changes once the child is ready, and only the sweep (not due for a minute) would notice
+        pool = self.makePool(lock_after=0.2)
+        time.sleep(0.4)
+        start = time.time()
+        child = self.acquire(pool)
+        self.failUnless(child is not None)
+        self.failUnless(time.time() - start < 1, 'acquire waited on a verify')
+        ## the lock screen waiting was read in on the way
+        self.assertEqual(child.term.dump_row(0).strip(), 'LOCKED')
+    def testDeadChildNotHandedOut(self):
+        pool = self.makePool()
+        child = pool._SpawnPool__ready[0]
+        os.kill(child.pid, signal.SIGKILL)
+        self.failUnless(waitFor(lambda: not child.isalive()))
+        replacement = self.acquire(pool)
+        self.failIf(replacement is child)
+    def testAlive(self):
+        pool = self.makePool()
+        child = self.acquire(pool)
+        self.failUnless(pool.alive(child))
+        child.sendeof()
+        os.kill(child.pid, signal.SIGKILL)
+        self.failUnless(waitFor(lambda: not pool.alive(child)))
+    def testSweepReapsUnhealthy(self):
+        pool = self.makePool(lock_after=0.3, check_interval=0.2)
+        first = pool._SpawnPool__ready[0]
+        ## locked, it fails the sweep's verify and is replaced (by a child which in turn locks)
+        self.failUnless(waitFor(lambda: first not in pool._SpawnPool__ready))
+        ## and collected by the reaper
+        self.failUnless(waitFor(lambda: first.closed))
+
+class PooledSessionTest(unittest.TestCase):
+    def testPoolFlow(self):
+        ## every session starts on the menu with a pooled child, and the children are reaped afterwards
+        figures = flows.poolFlow(sessions=2)
+        self.assertEqual(figures['pooled'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: sw=4 ts=4 sts=4 sta et ai